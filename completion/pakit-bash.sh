@@ -27,7 +27,7 @@ _pakit() {
 
   local available opts subcoms
   opts="-c -h -v --conf --help --version"
-  subcoms="install remove update display list available search relink"
+  subcoms="install remove update display list available search relink rdeps gc config"
   if [ "${__COMP_CACHE_PAKIT}x" = "x" ]; then
     available=$($prog available --short 2>/dev/null)
     __COMP_CACHE_PAKIT=( "$available" )
@@ -56,8 +56,13 @@ _pakit() {
      [ "$(word_in_array "display" "${COMP_WORDS[@]}")" = "1" ]; then
     COMPREPLY=( $(compgen -W "${subopts} ${available}" -- "${cur}") )
     return 0
-  elif [ "$(word_in_array "remove" "${COMP_WORDS[@]}")" = "1" ] ||
-       [ "$(word_in_array "update" "${COMP_WORDS[@]}")" = "1" ]; then
+  elif [ "$(word_in_array "remove" "${COMP_WORDS[@]}")" = "1" ]; then
+    local installed=$($prog list --short 2>/dev/null)
+    COMPREPLY=( $(compgen -W "${subopts} --cascade ${installed}" -- "${cur}") )
+    return 0
+  elif [ "$(word_in_array "update" "${COMP_WORDS[@]}")" = "1" ] ||
+       [ "$(word_in_array "rdeps" "${COMP_WORDS[@]}")" = "1" ] ||
+       [ "$(word_in_array "relink" "${COMP_WORDS[@]}")" = "1" ]; then
     local installed=$($prog list --short 2>/dev/null)
     COMPREPLY=( $(compgen -W "${subopts} ${installed}" -- "${cur}") )
     return 0
@@ -66,11 +71,16 @@ _pakit() {
     COMPREPLY=( $(compgen -W "${subopts} --short" -- "${cur}") )
     return 0
   elif [ "$(word_in_array "search" "${COMP_WORDS[@]}")" = "1" ]; then
-    local search_flags="--case --names"
+    local search_flags="--case --names --all --regex"
     COMPREPLY=( $(compgen -W "${subopts} ${search_flags}" -- "${cur}") )
     return 0
-  elif [ "$(word_in_array "purge" "${COMP_WORDS[@]}")" = "1" ] ||
-       [ "$(word_in_array "relink" "${COMP_WORDS[@]}")" = "1" ]; then
+  elif [ "$(word_in_array "gc" "${COMP_WORDS[@]}")" = "1" ]; then
+    COMPREPLY=( $(compgen -W "${subopts} --dry-run" -- "${cur}") )
+    return 0
+  elif [ "$(word_in_array "config" "${COMP_WORDS[@]}")" = "1" ]; then
+    COMPREPLY=( $(compgen -W "${subopts} --which" -- "${cur}") )
+    return 0
+  elif [ "$(word_in_array "purge" "${COMP_WORDS[@]}")" = "1" ]; then
     COMPREPLY=( $(compgen -W "${subopts}" -- "${cur}") )
     return 0
   fi
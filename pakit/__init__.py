@@ -14,6 +14,7 @@ When you install a program Pakit will...
 
 See...
 - *pakit.conf* for information on configuration, including defaults.
+- *pakit.daemon* for pakitd, which keeps pakit loaded between commands.
 - *pakit.exc* for all exception classes.
 - *pakit.graph* for all graphing code.
 - *pakit.main* for all argument parsing and task running logic.
@@ -23,12 +24,65 @@ See...
 
 Configuration is done by YAML file in your $HOME folder.
 The default is `$HOME/.pakit.yml`.
+
+The names in __all__ are imported on first use, like the modules given
+to lazy_import. Commands pakitd runs never load most of pakit.
 """
 from __future__ import absolute_import
-
-from pakit.recipe import Recipe
-from pakit.shell import Archive, Dummy, Git, Hg
+import importlib
+import importlib.util
+import sys
 
 __all__ = ['Archive', 'Dummy', 'Git', 'Hg', 'Recipe']
-
 __version__ = '0.2.5'
+
+LAZY_NAMES = {
+    'Archive': 'pakit.shell',
+    'Dummy': 'pakit.shell',
+    'Git': 'pakit.shell',
+    'Hg': 'pakit.shell',
+    'Recipe': 'pakit.recipe',
+}
+
+
+def __getattr__(name):
+    """
+    Import the names in __all__ from their modules on first use.
+    """
+    if name not in LAZY_NAMES:
+        raise AttributeError("module 'pakit' has no attribute " + repr(name))
+
+    obj = getattr(importlib.import_module(LAZY_NAMES[name]), name)
+    globals()[name] = obj
+    return obj
+
+
+def lazy_import(name):
+    """
+    The lazy form of `import name`, the module is only executed when
+    one of its attributes is first used.
+
+    Args:
+        name: The full name of the module.
+
+    Returns:
+        The module, None if it is not installed.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+
+    return module
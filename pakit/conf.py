@@ -6,21 +6,36 @@ YamlDict: A dictionary class similar to UserDict, can be serialized
 YamlNestedDict: Same as YamlDict for convenient nesting.
 Config: Handles global configuration of pakit.
 InstallDB: Handles the database of installed programs.
+SqliteInstallDB: The InstallDB kept in SQLite, the default backend.
+open_idb: Open the InstallDB with the configured backend.
 RecipeURIDB: Store and track recipe URIs.
 """
 from __future__ import absolute_import
+import contextlib
 import copy
 import json
 import logging
 import os
 import tempfile
 import time
+from collections import ChainMap
 from collections.abc import MutableMapping
+from types import MappingProxyType
 
-import yaml
+from pakit import lazy_import
+from pakit.exc import PakitError
+
+sqlite3 = lazy_import('sqlite3')
+yaml = lazy_import('yaml')
 
 CONFIG = None
 IDB = None
+IDB_FILES = {
+    'sqlite': 'idb.db',
+    'yaml': 'idb.yml',
+}
+PARSED = {}
+SQLITE_TIMEOUT = 30
 TMP_DIR = tempfile.mkdtemp(prefix='pakit_cmd_stdout_')
 TEMPLATE = {
     'pakit': {
@@ -30,6 +45,19 @@ TEMPLATE = {
         'defaults': {
             'repo': 'stable',
         },
+        'gc': {
+            'auto': True,
+            'keep': 0,
+            'max_age': 60 * 60 * 24 * 7,
+            'max_source': 2 * 1024 ** 3,
+        },
+        'idb': {
+            'backend': 'sqlite',
+        },
+        'link': {
+            'fold': False,
+            'priority': [],
+        },
         'log': {
             'enabled': True,
             'file': '/tmp/pakit/main.log',
@@ -50,18 +78,74 @@ TEMPLATE = {
         },
     },
 }
+TEMPLATE_LOOKUP = None
+
+
+def flatten(obj):
+    """
+    Build a flat table of nested dictionaries.
+
+    Args:
+        obj: A dictionary, the values may be dictionaries themselves.
+
+    Returns:
+        A dict mapping every dotted key path onto its value,
+        i.e. table['a.b.c'] = obj['a']['b']['c'].
+        Dictionaries along the way are mapped as well, table['a.b'].
+    """
+    table = {}
+    stack = [('', obj or {})]
+    while stack:
+        prefix, node = stack.pop()
+        for key, val in node.items():
+            path = prefix + str(key)
+            table[path] = val
+            if isinstance(val, dict):
+                stack.append((path + '.', val))
+
+    return table
+
+
+def template_lookup():
+    """
+    The flat table of TEMPLATE, see flatten. Built on first use.
+    """
+    global TEMPLATE_LOOKUP  # pylint: disable=global-statement
+    if TEMPLATE_LOOKUP is None:
+        TEMPLATE_LOOKUP = MappingProxyType(flatten(TEMPLATE))
+    return TEMPLATE_LOOKUP
+
+
+def fsync_dir(path):
+    """
+    Sync a directory, making renames inside it durable.
+    Not every platform supports it, failures are ignored.
+    """
+    try:
+        dir_fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
 
 
 class YamlDict(MutableMapping):
     """
     A custom dictionary with special features:
         - Essentially like UserDict
-        - Written to self.filename with write()
+        - Written to self.filename with write(), only when changed
         - Loads arbitrary dictionary obj into self.data with read()
+        - Writes inside batch() are done once, when it ends
     """
     def __init__(self, fname=None, default_data=None):
         self.data = {}
         self.filename = fname
+        self._batch = 0
+        self._saved = None
         if self.filename and os.path.exists(self.filename):
             self.read()
         elif default_data:
@@ -95,13 +179,37 @@ class YamlDict(MutableMapping):
         """
         del self[key]
 
+    @property
+    def changed(self):
+        """
+        True iff the data changed since it was last read or written.
+        """
+        return self.data != self._saved
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Defer calls to write() until the outermost batch ends,
+        then write once. Nothing is written if an error escapes.
+        Every task holds one on the InstallDB, see run_tasks.
+        """
+        self._batch += 1
+        try:
+            yield self
+        finally:
+            self._batch -= 1
+        self.write()
+
     def read(self):
         """
         Read the config file into a python object.
         """
+        # The libyaml loader when available, much faster
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
         try:
             with open(self.filename) as fin:
-                self.data = yaml.load(fin, Loader=yaml.FullLoader)
+                self.data = yaml.load(fin, Loader=loader)
+            self._saved = copy.deepcopy(self.data)
             logging.debug(self)
         except IOError as exc:
             logging.error('Failed to load user config. %s', exc)
@@ -109,13 +217,43 @@ class YamlDict(MutableMapping):
     def write(self):
         """
         Write the contents of a python dictionary to the config file.
+        Does nothing inside a batch or when the data did not change.
+        """
+        if not self._batch and self.changed:
+            self.commit()
 
-        Args:
-            obj: An arbitrarily filled python dictionary.
+    def commit(self):
         """
-        with open(self.filename, 'w') as fout:
-            yaml.dump(self.data, fout, default_flow_style=False)
-            logging.info('Config written to: %s', self.filename)
+        Write the file now, replacing it atomically.
+        The data goes to a temporary file beside it that is synced
+        and renamed over it, the file is never left half written.
+        """
+        dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp_file = tempfile.mkstemp(
+            prefix='.' + os.path.basename(self.filename) + '.', dir=dirname)
+        try:
+            with os.fdopen(fd, 'w') as fout:
+                yaml.dump(self.data, fout, Dumper=dumper,
+                          default_flow_style=False)
+                fout.flush()
+                os.fsync(fout.fileno())
+            try:
+                mode = os.stat(self.filename).st_mode & 0o777
+            except OSError:
+                mode = 0o644
+            os.chmod(tmp_file, mode)
+            os.rename(tmp_file, self.filename)
+        except BaseException:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise
+        fsync_dir(dirname)
+
+        self._saved = copy.deepcopy(self.data)
+        logging.info('Config written to: %s', self.filename)
 
 
 class YamlNestedDict(YamlDict):
@@ -123,18 +261,43 @@ class YamlNestedDict(YamlDict):
     Same as YamlDict except:
         - Allows nested dictionary shorthand,
           i.e. dict['a.b.c'] = dict['a']['b']['c']
+        - Lookups go through a flat table of every dotted key,
+          built on first use and discarded whenever the data changes.
+          Changes made directly to nested values are not seen,
+          set them through the dotted key instead.
     """
     def __init__(self, fname=None, default_data=None):
+        self._lookup = None
         super(YamlNestedDict, self).__init__(fname, default_data)
 
-    def __getitem__(self, key_str):
-        obj = self.data
-        keys = key_str.split('.')
-        leaf = keys[-1]
+    @property
+    def data(self):
+        """
+        The nested dictionaries, replacing them discards the lookup table.
+        """
+        return self._data
 
-        for key in keys[0:-1]:
-            obj = obj[key]
-        return obj[leaf]
+    @data.setter
+    def data(self, new_data):
+        self._data = new_data
+        self._lookup = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_lookup'] = None
+        return state
+
+    @property
+    def lookup(self):
+        """
+        A read-only flat table of the data, see flatten.
+        """
+        if self._lookup is None:
+            self._lookup = MappingProxyType(flatten(self.data))
+        return self._lookup
+
+    def __getitem__(self, key_str):
+        return self.lookup[key_str]
 
     def __setitem__(self, key_str, new_val):
         obj = self.data
@@ -149,6 +312,7 @@ class YamlNestedDict(YamlDict):
                 obj = obj[key]
 
         obj[leaf] = new_val
+        self._lookup = None
 
     def __delitem__(self, key_str):
         obj = self.data
@@ -158,6 +322,7 @@ class YamlNestedDict(YamlDict):
         for key in keys[0:-1]:
             obj = obj[key]
         del obj[leaf]
+        self._lookup = None
 
 
 class Config(YamlNestedDict):
@@ -173,6 +338,41 @@ class Config(YamlNestedDict):
         The timeout for commands.
         When no stdout produced for timeout seconds kill the process.
 
+    pakit.gc.auto
+        When True, garbage is collected in the background after
+        installing, removing or updating recipes. See `pakit gc`.
+
+    pakit.gc.keep
+        How many old versions of each installed recipe to keep
+        beside the current one.
+
+    pakit.gc.max_age
+        Source trees, leftover temporary files and installs of recipes
+        no longer in the install database are deleted once they have
+        not been modified for max_age seconds.
+
+    pakit.gc.max_source
+        The source trees are trimmed, oldest first, until they use at
+        most max_source bytes. Set to 0 for no limit.
+
+    pakit.idb.backend
+        How the database of installed recipes is stored in
+        `pakit.paths.prefix`, either 'sqlite' or 'yaml'.
+        The 'sqlite' backend writes only the recipes that changed, in a
+        single transaction, and is safe to use from concurrent pakit
+        commands. An existing 'yaml' database is imported into it once.
+
+    pakit.link.fold
+        When True, a folder only one recipe installs into is linked as
+        a whole rather than file by file, like GNU stow.
+        It is unfolded automatically when another recipe needs it.
+
+    pakit.link.priority
+        A list of recipe names, earlier recipes win link conflicts.
+        When two recipes install the same file, the link goes to the one
+        listed first. Recipes not listed lose to any that are listed.
+        Conflicts between two unlisted recipes fail before linking.
+
     pakit.log.enabled
         Toggles the file logger. Console errors are always enabled.
 
@@ -191,6 +391,8 @@ class Config(YamlNestedDict):
         All recipes will be installed inside their own silos here.
         Using the above config, the recipe `ag` would be
         installed under `/tmp/pakit/builds/ag`.
+        Each version gets its own folder there, named by its source hash,
+        and the `current` link points at the active one.
 
     pakit.paths.recipes
         Path to a folder where all recipes will be stored.
@@ -201,7 +403,8 @@ class Config(YamlNestedDict):
 
     pakit.recipe.update_interval
         After a recipe uri has not been updated for update_interval seconds
-        check for updates.
+        check for updates. Updates run in the background, new recipes
+        are used from the next run of pakit.
 
     pakit.recipe.uris
         The list contains a series of dictionaries that specify recipes.
@@ -251,14 +454,35 @@ class Config(YamlNestedDict):
         """
         key = args[0]
         try:
-            return self[key]
+            return self.lookup[key]
         except KeyError:
             if len(args) > 1:
                 return args[1]
             else:
-                ydict = YamlNestedDict()
-                ydict.data = TEMPLATE
-                return ydict[key]
+                return template_lookup()[key]
+
+    def read(self):
+        """
+        Read the config file into a python object.
+        The parsed file is kept in PARSED, reading it again while its
+        mtime, size and inode are unchanged skips parsing.
+        """
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            super(Config, self).read()
+            return
+
+        key = os.path.realpath(self.filename)
+        stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+        cached = PARSED.get(key)
+        if cached is not None and cached[0] == stamp:
+            self.data = copy.deepcopy(cached[1])
+            self._saved = cached[1]
+            return
+
+        super(Config, self).read()
+        PARSED[key] = (stamp, self._saved)
 
     def reset(self):
         """
@@ -274,19 +498,20 @@ class Config(YamlNestedDict):
             recipe_name: The recipe to look for.
 
         Returns:
-            A dictionary that starts with everything under
-            config['pakit']['defaults'] and updates the dictionary
-            with the values in:
-                - config['pakit']['paths']
+            A ChainMap over the config, nothing is copied.
+            Keys are looked up in order in:
                 - config[recipe_name]
+                - config['pakit']['paths']
+                - config['pakit']['defaults']
+            Keys set on it go to a new dictionary in front.
         """
-        opts = copy.deepcopy(self['pakit.defaults'])
-        opts.update(self['pakit.paths'])
+        layers = [{}]
         try:
-            opts.update(self[recipe_name])
+            layers.append(self[recipe_name])
         except KeyError:
             pass
-        return opts
+        layers += [self.get('pakit.paths'), self.get('pakit.defaults')]
+        return ChainMap(*layers)
 
     def path_to(self, key):
         """
@@ -312,13 +537,123 @@ class InstallDB(YamlDict):
         - the date built
         - the repo source code was retrieved from
         - the hash of the build
+        - the manifest of links made, paths relative to the link dir
+        - the names of the recipes it requires
+
+    Changes made inside a transaction() are written together when it ends.
 
     Attributes:
         filename: The file that holds the config.
     """
     def __init__(self, filename):
+        self._owners = None
+        self._dependents = None
         super(InstallDB, self).__init__(filename)
 
+    def __setitem__(self, key_str, new_val):
+        super(InstallDB, self).__setitem__(key_str, new_val)
+        self._owners = None
+        self._dependents = None
+
+    def __delitem__(self, key_str):
+        super(InstallDB, self).__delitem__(key_str)
+        self._owners = None
+        self._dependents = None
+
+    @property
+    def owners(self):
+        """
+        An index of every link in the manifests onto the recipe owning it.
+        Built on first use, discarded whenever an entry changes.
+
+        Returns:
+            A dict mapping links, relative to the link dir, onto names.
+        """
+        if self._owners is None:
+            self._owners = {}
+            for name, entry in self.data.items():
+                for link in (entry or {}).get('links', []):
+                    self._owners[link] = name
+
+        return self._owners
+
+    @property
+    def dependents(self):
+        """
+        An index of every recipe onto the installed recipes requiring it.
+        Built on first use, discarded whenever an entry changes.
+
+        Returns:
+            A dict mapping names onto a sorted list of names.
+        """
+        if self._dependents is None:
+            self._dependents = {}
+            for name, entry in self.data.items():
+                for requirement in (entry or {}).get('requires', []):
+                    self._dependents.setdefault(requirement, []).append(name)
+            for names in self._dependents.values():
+                names.sort()
+
+        return self._dependents
+
+    def rdeps(self, names):
+        """
+        Find the installed recipes that require any of names,
+        either directly or through other installed recipes.
+
+        Args:
+            names: A list of recipe names.
+
+        Returns:
+            A sorted list of the dependent names, excluding names.
+        """
+        found = set(names)
+        queue = list(names)
+        while queue:
+            for dependent in self.dependents.get(queue.pop(), []):
+                if dependent not in found:
+                    found.add(dependent)
+                    queue.append(dependent)
+
+        return sorted(found.difference(names))
+
+    def read(self):
+        """
+        Read the database file into a python object.
+        """
+        if os.path.exists(self.filename):
+            super(InstallDB, self).read()
+        else:
+            self.data = {}
+            self._saved = {}
+        self._owners = None
+        self._dependents = None
+
+    def stamp(self):
+        """
+        A value that changes whenever another process writes
+        the database, None if it was never written.
+        """
+        try:
+            return os.path.getmtime(self.filename)
+        except OSError:
+            return None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group the changes to several recipes, see batch().
+        If an error escapes, the changes are dropped and the database
+        is read again.
+        """
+        try:
+            with self.batch():
+                yield self
+        except BaseException:
+            if not self._batch:
+                self.read()
+            raise
+
     def add(self, *args):
         """
         Update the database for recipe.
@@ -326,19 +661,154 @@ class InstallDB(YamlDict):
 
         Args:
             recipe: The Recipe object to add to the database.
+            links: Optional, the manifest returned by walk_and_link.
         """
         recipe = args[0]
+        links = args[1] if len(args) == 2 else None
         timestamp = time.time()
-        self[recipe.name] = {
+        entry = {
             'date': time.strftime('%H:%M:%S %d/%m/%y',
                                   time.localtime(timestamp)),
             'hash': recipe.repo.src_hash,
             'repo': recipe.repo_name,
+            'requires': list(getattr(recipe, 'requires', [])),
             'time': timestamp,
         }
+        if links is not None:
+            entry['links'] = sorted(links)
+        self[recipe.name] = entry
         self.write()
 
 
+class SqliteInstallDB(InstallDB):
+    """
+    An InstallDB kept in SQLite, each recipe is a row holding its entry
+    as JSON.
+
+    Only the rows changed since the last read or write are written,
+    in one transaction. The database runs in WAL mode, readers never
+    wait on a writer and concurrent pakit commands only wait on each
+    other while writing.
+
+    Attributes:
+        conn: The connection to the database.
+        filename: The database file.
+    """
+    def __init__(self, filename):
+        self._dirty = set()
+        self.conn = sqlite3.connect(filename, timeout=SQLITE_TIMEOUT,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS installed '
+                          '(name TEXT PRIMARY KEY, entry TEXT)')
+        super(SqliteInstallDB, self).__init__(filename)
+
+    def __setitem__(self, key_str, new_val):
+        super(SqliteInstallDB, self).__setitem__(key_str, new_val)
+        self._dirty.add(key_str)
+
+    def __delitem__(self, key_str):
+        super(SqliteInstallDB, self).__delitem__(key_str)
+        self._dirty.add(key_str)
+
+    @property
+    def changed(self):
+        """
+        True iff rows changed since the last read or write.
+        """
+        return bool(self._dirty)
+
+    def read(self):
+        """
+        Read every row of the database, pending changes are dropped.
+        """
+        rows = self.conn.execute('SELECT name, entry FROM installed')
+        self.data = dict([(name, json.loads(entry)) for name, entry in rows])
+        self._dirty.clear()
+        self._owners = None
+        self._dependents = None
+
+    def commit(self):
+        """
+        Write the rows changed since the last read or write.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for name in sorted(self._dirty):
+                if name in self.data:
+                    cursor.execute('INSERT OR REPLACE INTO installed '
+                                   'VALUES (?, ?)',
+                                   (name, json.dumps(self.data[name],
+                                                     sort_keys=True)))
+                else:
+                    cursor.execute('DELETE FROM installed WHERE name = ?',
+                                   (name,))
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        self._dirty.clear()
+
+    def stamp(self):
+        """
+        A value that changes whenever another connection writes
+        the database.
+        """
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def migrate(self, yaml_file):
+        """
+        Import the entries of a YAML InstallDB into an empty database.
+        The YAML file is renamed with a '.bak' suffix once imported.
+
+        Args:
+            yaml_file: The InstallDB file of the 'yaml' backend.
+
+        Returns:
+            True iff entries were imported.
+        """
+        if self.data or not os.path.exists(yaml_file):
+            return False
+
+        with self.transaction():
+            old_db = InstallDB(yaml_file)
+            for name in old_db:
+                self[name] = old_db[name]
+        os.rename(yaml_file, yaml_file + '.bak')
+        logging.info('InstallDB imported from: %s', yaml_file)
+        return True
+
+
+def open_idb(config):
+    """
+    Open the InstallDB in `pakit.paths.prefix` with the backend
+    selected by `pakit.idb.backend`.
+
+    Args:
+        config: The pakit configuration.
+
+    Returns:
+        The InstallDB, an existing YAML database is imported into
+        a new SQLite one.
+
+    Raises:
+        PakitError: The backend is not supported.
+    """
+    backend = config.get('pakit.idb.backend')
+    if backend not in IDB_FILES:
+        raise PakitError('Unsupported InstallDB backend: ' + str(backend))
+
+    prefix = config.path_to('prefix')
+    if backend == 'yaml':
+        return InstallDB(os.path.join(prefix, IDB_FILES['yaml']))
+
+    idb = SqliteInstallDB(os.path.join(prefix, IDB_FILES['sqlite']))
+    idb.migrate(os.path.join(prefix, IDB_FILES['yaml']))
+    return idb
+
+
 class RecipeURIDB(YamlDict):
     """
     Store information on configured recipe uris and the paths to index them.
@@ -0,0 +1,378 @@
+"""
+A long running pakit server, pakitd, and the client pakit uses to reach it.
+
+The server keeps the Config, RecipeDB and InstallDB loaded between
+commands. Before each command it picks up changes to the config file,
+the InstallDB and the recipe folders. Commands run one at a time in
+the order they arrive, the tasks share pakit's global state.
+Only read only commands are sent, builds must use the environment
+of the client.
+
+Messages are lines of JSON over a Unix socket.
+The client sends: {"argv": ARGV, "conf": CONF, "cwd": CWD}
+The server answers with {"out": TEXT} lines, then {"exit": CODE}.
+A server loaded with another config answers {"refused": CONF} instead.
+
+PakitServer: The server holding pakit's state.
+forward: Run a command on the server if one is running.
+main: The entry point of pakitd.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+
+try:
+    import socketserver
+except ImportError:  # pragma: no cover
+    import SocketServer as socketserver
+
+import pakit.conf
+import pakit.main
+from pakit import lazy_import
+from pakit.exc import PakitError, PakitDBError
+
+# Only the server needs recipes, forward must stay cheap
+lazy_import('pakit.recipe')
+
+PLOG = logging.getLogger('pakit').info
+
+
+def socket_path():
+    """
+    The socket pakitd listens on, $PAKITD_SOCKET overrides the default.
+    """
+    return os.environ.get('PAKITD_SOCKET',
+                          os.path.expanduser('~/.pakit/pakitd.sock'))
+
+
+def mtime(path):
+    """
+    The modification time of path, None if it does not exist.
+    """
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class MessageWriter(object):
+    """
+    A file like object that sends everything written to the client.
+    Output is dropped once the client goes away, the command carries on.
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.closed = False
+
+    def send(self, **msg):
+        """
+        Send one message to the client.
+        """
+        if self.closed:
+            return
+        try:
+            self.wfile.write((json.dumps(msg) + '\n').encode('utf-8'))
+            self.wfile.flush()
+        except (IOError, OSError, socket.error):
+            self.closed = True
+
+    def write(self, text):
+        if text:
+            self.send(out=text)
+
+    def flush(self):
+        pass
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """
+    Handle one connection, it carries a single command.
+    """
+    def handle(self):
+        out = MessageWriter(self.wfile)
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            out.send(exit=2)
+            return
+
+        if os.path.realpath(request.get('conf', '')) != self.server.conf:
+            out.send(refused=self.server.conf)
+            return
+
+        out.send(exit=self.server.run(request, out))
+
+
+class PakitServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves pakit commands over a Unix socket.
+
+    Attributes:
+        conf: The config file the server loaded.
+        lock: Held while a command runs.
+        manager: The RecipeManager of the recipe folders.
+        paths: The recipe folders indexed.
+        stamps: The mtimes of the files and folders when last loaded,
+            the InstallDB.stamp() for the InstallDB.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, conf):
+        self.conf = os.path.realpath(conf)
+        self.lock = threading.Lock()
+        self.manager = None
+        self.paths = []
+        self.stamps = {}
+        self.load()
+        socketserver.UnixStreamServer.__init__(self, path, CommandHandler)
+        os.chmod(path, 0o600)
+
+    def load(self):
+        """
+        Load everything from scratch, like a new pakit command would.
+        """
+        config = pakit.main.global_init(self.conf)
+        self.manager = pakit.recipe.RecipeManager(config)
+        self.paths = self.manager.paths
+        self.stamps = dict([(path, mtime(path)) for path in self.paths])
+        self.stamps[self.conf] = mtime(self.conf)
+        self.stamps[self.manager.uri_db.filename] = mtime(
+            self.manager.uri_db.filename)
+        self.stamps[pakit.conf.IDB.filename] = pakit.conf.IDB.stamp()
+
+    def refresh(self):
+        """
+        Pick up changes made since the last command.
+
+        A changed config reloads everything and a changed recipe folder
+        indexes all recipes again. Recipes edited in place are indexed
+        again one at a time. Stale recipe sources are updated in the
+        background like any pakit command would.
+        """
+        if mtime(self.conf) != self.stamps[self.conf]:
+            logging.debug('pakitd: Config changed, reloading')
+            self.load()
+            return
+
+        uri_db = self.manager.uri_db
+        if mtime(uri_db.filename) != self.stamps[uri_db.filename]:
+            uri_db.read()
+            self.stamps[uri_db.filename] = mtime(uri_db.filename)
+        self.manager.refresh_in_background(self.conf)
+
+        idb = pakit.conf.IDB
+        if idb.stamp() != self.stamps[idb.filename]:
+            idb.read()
+            self.stamps[idb.filename] = idb.stamp()
+
+        if [path for path in self.paths
+                if mtime(path) != self.stamps[path]]:
+            logging.debug('pakitd: Recipes added or removed, indexing')
+            recipe_db = pakit.recipe.RecipeDB(pakit.conf.CONFIG)
+            for path in self.paths:
+                recipe_db.index(path)
+                self.stamps[path] = mtime(path)
+            pakit.recipe.RDB = recipe_db
+            return
+
+        recipe_db = pakit.recipe.RDB
+        for name in [name for name in recipe_db.files
+                     if recipe_db.changed(name)]:
+            recipe_db.index(os.path.dirname(recipe_db.files[name][0]), [name])
+
+    def run(self, request, out):
+        """
+        Run the command of a client, with all output sent to it.
+
+        Args:
+            request: The decoded request of the client.
+            out: The MessageWriter for the client.
+
+        Returns:
+            The exit code of the command.
+        """
+        with self.lock:
+            old_out, old_err, old_cwd = sys.stdout, sys.stderr, os.getcwd()
+            sys.stdout = sys.stderr = out
+            try:
+                os.chdir(request.get('cwd', old_cwd))
+                self.refresh()
+                set_log_streams(out)
+                return self.run_command(request['argv'])
+            finally:
+                set_log_streams(old_err)
+                sys.stdout, sys.stderr = old_out, old_err
+                os.chdir(old_cwd)
+                idb = pakit.conf.IDB
+                self.stamps[idb.filename] = idb.stamp()
+
+    def run_command(self, argv):
+        """
+        Parse and run argv as pakit.main.main would.
+
+        Returns:
+            The exit code of the command.
+        """
+        try:
+            args = pakit.main.create_args_parser().parse_args(argv[1:])
+            args.conf = self.conf
+            pakit.main.run_tasks(args)
+        except SystemExit as exc:
+            return exc.code or 0
+        except PakitDBError as exc:
+            PLOG(str(exc))
+        except PakitError as exc:
+            logging.error(exc)
+            return 1
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('pakitd: Command failed: %s', argv)
+            return 1
+
+        return 0
+
+
+def set_log_streams(stream):
+    """
+    Point the console handlers of the root and pakit loggers at stream.
+    """
+    for logger in (logging.getLogger(), logging.getLogger('pakit')):
+        for handler in logger.handlers:
+            if type(handler) is logging.StreamHandler:
+                handler.stream = stream
+
+
+def connect(path):
+    """
+    Connect to the server at path.
+
+    Returns:
+        The connected socket, None if no server is listening.
+    """
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    return sock
+
+
+def forward(argv, conf, path=None):
+    """
+    Run a command on pakitd and print its output.
+
+    Args:
+        argv: The program arguments, like sys.argv.
+        conf: The config file the command should use.
+        path: The socket of the server, default socket_path().
+
+    Returns:
+        The exit code of the command.
+        None if no server accepted it, the caller should run it.
+    """
+    sock = connect(path or socket_path())
+    if sock is None:
+        return None
+
+    try:
+        request = {
+            'argv': list(argv),
+            'conf': os.path.realpath(conf),
+            'cwd': os.getcwd(),
+        }
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        for line in sock.makefile('rb'):
+            msg = json.loads(line.decode('utf-8'))
+            if 'out' in msg:
+                sys.stdout.write(msg['out'])
+                sys.stdout.flush()
+            elif 'exit' in msg:
+                return msg['exit']
+            else:
+                logging.debug('pakitd: Refused, serving %s', msg['refused'])
+                return None
+    except socket.error as exc:
+        logging.error('pakitd: Lost connection: %s', exc)
+    finally:
+        sock.close()
+
+    logging.error('pakitd: Connection closed before the command finished.')
+    return 1
+
+
+def serve(conf, path):
+    """
+    Serve pakit commands on the socket at path until interrupted.
+
+    Args:
+        conf: The config file to load.
+        path: Where to make the socket.
+    """
+    sock = connect(path)
+    if sock is not None:
+        sock.close()
+        logging.error('pakitd: Already running on %s', path)
+        sys.exit(1)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+
+    server = PakitServer(path, conf)
+    PLOG('pakitd: Serving on %s', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def main(argv=None):
+    """
+    The entry point of pakitd.
+
+    Args:
+        argv: A list of program options, if None use sys.argv.
+    """
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        prog='pakitd', description='Keep pakit loaded and serve pakit '
+        'commands over a Unix socket. While running, pakit sends every '
+        'command using the same config to it.')
+    parser.add_argument('-c', '--conf', help='the yaml config file to use')
+    parser.add_argument('-s', '--socket', default=socket_path(),
+                        help='the socket to listen on, default '
+                        '$PAKITD_SOCKET or ~/.pakit/pakitd.sock')
+    args = parser.parse_args(argv[1:])
+    if not args.conf:
+        args.conf = pakit.main.search_for_config(
+            os.path.expanduser('~/.pakit.yml'))
+
+    # Exit through serve's cleanup, removing the socket
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    serve(args.conf, args.socket)
+
+
+if __name__ == '__main__':
+    main()  # pragma: no cover
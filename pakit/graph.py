@@ -1,24 +1,31 @@
 """
 Implements graph logic for dependencies between Recipes.
 
-DiGraph: A directed graph with adjacency lists.
+DiGraph: A directed graph with adjacency sets.
 topological_sort: Order vertices to meet edge dependencies.
 """
 from __future__ import absolute_import
+from collections import deque
 
 from pakit.exc import CycleInGraphError
 
 
 class DiGraph(object):
     """
-    Repesents a directed graph with adjacency lists.
+    Repesents a directed graph with adjacency sets.
+
+    Every edge is also kept in a reverse index, so removing a vertex
+    only touches the vertices it shares an edge with.
 
     Attributes:
         adj_lists: Dictionary that maps vertex name onto adjacent vertices
-                  stored in a list.
+                  stored in a set.
+        rev_lists: Dictionary that maps vertex name onto the vertices
+                  with an edge to it, stored in a set.
     """
     def __init__(self):
         self.adj_lists = {}
+        self.rev_lists = {}
 
     def __str__(self):
         msg = ['There are ' + str(self.size) + ' vertices.']
@@ -51,7 +58,8 @@ class DiGraph(object):
             key: The vertex name.
             depends_on: A vertex name key depends on.
         """
-        self.adj_lists[key].append(depends_on)
+        self.adj_lists[key].add(depends_on)
+        self.rev_lists.setdefault(depends_on, set()).add(key)
 
     def add_edges(self, key, depends_on_all):
         """
@@ -61,13 +69,17 @@ class DiGraph(object):
             key: The vertex name.
             depends_on: A list of vertex names key depends on.
         """
-        self.adj_lists[key].extend(depends_on_all)
+        for depends_on in depends_on_all:
+            self.add_edge(key, depends_on)
 
     def add_vertex(self, key):
         """
-        Add a vertex to the graph.
+        Add a vertex to the graph, any edges from it are reset.
         """
-        self.adj_lists[key] = []
+        for depends_on in self.adj_lists.get(key, ()):
+            self.rev_lists[depends_on].discard(key)
+        self.adj_lists[key] = set()
+        self.rev_lists.setdefault(key, set())
 
     def is_connected(self, start, end):
         """
@@ -78,37 +90,83 @@ class DiGraph(object):
     def remove(self, key):
         """
         Remove a vertex from the graph.
-        Delete it from all adjacency lists as well.
+        Delete it from all adjacency sets as well.
+        """
+        for depends_on in self.adj_lists.pop(key, ()):
+            self.rev_lists[depends_on].discard(key)
+        for dependent in self.rev_lists.pop(key, ()):
+            self.adj_lists[dependent].discard(key)
+
+    def find_cycle(self):
         """
-        try:
-            del self.adj_lists[key]
-        except KeyError:
-            pass
-        for adj_list in self.adj_lists.values():
-            while adj_list.count(key):
-                adj_list.remove(key)
+        Find a cycle with a depth first search.
+
+        Returns:
+            A list of vertex names that starts and ends on the same
+            vertex, each having an edge to the next one.
+            Empty if the graph has no cycle.
+        """
+        done = set()
+        for start in sorted(self.adj_lists):
+            if start in done:
+                continue
+
+            path = [start]
+            on_path = set(path)
+            stack = [iter(sorted(self.adj_lists[start]))]
+            while stack:
+                for adjacent in stack[-1]:
+                    if adjacent in on_path:
+                        return path[path.index(adjacent):] + [adjacent]
+                    if adjacent not in done and adjacent in self.adj_lists:
+                        path.append(adjacent)
+                        on_path.add(adjacent)
+                        stack.append(iter(sorted(self.adj_lists[adjacent])))
+                        break
+                else:
+                    stack.pop()
+                    done.add(path[-1])
+                    on_path.discard(path.pop())
+
+        return []
 
 
 def topological_sort(graph):
     """
-    Generate a topological sort of a graph.
+    Generate a topological sort of a graph with Kahn's algorithm,
+    in O(V + E log E) time.
     Side Effect: Empties the graph.
 
+    Vertices with no requirements come in the order they were added,
+    the dependents freed by each vertex in sorted order. The result
+    never depends on the hashing of the sets.
+
     Returns:
         A node in the graph with requirements satisfied.
 
     Raises:
-        CycleInGraphError: The directed graph has a cycle.
+        CycleInGraphError: The directed graph has a cycle, or an edge
+            to a vertex that is not in the graph.
     """
-    last_len = graph.size
-
-    while graph.size:
-        for key in graph.adj_lists:
-            if graph.adj_lists[key] == []:
-                graph.remove(key)
-                yield key
-                break
-
-        if last_len == graph.size:
-            raise CycleInGraphError(str(graph))
-        last_len = graph.size
+    ready = deque([key for key in graph.adj_lists
+                   if not graph.adj_lists[key]])
+
+    while ready:
+        key = ready.popleft()
+        dependents = sorted(graph.rev_lists.get(key, ()))
+        graph.remove(key)
+        yield key
+
+        for dependent in dependents:
+            if dependent in graph and not graph.adj_lists[dependent]:
+                ready.append(dependent)
+
+    if graph.size:
+        cycle = graph.find_cycle()
+        if cycle:
+            msg = 'Cycle in dependencies: ' + ' -> '.join(cycle)
+        else:
+            missing = sorted(set([dep for deps in graph.adj_lists.values()
+                                  for dep in deps if dep not in graph]))
+            msg = 'Missing dependencies: ' + ', '.join(missing)
+        raise CycleInGraphError(msg)
@@ -6,25 +6,31 @@ Acts as an intermediary between program arguments and pakit Tasks.
 from __future__ import absolute_import, print_function
 import argparse
 from argparse import RawDescriptionHelpFormatter as RawDescriptionHelp
+import json
 import logging
-import logging.handlers
 import os
 import sys
+import tempfile
+import time
 
 import pakit.conf
-import pakit.recipe
-import pakit.shell
-from pakit import __version__
-from pakit.conf import Config, InstallDB
+from pakit import __version__, lazy_import
+from pakit.conf import Config, open_idb
 from pakit.exc import PakitError, PakitDBError
 from pakit.graph import DiGraph, topological_sort
-from pakit.task import (
-    InstallTask, RemoveTask, UpdateTask, ListInstalled, ListAvailable,
-    DisplayTask, RelinkRecipes, SearchTask, CreateConfig, PurgeTask
-)
 
+# Loaded on first use, commands sent to pakitd never need them
+lazy_import('logging.handlers')
+lazy_import('pakit.daemon')
+lazy_import('pakit.recipe')
+lazy_import('pakit.shell')
+lazy_import('pakit.task')
 
+
+CONFIG_NAMES = ['.pakit.yml', '.pakit.yaml', 'pakit.yml', 'pakit.yaml']
 PLOG = logging.getLogger('pakit').info
+SEARCH_CACHE_MAX = 1024
+SEARCH_CACHE_RACY = 2
 
 
 def create_args_parser():
@@ -76,14 +82,18 @@ def create_args_parser():
                      help='one or more RECIPE(s) to install')
     sub.set_defaults(func=parse_install)
 
-    sub = subs.add_parser('remove', description='Remove specified RECIPE(s).')
+    sub = subs.add_parser('remove', description='Remove specified RECIPE(s).'
+                          ' Refuses if installed recipes require them.')
     sub.add_argument('recipes', nargs='+', metavar='RECIPE',
                      help='one or more RECIPE(s) to remove')
+    sub.add_argument('--cascade', default=False, action='store_true',
+                     help='also remove installed recipes requiring them')
     sub.set_defaults(func=parse_remove)
 
     sub = subs.add_parser('update',
                           description='Update all recipes installed. '
-                          'Alternatively, just specified RECIPE(s)')
+                          'Alternatively, just specified RECIPE(s) and '
+                          'the installed recipes requiring them.')
     sub.add_argument('recipes', nargs='*', default=(), metavar='RECIPE',
                      help='zero or more RECIPE(s) to update')
     sub.set_defaults(func=parse_update)
@@ -108,6 +118,7 @@ def create_args_parser():
 
     desc = """Search for WORD(s) in the recipe database.
     The matches for each WORD will be ORed together.
+    Recipes matching in their name are listed first.
 
     Default options:
     - Substring match
@@ -122,8 +133,19 @@ def create_args_parser():
     sub.add_argument('--names', default=False, action='store_true',
                      help='only search against recipe name,'
                      ' default name and description')
+    sub.add_argument('--all', default=False, action='store_true',
+                     help='match every WORD, default any WORD')
+    sub.add_argument('--regex', default=False, action='store_true',
+                     help='treat each WORD as a regular expression')
     sub.set_defaults(func=parse_search)
 
+    sub = subs.add_parser('rdeps',
+                          description='List installed recipes that require '
+                          'RECIPE, directly or through other recipes.')
+    sub.add_argument('recipe', metavar='RECIPE',
+                     help='the RECIPE to query')
+    sub.set_defaults(func=parse_rdeps)
+
     sub = subs.add_parser('relink',
                           description='Relink all installed RECIPE(s).'
                           '\nAlternatively, relink specified RECIPE(s).',
@@ -136,6 +158,25 @@ def create_args_parser():
                           description='(Over)write the selected pakit config.')
     sub.set_defaults(func=parse_create_conf)
 
+    sub = subs.add_parser('config',
+                          description='Show the selected pakit config.')
+    sub.add_argument('--which', default=False, action='store_true',
+                     help='only print the path of the config file')
+    sub.set_defaults(func=parse_config)
+
+    desc = """Delete what pakit no longer needs, see pakit.gc in the config.
+
+    Will delete ...
+    - old versions of installed recipes beyond pakit.gc.keep.
+    - source trees, leftover and temporary files older than
+      pakit.gc.max_age.
+    - the oldest source trees, until under pakit.gc.max_source."""
+    sub = subs.add_parser('gc', description=desc,
+                          formatter_class=RawDescriptionHelp)
+    sub.add_argument('--dry-run', default=False, action='store_true',
+                     help='only list what would be deleted')
+    sub.set_defaults(func=parse_gc)
+
     desc = """Remove most traces of pakit. No undo!
 
     Will delete ...
@@ -171,7 +212,8 @@ def global_init(config_file):
     Must be called before using pakit. Will ...
         - Read user configuration.
         - Initialize the logging system.
-        - Populate the recipe database.
+        - Populate the recipe database, recipes load on first use.
+        - Refresh stale recipe sources in the background.
         - Create configured folders.
         - Setup pakit man page.
 
@@ -193,18 +235,14 @@ def global_init(config_file):
         except OSError:
             pass
 
-    prefix = config.path_to('prefix')
-    pakit.conf.IDB = InstallDB(os.path.join(prefix, 'idb.yml'))
+    pakit.conf.IDB = open_idb(config)
     logging.debug('InstallDB: %s', pakit.conf.IDB)
 
     manager = pakit.recipe.RecipeManager(config)
     manager.check_for_deletions()
-    manager.check_for_updates()
     manager.init_new_uris()
-    recipe_db = pakit.recipe.RecipeDB(config)
-    for path in manager.paths:
-        recipe_db.index(path)
-    pakit.recipe.RDB = recipe_db
+    pakit.recipe.RDB = pakit.recipe.RecipeDB(config, manager.paths)
+    manager.refresh_in_background(config.filename)
 
     pakit.shell.link_man_pages(config.path_to('link'))
     environment_check(config)
@@ -212,6 +250,33 @@ def global_init(config_file):
     return config
 
 
+def refresh_recipes(config_file):
+    """
+    Update the stale recipe sources of a config.
+    Run in the process started by RecipeManager.refresh_in_background,
+    does nothing if another process holds the lock.
+
+    Args:
+        config_file: The YAML configuration filename.
+    """
+    config = Config(config_file)
+    pakit.conf.CONFIG = config
+    log_init(config)
+
+    manager = pakit.recipe.RecipeManager(config)
+    lock = pakit.shell.try_lock(manager.lock_file)
+    if lock is None:
+        return
+
+    try:
+        manager.uri_db.read()
+        manager.check_for_updates()
+    except Exception:  # pylint: disable=broad-except
+        logging.exception('Background recipe refresh failed.')
+    finally:
+        lock.close()
+
+
 def log_init(config):
     """
     Setup project wide logging.
@@ -259,85 +324,116 @@ def log_init(config):
     pak.addHandler(pak_stream)
 
 
-def add_deps_for(recipe_name, graph):
+def order_tasks(recipe_names, task_class):
     """
-    Recursively add a recipe_name and all reqirements to the graph.
-
-    NOTE: Cycles may be present in the graph when recursion terminates.
-    Even so, this function will NOT recurse endlessly.
+    Order the recipes so that all dependencies can be met.
+    Every recipe added as a requirement is logged with the recipes
+    that require it.
 
     Args:
-        graph: A directed graph.
-        recipe_name: A recipe in RecipeDB.
+        recipe_names: List of recipe names.
+        task_class: The Task to be carried out on the recipes.
+
+    Returns:
+        A list of task_class instances ordered to meet dependencies.
 
     Raises:
         PakitDBError: No matching recipe in RecipeDB.
-        CycleInGraphError: A cycle was detected in the recursion.
+        CycleInGraphError: The dependencies could not be resolved
+        as there was a cycle in the dependency graph.
     """
-    if recipe_name in graph:
-        return
+    graph = pakit.recipe.RDB.resolve(recipe_names)
+    for recipe_name in sorted(set(graph.adj_lists).difference(recipe_names)):
+        PLOG('Including %s, required by: %s', recipe_name,
+             ', '.join(sorted(graph.rev_lists[recipe_name])))
+
+    return [task_class(recipe_name) for recipe_name in topological_sort(graph)]
 
-    recipe = pakit.recipe.RDB.get(recipe_name)
-    graph.add_vertex(recipe_name)
 
-    requires = getattr(recipe, 'requires', [])
-    graph.add_edges(recipe_name, requires)
-    for requirement in requires:
-        add_deps_for(requirement, graph)
+def index_requires():
+    """
+    Record the requirements of installed recipes in the InstallDB.
+    Entries written before they were recorded get them from the RecipeDB.
+    """
+    missing = [name for name in pakit.conf.IDB
+               if pakit.conf.IDB[name] and
+               'requires' not in pakit.conf.IDB[name]]
+    for name in missing:
+        requires = []
+        if name in pakit.recipe.RDB:
+            recipe = pakit.recipe.RDB.get(name)
+            requires = list(getattr(recipe, 'requires', []))
+        entry = dict(pakit.conf.IDB[name])
+        entry['requires'] = requires
+        pakit.conf.IDB[name] = entry
 
+    if missing:
+        pakit.conf.IDB.write()
 
-def order_tasks(recipe_names, task_class):
+
+def order_removal(recipe_names):
     """
-    Order the recipes so that all dependencies can be met.
+    Order installed recipes so none is removed before those requiring it.
 
     Args:
         recipe_names: List of recipe names.
-        task_class: The Task to be carried out on the recipes.
 
     Returns:
-        A list of task_class instances ordered to meet dependencies.
-
-    Raises:
-        CycleInGraphError: The dependencies could not be resolved
-        as there was a cycle in the dependency graph.
+        A list of RemoveTask instances.
     """
     graph = DiGraph()
-
     for recipe_name in recipe_names:
-        add_deps_for(recipe_name, graph)
+        graph.add_vertex(recipe_name)
+    for recipe_name in recipe_names:
+        entry = pakit.conf.IDB.get(recipe_name) or {}
+        graph.add_edges(recipe_name, [req for req in entry.get('requires', [])
+                                      if req in graph])
 
-    return [task_class(recipe_name) for recipe_name in topological_sort(graph)]
+    order = list(topological_sort(graph))
+    return [pakit.task.RemoveTask(recipe_name)
+            for recipe_name in reversed(order)]
 
 
 def parse_install(args):
     """
     Parse args for InstallTask(s).
     """
-    return order_tasks(args.recipes, InstallTask)
+    return order_tasks(args.recipes, pakit.task.InstallTask)
 
 
 def parse_remove(args):
     """
     Parse args for RemoveTask(s).
-    """
-    return [RemoveTask(recipe) for recipe in args.recipes]
+    Exits with 1 when installed recipes still require them and
+    --cascade was not given.
+    """
+    index_requires()
+    dependents = pakit.conf.IDB.rdeps(args.recipes)
+    if dependents and not args.cascade:
+        PLOG('Required by installed recipe(s): ' + ', '.join(dependents))
+        PLOG('Nothing removed, use --cascade to remove them too.')
+        sys.exit(1)
+
+    return order_removal(list(args.recipes) + dependents)
 
 
 def parse_update(args):
     """
     Parse args for UpdateTask(s).
     """
+    index_requires()
     tasks = None
     if len(args.recipes) == 0:
         to_update = [recipe for recipe in pakit.conf.IDB]
-        tasks = order_tasks(to_update, UpdateTask)
+        tasks = order_tasks(to_update, pakit.task.UpdateTask)
     else:
         to_update = [recipe for recipe in args.recipes
                      if recipe in pakit.conf.IDB]
         not_installed = sorted(set(args.recipes).difference(to_update))
         if len(not_installed):
             PLOG('Recipe(s) not installed: ' + ', '.join(not_installed))
-        tasks = order_tasks(to_update, UpdateTask)
+        to_update += pakit.conf.IDB.rdeps(to_update)
+        tasks = order_tasks(to_update, pakit.task.UpdateTask)
 
     if len(tasks) == 0:
         PLOG('Nothing to update.')
@@ -348,55 +444,127 @@ def parse_display(args):
     """
     Parse args for DisplayTasks.
     """
-    return [DisplayTask(prog) for prog in args.recipes]
+    return [pakit.task.DisplayTask(prog) for prog in args.recipes]
 
 
 def parse_available(args):
     """
     Parse args for ListAvailable task.
     """
-    return [ListAvailable(args.short)]
+    return [pakit.task.ListAvailable(args.short)]
 
 
 def parse_list(args):
     """
     Parse args for ListInstalled task.
     """
-    return [ListInstalled(args.short)]
+    return [pakit.task.ListInstalled(args.short)]
 
 
-def parse_relink(_):
+def parse_rdeps(args):
+    """
+    Parse args for ListDependents task.
+    """
+    index_requires()
+    return [pakit.task.ListDependents(args.recipe)]
+
+
+def parse_relink(args):
     """
     Parse args for RelinkRecipes task.
     """
-    return [RelinkRecipes()]
+    return [pakit.task.RelinkRecipes(args.recipes)]
 
 
 def parse_search(args):
     """
     Parse args for DisplayTask(s).
     """
-    return [SearchTask(args)]
+    return [pakit.task.SearchTask(args)]
 
 
 def parse_create_conf(args):
     """
     Parse args for CreateConfig
     """
-    return [CreateConfig(args.conf)]
+    return [pakit.task.CreateConfig(args.conf)]
+
+
+def parse_config(args):
+    """
+    Print the selected config, the filename only with --which.
+    Runs without global_init, nothing else is loaded.
+    """
+    if args.which:
+        print(args.conf)
+    else:
+        print(Config(args.conf))
+    return []
+
+
+def parse_gc(args):
+    """
+    Parse args for GCTask.
+    """
+    return [pakit.task.GCTask(args.dry_run)]
 
 
 def parse_purge(_):
     """
     Parse args for PurgeTask
     """
-    return [PurgeTask()]
+    return [pakit.task.PurgeTask()]
+
+
+def search_cache_file():
+    """
+    The file caching the folders searched by search_for_config,
+    in $XDG_CACHE_HOME, default $HOME/.cache.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'pakit', 'config_search.json')
+
+
+def read_search_cache(cache_file):
+    """
+    Read the search cache, empty if missing or unreadable.
+
+    Returns:
+        A dict mapping folders onto [mtime, config file or None].
+    """
+    try:
+        with open(cache_file) as fin:
+            cache = json.load(fin)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_search_cache(cache_file, cache):
+    """
+    Replace the search cache atomically, failures are ignored.
+    """
+    try:
+        try:
+            os.makedirs(os.path.dirname(cache_file))
+        except OSError:
+            pass
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(cache, fout)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as exc:
+        logging.debug('Failed to write search cache: %s', exc)
 
 
 def search_for_config(default_config=None):
     """
     Search for the most relevant configuration file.
 
+    If $PAKIT_CONFIG is set, return it without searching.
+
     Will search from current dir upwards until root for config files matching:
         - .pakit.yml
         - .pakit.yaml
@@ -407,6 +575,10 @@ def search_for_config(default_config=None):
 
     If still nothing found, return default_config.
 
+    What each folder holds is cached, see search_cache_file.
+    A folder is only searched again once its mtime changes,
+    otherwise it costs a single stat.
+
     Args:
         default_config: The default config if nothing else present.
 
@@ -414,6 +586,10 @@ def search_for_config(default_config=None):
         If a path existed, return found filename.
         If no paths matched an existing file return the default_config.
     """
+    env_config = os.environ.get('PAKIT_CONFIG')
+    if env_config:
+        return env_config
+
     folders = [os.getcwd()]
     cur_dir = os.path.dirname(os.getcwd())
     while cur_dir != '/':
@@ -422,13 +598,68 @@ def search_for_config(default_config=None):
     folders.append(os.path.expanduser('~'))
     folders.append(os.path.expanduser('~/.pakit'))
 
+    cache_file = search_cache_file()
+    cache = read_search_cache(cache_file)
+    changed = False
+    found = default_config
     for folder in folders:
-        for conf in ['.pakit.yml', '.pakit.yaml', 'pakit.yml', 'pakit.yaml']:
-            config_file = os.path.join(folder, conf)
-            if os.path.exists(config_file):
-                return config_file
+        try:
+            stamp = os.stat(folder).st_mtime
+        except OSError:
+            continue
+
+        entry = cache.get(folder)
+        if entry is None or entry[0] != stamp:
+            entry = [stamp, None]
+            for conf in CONFIG_NAMES:
+                config_file = os.path.join(folder, conf)
+                if os.path.exists(config_file):
+                    entry[1] = config_file
+                    break
+            # Entries may be changed again within the mtime resolution
+            if time.time() - stamp > SEARCH_CACHE_RACY:
+                cache[folder] = entry
+                changed = True
+
+        if entry[1] is not None:
+            found = entry[1]
+            break
+
+    if changed:
+        if len(cache) > SEARCH_CACHE_MAX:
+            cache = dict([(folder, cache[folder]) for folder in folders
+                          if folder in cache])
+        write_search_cache(cache_file, cache)
+
+    return found
 
-    return default_config
+
+def run_tasks(args):
+    """
+    Run the tasks selected by the program arguments.
+    Must be called after global_init.
+
+    Each task changes the InstallDB in its own transaction, written
+    once when the task is done. A failed task leaves it as it was
+    before the task, the tasks before it stay recorded as they stay
+    on disk.
+
+    Args:
+        args: The parsed program arguments.
+    """
+    logging.debug('CLI: %s', args)
+
+    tasks = args.func(args)
+    for task in tasks:
+        PLOG('Running: %s', str(task))
+        with pakit.conf.IDB.transaction():
+            task.run()
+
+    changed = [task for task in tasks if isinstance(
+        task, (pakit.task.InstallTask, pakit.task.RemoveTask,
+               pakit.task.UpdateTask))]
+    if changed and pakit.conf.CONFIG.get('pakit.gc.auto'):
+        pakit.task.GCTask(background=True).run()
 
 
 def main(argv=None):
@@ -452,12 +683,22 @@ def main(argv=None):
         if not args.conf:
             args.conf = search_for_config(os.path.expanduser('~/.pakit.yml'))
 
-        global_init(args.conf)
-        logging.debug('CLI: %s', args)
+        if args.func is parse_config:
+            args.func(args)
+            return
 
-        for task in args.func(args):
-            PLOG('Running: %s', str(task))
-            task.run()
+        # pakitd has its own environment and umask, only send it
+        # commands that never build or change files
+        if args.func in (parse_available, parse_display, parse_list,
+                         parse_rdeps, parse_search):
+            code = pakit.daemon.forward(argv, args.conf)
+            if code:
+                sys.exit(code)
+            elif code is not None:
+                return
+
+        global_init(args.conf)
+        run_tasks(args)
 
     except PakitDBError as exc:
         PLOG(str(exc))
@@ -5,17 +5,21 @@ DecChangeDir: Deocrate a method, it executes in a different CWD.
 DecPrePost: Execute optional pre/post methods.
 Recipe: The base class for all recipes.
 RecipeDB: The database that indexes all recipes.
+SearchIndex: Token and trigram indexes over recipe names and descriptions.
 RecipeManager: Retrieves and manages remote recipe sources.
 """
 from __future__ import absolute_import
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import functools
 import glob
 import inspect
 import logging
 import os
+import re
 import shutil
+import subprocess
 import sys
 import tempfile
 
@@ -26,11 +30,17 @@ except ImportError:
 
 from pakit.conf import RecipeURIDB
 from pakit.exc import PakitDBError, PakitError
-from pakit.shell import Command, vcs_factory
+from pakit.graph import DiGraph
+from pakit.shell import Command, try_lock, vcs_factory
 
 
 PLOG = logging.getLogger('pakit').info
 RDB = None
+REFRESH_CMD = 'import sys; import pakit.main; ' \
+    'pakit.main.refresh_recipes(sys.argv[1])'
+REFRESH_LOCK = '.refresh.lock'
+REFRESH_WORKERS = 4
+TOKEN_RE = re.compile(r'[a-z0-9]+')
 
 
 def check_package(path):
@@ -183,7 +193,8 @@ class Recipe(object):
         repo: The active source repository.
         repo_name: The name of the current repository in *repos*.
         name: The name of the recipe.
-        install_dir: Where the program will be installed to.
+        install_root: Holds one folder per installed version.
+        install_dir: Where the active version is, the `current` link.
         link_dir: Where the installation will be linked to.
         source_dir: Where the source code will be downloaded to and built.
     """
@@ -234,8 +245,10 @@ class Recipe(object):
         Users should not be using this directly.
         """
         self.opts.update(config.opts_for(self.name))
+        install_root = os.path.join(self.opts.get('prefix'), self.name)
         self.opts.update({
-            'prefix': os.path.join(self.opts.get('prefix'), self.name),
+            'install_root': install_root,
+            'prefix': os.path.join(install_root, 'current'),
             'source': os.path.join(self.opts.get('source'), self.name)
         })
         for repo in self.repos.values():
@@ -281,12 +294,40 @@ class Recipe(object):
 
         return rest
 
+    @property
+    def install_root(self):
+        """
+        The folder holding every installed version of the program.
+        """
+        return self.opts.get('install_root')
+
+    @property
+    def current_link(self):
+        """
+        The link under install_root to the active version.
+        """
+        return os.path.join(self.install_root, 'current')
+
     @property
     def install_dir(self):
         """
-        The folder the program will install to.
+        The folder the installed program is linked from, the current_link.
+        Installs made before versioned installs have no current_link,
+        the program is directly under install_root.
+        """
+        if not os.path.lexists(self.current_link) and \
+                os.path.isdir(self.install_root):
+            return self.install_root
+        return self.current_link
+
+    def version_dir(self, version):
         """
-        return self.opts.get('prefix')
+        The folder a version of the program is installed to.
+
+        Args:
+            version: The src_hash of the version.
+        """
+        return os.path.join(self.install_root, version)
 
     @property
     def link_dir(self):
@@ -408,13 +449,141 @@ class Recipe(object):
         raise NotImplementedError
 
 
+def trigrams(word):
+    """
+    The set of three character substrings in a word.
+    """
+    return set([word[ind:ind + 3] for ind in range(len(word) - 2)])
+
+
+class SearchIndex(object):
+    """
+    Indexes recipe names and descriptions for searching.
+
+    Substring queries only check the recipes holding every trigram of
+    the query, the token indexes rank name hits above description hits.
+    Everything is lowercase, case sensitive matching is left to callers.
+
+    Attributes:
+        lines: Maps recipe names onto their one line summary.
+        name_tokens: Maps a token onto the recipes with it in the name.
+        desc_tokens: Maps a token onto the recipes with it in the
+            description.
+        trigrams: Maps a trigram onto the recipes with it in the name,
+            description or summary.
+    """
+    def __init__(self, recipes):
+        """
+        Args:
+            recipes: An iterable of (name, recipe) pairs.
+        """
+        self.lines = {}
+        self.name_tokens = {}
+        self.desc_tokens = {}
+        self.trigrams = {}
+        for name, recipe in recipes:
+            self.add(name, recipe)
+
+    def add(self, name, recipe):
+        """
+        Index a recipe under name.
+        """
+        self.lines[name] = str(recipe)
+        for token in TOKEN_RE.findall(name.lower()):
+            self.name_tokens.setdefault(token, set()).add(name)
+        for token in TOKEN_RE.findall(recipe.description.lower()):
+            self.desc_tokens.setdefault(token, set()).add(name)
+        # The summary cuts long names, index the full name on its own
+        grams = trigrams(name.lower())
+        grams.update(trigrams(recipe.description.lower()))
+        grams.update(trigrams(self.lines[name].lower()))
+        for trigram in grams:
+            self.trigrams.setdefault(trigram, set()).add(name)
+
+    def candidates(self, word):
+        """
+        The recipes that may contain word as a substring of their name,
+        description or summary.
+
+        Returns:
+            A set of recipe names, a superset of the recipes matching.
+        """
+        grams = trigrams(word.lower())
+        if not grams:
+            return set(self.lines)
+
+        postings = sorted([self.trigrams.get(gram, set()) for gram in grams],
+                          key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def score(self, name, words):
+        """
+        Rank how well a recipe matches the words, higher is better.
+        A word matching the whole name beats one matching a token of it,
+        any name hit beats a description hit.
+        """
+        score = 0
+        lname = name.lower()
+        for word in words:
+            word = word.lower()
+            if word == lname:
+                score += 8
+            elif name in self.name_tokens.get(word, ()):
+                score += 4
+            elif word in lname:
+                score += 2
+            elif name in self.desc_tokens.get(word, ()):
+                score += 1
+
+        return score
+
+
 class RecipeDB(object):
     """
     An object database that can import recipes dynamically.
+
+    The transitive requirements of each recipe are cached once resolved.
+    A recipe whose file changed since it was indexed is imported again
+    and every cached closure holding it is dropped.
+
+    Attributes:
+        closures: Maps a recipe name onto a frozenset of all recipes
+            it requires, directly or not, including itself.
+        files: Maps a recipe name onto the path and mtime of its file
+            when indexed.
+        pending: The folders given to the constructor not indexed yet.
+            They are indexed on first use of the database.
+        rdb: Maps a recipe name onto its Recipe object.
     """
-    def __init__(self, config):
+    def __init__(self, config, paths=None):
+        """
+        Args:
+            config: The Config of pakit.
+            paths: Optional, folders to index on first use. Commands
+                that never look at recipes never import them.
+        """
         self.config = config
-        self.rdb = {}
+        self.closures = {}
+        self.pending = list(paths or [])
+        self._files = {}
+        self._rdb = {}
+        self._search_index = None
+
+    @property
+    def files(self):
+        """
+        The path and mtime of each recipe file, see the class.
+        """
+        self.index_pending()
+        return self._files
+
+    @property
+    def rdb(self):
+        """
+        The Recipe objects by name, see the class.
+        """
+        self.index_pending()
+        return self._rdb
 
     def __contains__(self, name):
         return name in self.rdb
@@ -435,7 +604,7 @@ class RecipeDB(object):
             raise PakitDBError('Missing recipe to build: ' + name)
         return obj
 
-    def index(self, path):
+    def index(self, path, names=None):
         """
         Index all *Recipes* in the path.
 
@@ -444,7 +613,9 @@ class RecipeDB(object):
 
         Args:
             path: The folder containing recipes to index.
+            names: Optional, only index the recipes with these names.
         """
+        self.index_pending()
         try:
             check_package(path)
             sys.path.insert(0, os.path.dirname(path))
@@ -455,15 +626,137 @@ class RecipeDB(object):
                 new_recs.remove('__init__')
             if 'setup' in new_recs:
                 new_recs.remove('setup')
+            if names is not None:
+                new_recs = [cls for cls in new_recs if cls in names]
+            self._search_index = None
 
             mod = os.path.basename(path)
             for cls in new_recs:
                 obj = self.recipe_obj(mod, cls)
-                self.rdb.update({cls: obj})
+                self._rdb.update({cls: obj})
+                self.uncache(cls)
+                fname = os.path.join(path, cls + '.py')
+                self._files[cls] = (fname, os.path.getmtime(fname))
         finally:
             if os.path.dirname(path) in sys.path:
                 sys.path.remove(os.path.dirname(path))
 
+    def index_pending(self):
+        """
+        Index the folders still pending, in the order they were given.
+        """
+        pending, self.pending = self.pending, []
+        for path in pending:
+            self.index(path)
+
+    @property
+    def search_index(self):
+        """
+        A SearchIndex of every recipe.
+        Built on first use, discarded whenever recipes are indexed.
+        """
+        if self._search_index is None:
+            self._search_index = SearchIndex(self.rdb.items())
+        return self._search_index
+
+    def uncache(self, name):
+        """
+        Drop every cached closure that holds the recipe name.
+        """
+        self.closures = dict([(key, closure) for key, closure
+                              in self.closures.items() if name not in closure])
+
+    def changed(self, name):
+        """
+        True iff the file of the recipe changed since it was indexed.
+        """
+        if name not in self.files:
+            return False
+
+        fname, mtime = self.files[name]
+        try:
+            return os.path.getmtime(fname) != mtime
+        except OSError:
+            return True
+
+    def requires(self, name):
+        """
+        The recipes that name requires directly.
+        Indexes the recipe again if its file changed.
+
+        Returns:
+            A list of recipe names.
+
+        Raises:
+            PakitDBError: Could not resolve the name to a recipe.
+        """
+        if self.changed(name) and os.path.exists(self.files[name][0]):
+            self.index(os.path.dirname(self.files[name][0]), [name])
+        return list(getattr(self.get(name), 'requires', []))
+
+    def closure(self, name):
+        """
+        Find all recipes that name requires, directly or not.
+        Closures already cached are reused for the requirements.
+
+        Returns:
+            A frozenset of recipe names, including name.
+
+        Raises:
+            PakitDBError: Could not resolve a name to a recipe.
+        """
+        cached = self.closures.get(name)
+        if cached is not None and not any(self.changed(req)
+                                          for req in cached):
+            return cached
+
+        found = set([name])
+        stack = [name]
+        while stack:
+            cur = stack.pop()
+            cached = self.closures.get(cur)
+            if cur != name and cached is not None and \
+                    not any(self.changed(req) for req in cached):
+                found.update(cached)
+                continue
+
+            for req in self.requires(cur):
+                if req not in found:
+                    found.add(req)
+                    stack.append(req)
+
+        self.closures[name] = frozenset(found)
+        return self.closures[name]
+
+    def resolve(self, names):
+        """
+        Resolve the requirements of many recipes at once.
+
+        The rev_lists of the graph explain why a recipe is included,
+        they map it onto the recipes requiring it.
+
+        Args:
+            names: A list of recipe names.
+
+        Returns:
+            A DiGraph of names and all recipes they require.
+            Edges point from a recipe to its requirements.
+
+        Raises:
+            PakitDBError: Could not resolve a name to a recipe.
+        """
+        needed = set()
+        for name in names:
+            needed.update(self.closure(name))
+
+        graph = DiGraph()
+        for name in list(names) + sorted(needed.difference(names)):
+            graph.add_vertex(name)
+        for name in sorted(needed):
+            graph.add_edges(name, self.requires(name))
+
+        return graph
+
     def names(self, desc=False):
         """
         Names of recipes available, optionally with descriptions.
@@ -513,6 +806,21 @@ class RecipeDB(object):
         return obj
 
 
+def raise_first(errors):
+    """
+    Raise the first error of a fetch, the others are only logged.
+
+    Args:
+        errors: A dict of uri -> exception or None, see
+            RecipeManager.fetch_repos.
+    """
+    failed = [uri for uri in sorted(errors) if errors[uri] is not None]
+    for uri in failed[1:]:
+        logging.error('Failed to fetch recipes from %s: %s', uri, errors[uri])
+    if failed:
+        raise errors[failed[0]]
+
+
 class RecipeManager(object):
     """
     Manage the retrieval and updating of recipe sources remote and local.
@@ -565,29 +873,142 @@ class RecipeManager(object):
             del self.uri_db[uri]
         self.uri_db.write()
 
-    def check_for_updates(self):
+    @property
+    def lock_file(self):
         """
-        Check if any of the active URIs needs updating.
+        The lock held while refreshing the recipe uris.
+        """
+        return os.path.join(self.root, REFRESH_LOCK)
+
+    def stale_uris(self):
+        """
+        The active URIs that need updating.
 
         A recipe remote will be update if it is version controlled and ...
             - it has not been updated since interval
             - the kwargs between uri_db and active_kwargs differ
+
+        Returns:
+            A list of uris.
         """
         need_updates = self.uri_db.need_updates(self.interval)
         vcs_uris = [uri for uri in self.uri_db if self.uri_db[uri]['is_vcs']]
+        stale = []
         for uri in set(self.active_uris).intersection(vcs_uris):
             db_kwargs = self.uri_db[uri].get('kwargs', {})
-            kwargs = self.active_kwargs.get(uri, {})
-            repo = vcs_factory(uri, **kwargs)
-            repo.target = self.uri_db[uri]['path']
+            if uri in need_updates or db_kwargs != self.active_kwargs.get(
+                    uri, {}):
+                stale.append(uri)
 
-            if uri in need_updates or db_kwargs != kwargs:
-                PLOG('Updating recipes from: %s.', uri)
-                with repo:
-                    self.uri_db.update_time(uri)
-                    self.uri_db[uri]['kwargs'] = kwargs
+        return sorted(stale)
 
-        self.uri_db.write()
+    def check_for_updates(self):
+        """
+        Update all stale URIs, see stale_uris.
+        The repositories are fetched concurrently, see fetch_repos.
+        """
+        repos = {}
+        for uri in self.stale_uris():
+            repos[uri] = vcs_factory(uri, **self.active_kwargs.get(uri, {}))
+            repos[uri].target = self.uri_db[uri]['path']
+            PLOG('Updating recipes from: %s.', uri)
+
+        errors = self.fetch_repos(repos)
+        entries = {}
+        for uri in sorted(errors):
+            if errors[uri] is None:
+                self.uri_db.update_time(uri)
+                self.uri_db[uri]['kwargs'] = self.active_kwargs.get(uri, {})
+                entries[uri] = self.uri_db[uri]
+        self.write_entries(entries)
+        raise_first(errors)
+
+    def fetch_repos(self, repos):
+        """
+        Clone or update the repositories on a bounded pool of threads,
+        see REFRESH_WORKERS. Every fetch runs to completion even when
+        another one fails.
+
+        Args:
+            repos: A dict of uri -> VersionRepo, targets already set.
+
+        Returns:
+            A dict of uri -> the exception raised fetching it,
+            None if it was fetched.
+        """
+        def fetch(repo):
+            """ Clone or update one repository. """
+            with repo:
+                pass
+
+        if not repos:
+            return {}
+
+        workers = min(REFRESH_WORKERS, len(repos))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = dict([(uri, pool.submit(fetch, repos[uri]))
+                            for uri in repos])
+
+        return dict([(uri, futures[uri].exception()) for uri in futures])
+
+    def write_entries(self, entries):
+        """
+        Write the entries to the uri_db once, under a lock on it.
+        The file is read again first, entries other pakit processes
+        wrote in the mean time are kept.
+
+        Args:
+            entries: A dict of uri -> uri_db entry.
+        """
+        if not entries and os.path.exists(self.uri_db.filename):
+            return
+
+        lock = try_lock(self.uri_db.filename + '.lock', wait=True)
+        try:
+            if os.path.exists(self.uri_db.filename):
+                self.uri_db.read()
+                self.uri_db.data = self.uri_db.data or {}
+            self.uri_db.update(entries)
+            self.uri_db.write()
+        finally:
+            lock.close()
+
+    def refresh_in_background(self, config_file):
+        """
+        Update the stale URIs in a detached process, see
+        pakit.main.refresh_recipes.
+        The recipes already indexed are used until the next run.
+
+        Args:
+            config_file: The config file the process should load,
+                relative paths are made absolute before the process
+                changes to '/'.
+
+        Returns:
+            True iff a process was started. None is started when nothing
+            is stale or another process is refreshing already.
+        """
+        stale = self.stale_uris()
+        if not stale:
+            return False
+
+        lock = try_lock(self.lock_file)
+        if lock is None:
+            return False
+        lock.close()
+
+        logging.debug('Refreshing recipes in the background: %s', stale)
+        pakit_root = os.path.dirname(os.path.dirname(__file__))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [pakit_root] + [path for path in [env.get('PYTHONPATH')] if path])
+        with open(os.devnull, 'r+') as dnull:
+            subprocess.Popen([sys.executable, '-c', REFRESH_CMD,
+                              os.path.abspath(config_file)],
+                             stdin=dnull, stdout=dnull, stderr=dnull,
+                             close_fds=True, cwd='/', env=env,
+                             preexec_fn=os.setsid)
+        return True
 
     def init_new_uris(self):
         """
@@ -596,12 +1017,15 @@ class RecipeManager(object):
             - Add an entry to the uri_db
             - If the uri is local, create the folder at the path.
             - If the uri is remote, clone the version repository
-              with optional kwargs.
+              with optional kwargs. Repositories are cloned
+              concurrently, see fetch_repos.
 
         Raises:
             PakitError: User attempted to use an unsupported URI.
         """
-        for uri in set(self.active_uris).difference(self.uri_db.keys()):
+        repos, entries = {}, {}
+        new_uris = set(self.active_uris).difference(self.uri_db.keys())
+        for uri in sorted(new_uris):
             repo = None
             kwargs = self.active_kwargs.get(uri, {})
 
@@ -617,14 +1041,21 @@ class RecipeManager(object):
 
             if repo:
                 repo.target = path
+                repos[uri] = repo
                 PLOG('Downloading new recipes: %s', uri)
-                with repo:
-                    pass
             else:
+                entries[uri] = self.uri_db[uri]
                 PLOG('Indexing local recipes from: %s', path)
                 try:
                     os.makedirs(path)
                 except OSError:
                     pass
 
-        self.uri_db.write()
+        errors = self.fetch_repos(repos)
+        for uri in sorted(errors):
+            if errors[uri] is None:
+                entries[uri] = self.uri_db[uri]
+            else:
+                del self.uri_db[uri]
+        self.write_entries(entries)
+        raise_first(errors)
@@ -10,7 +10,10 @@ Hg: Used to fetch a mercurial repository.
 from __future__ import absolute_import
 from abc import ABCMeta, abstractmethod, abstractproperty
 import atexit
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
 import functools
+import heapq
 import glob
 import inspect
 import logging
@@ -18,37 +21,58 @@ import os
 import shlex
 import shutil
 import signal
+import stat
 import subprocess
 import sys
-from tempfile import NamedTemporaryFile as TempFile
+from tempfile import NamedTemporaryFile as TempFile, mkdtemp
 import threading
 import time
 
-import hashlib
-import tarfile
-# pylint: disable=import-error
-try:
-    import urllib2 as ulib
-except ImportError:  # pragma: no cover
-    import urllib.request as ulib  # pylint: disable=no-name-in-module
-# pylint: enable=import-error
-import zipfile
-
 import pakit.conf
+from pakit import lazy_import
 from pakit.exc import (
     PakitError, PakitCmdError, PakitCmdTimeout, PakitLinkError
 )
 
+# Only needed to fetch and unpack archives, loaded on first use
+hashlib = lazy_import('hashlib')
+tarfile = lazy_import('tarfile')
+ulib = lazy_import('urllib.request')
+zipfile = lazy_import('zipfile')
+zstandard = lazy_import('zstandard')
+
 EXT_FUNCS = {
     'application/x-7z-compressed': 'extract_7z',
     'application/x-rar': 'extract_rar',
-    'application/gzip': 'extract_tar_gz',
-    'application/x-gzip': 'extract_tar_gz',
-    'application/x-bzip2': 'extract_tar_gz',
-    'application/x-tar': 'extract_tar_gz',
-    'application/x-xz': 'extract_tar_xz',
+    'application/gzip': 'extract_tar',
+    'application/x-gzip': 'extract_tar',
+    'application/x-bzip2': 'extract_tar',
+    'application/x-tar': 'extract_tar',
+    'application/x-xz': 'extract_tar',
     'application/zip': 'extract_zip',
+    'application/zstd': 'extract_tar_zst',
+    'application/x-zstd': 'extract_tar_zst',
 }
+MAGIC_BYTES = [
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'\x28\xb5\x2f\xfd', 'application/zstd'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'PK\x05\x06', 'application/zip'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/x-rar'),
+    (257, b'ustar', 'application/x-tar'),
+]
+DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+SNIFF_SIZE = 512
+STAGE_PREFIX = '.pakit_stage_'
+TRASH_DIR = '.pakit_trash'
+DELETE_LOCK = threading.Lock()
+DELETE_PENDING = set()
+DELETE_POOL = None
+DELETE_WORKERS = 4
+ZIP_PARALLEL_MIN = 8 * 1024 ** 2
 
 
 @atexit.register
@@ -59,6 +83,235 @@ def cmd_cleanup():
     shutil.rmtree(pakit.conf.TMP_DIR)
 
 
+def trash_path(path, root=None):
+    """
+    Move path into a new folder under the TRASH_DIR of root.
+    It is a rename on the same filesystem, instant whatever its size.
+
+    Args:
+        path: The file or folder to throw away.
+        root: A folder above path on the same filesystem,
+            by default the folder of path.
+
+    Returns:
+        The folder in TRASH_DIR that now holds path, delete it
+        with empty_trash.
+
+    Raises:
+        OSError: The path could not be moved.
+    """
+    trash_dir = os.path.join(root or os.path.dirname(path), TRASH_DIR)
+    try:
+        os.makedirs(trash_dir)
+    except OSError:
+        pass
+    holder = mkdtemp(prefix=os.path.basename(path) + '_', dir=trash_dir)
+    try:
+        os.rename(path, os.path.join(holder, os.path.basename(path)))
+    except OSError:
+        os.rmdir(holder)
+        raise
+    return holder
+
+
+def empty_trash(paths, background=False):
+    """
+    Delete folders returned by trash_path.
+
+    Args:
+        paths: The folders to delete.
+        background: When True, deletion is queued on the DELETE_POOL
+            and this returns at once. Otherwise block until done.
+    """
+    for path in paths:
+        if background:
+            submit_delete(path)
+        else:
+            remove_quietly(path)
+
+
+def delete_later(path, root=None):
+    """
+    Throw away path without waiting for it to be deleted.
+
+    The path is renamed into the trash at once, see trash_path,
+    then deleted by a worker of the DELETE_POOL.
+    Pending deletions are finished before pakit exits.
+
+    Args:
+        path: The file or folder to delete, may be missing.
+        root: Passed on to trash_path.
+
+    Returns:
+        The Future of the deletion, None if path did not exist.
+
+    Raises:
+        OSError: The path exists but could not be moved.
+    """
+    if not os.path.lexists(path):
+        return None
+
+    try:
+        holder = trash_path(path, root)
+    except OSError:
+        if not os.path.lexists(path):
+            return None
+        raise
+
+    return submit_delete(holder)
+
+
+def submit_delete(path):
+    """
+    Queue path for deletion on the DELETE_POOL, created on first use.
+
+    Returns:
+        The Future of the deletion.
+    """
+    global DELETE_POOL  # pylint: disable=global-statement
+    with DELETE_LOCK:
+        if DELETE_POOL is None:
+            DELETE_POOL = ThreadPoolExecutor(DELETE_WORKERS)
+        DELETE_PENDING.add(path)
+        return DELETE_POOL.submit(remove_pending, path)
+
+
+def remove_pending(path):
+    """
+    Run remove_quietly on a path queued by submit_delete.
+    """
+    try:
+        remove_quietly(path)
+    finally:
+        with DELETE_LOCK:
+            DELETE_PENDING.discard(path)
+
+
+def is_deleting(path):
+    """
+    True iff path is queued on the DELETE_POOL and not yet deleted.
+    """
+    with DELETE_LOCK:
+        return path in DELETE_PENDING
+
+
+@atexit.register
+def wait_deletions():
+    """
+    Block until every deletion queued on the DELETE_POOL is done.
+    """
+    global DELETE_POOL  # pylint: disable=global-statement
+    with DELETE_LOCK:
+        pool, DELETE_POOL = DELETE_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def remove_quietly(path):
+    """
+    Run remove_tree on path, only logging errors.
+    Another deleter removing the same tree first is not an error.
+    """
+    try:
+        remove_tree(path)
+    except OSError as exc:
+        if os.path.lexists(path):
+            logging.error('Could not delete path: %s, %s', path, exc)
+
+
+def remove_tree(path):
+    """
+    Delete path and everything below it, links are never followed.
+
+    Folders are read with scandir and their entries removed relative
+    to a descriptor of the folder, like `rm -rf` without the process.
+
+    Args:
+        path: The file or folder to delete, may be missing.
+    """
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return
+
+    if not stat.S_ISDIR(path_stat.st_mode):
+        os.unlink(path)
+        return
+
+    parent_fd = os.open(os.path.dirname(os.path.abspath(path)), DIR_FLAGS)
+    try:
+        remove_tree_at(os.path.basename(path.rstrip(os.path.sep)),
+                       parent_fd)
+    finally:
+        os.close(parent_fd)
+
+
+def remove_tree_at(name, dir_fd):
+    """
+    Delete the folder name relative to dir_fd, bottom up.
+    """
+    fd = os.open(name, DIR_FLAGS | getattr(os, 'O_NOFOLLOW', 0),
+                 dir_fd=dir_fd)
+    try:
+        with os.scandir(fd) as entries:
+            entries = list(entries)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                remove_tree_at(entry.name, fd)
+            else:
+                os.unlink(entry.name, dir_fd=fd)
+    finally:
+        os.close(fd)
+
+    os.rmdir(name, dir_fd=dir_fd)
+
+
+def dir_size(path):
+    """
+    Returns:
+        The total size in bytes of the files under path.
+        Links are counted but never followed.
+    """
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+
+    return total
+
+
+def try_lock(path, wait=False):
+    """
+    Take an exclusive lock on path, creating it if needed.
+    The lock is released when the returned file is closed or the
+    process exits.
+
+    Args:
+        path: The lock file.
+        wait: If True, block until the lock is free.
+
+    Returns:
+        The open lock file, None if another process holds the lock.
+    """
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock.fileno(),
+                    fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lock.close()
+        return None
+
+    return lock
+
+
 def check_connectivity():
     """
     Returns true iff and only iff can reach github.
@@ -101,14 +354,55 @@ def wrap_extract(extract_func):
         """
         Inner part of decorator.
         """
-        tmp_dir = os.path.join(pakit.conf.TMP_DIR, os.path.basename(filename))
-        extract_func(filename, tmp_dir)
-        extracted = glob.glob(os.path.join(tmp_dir, '*'))[0]
-        shutil.move(extracted, target)
-        os.rmdir(tmp_dir)
+        stage = stage_dir(target)
+        try:
+            tmp_dir = os.path.join(stage, os.path.basename(filename))
+            extract_func(filename, tmp_dir)
+            commit_extract(tmp_dir, target)
+        finally:
+            shutil.rmtree(stage, ignore_errors=True)
     return inner
 
 
+def stage_dir(target):
+    """
+    Create a hidden temporary folder beside target to extract into.
+    Being on the same filesystem, the result can be renamed into place.
+
+    Args:
+        target: The path the source should end up at.
+
+    Returns:
+        The path of the new folder, caller must remove it.
+    """
+    parent = os.path.dirname(os.path.abspath(target))
+    try:
+        os.makedirs(parent)
+    except OSError:
+        pass
+
+    return mkdtemp(prefix=STAGE_PREFIX + os.path.basename(target) + '_',
+                   dir=parent)
+
+
+def commit_extract(tmp_dir, target):
+    """
+    Move the top level folder extracted into tmp_dir to target.
+
+    The move is a single atomic rename when target is absent or
+    an empty folder, target is never left partially filled.
+
+    Args:
+        tmp_dir: The temporary folder an archive was extracted into.
+        target: The path the source should end up at.
+    """
+    extracted = glob.glob(os.path.join(tmp_dir, '*'))[0]
+    try:
+        os.rename(extracted, target)
+    except OSError:
+        shutil.move(extracted, target)
+
+
 @wrap_extract
 def extract_7z(filename, tmp_dir):
     """
@@ -150,49 +444,248 @@ def extract_rar(filename, tmp_dir):
                             filename)
 
 
+def extract_tar_stream(fileobj, tmp_dir, comp='*'):
+    """
+    Extract a tar read sequentially from fileobj into tmp_dir.
+
+    Streaming mode never seeks, so compressed members are decompressed
+    exactly once and nothing is written besides the extracted files.
+
+    Args:
+        fileobj: Any object with a read method.
+        tmp_dir: The folder to extract into.
+        comp: The tarfile compression suffix, '*' detects gz, bz2 & xz.
+
+    Raises:
+        PakitError: A member would be written outside of tmp_dir.
+    """
+    tarf = tarfile.open(fileobj=fileobj, mode='r|' + comp)
+    try:
+        if hasattr(tarfile, 'data_filter'):
+            tarf.extractall(tmp_dir, filter='data')
+        else:  # pragma: no cover, python without extraction filters
+            for member in tarf:
+                check_tar_member(member, tmp_dir)
+                tarf.extract(member, tmp_dir)
+    except getattr(tarfile, 'FilterError', ()) as exc:
+        raise PakitError('Unsafe member in archive: ' + str(exc))
+    finally:
+        tarf.close()
+
+
+def check_tar_member(member, tmp_dir):
+    """
+    Check a tar member can be extracted without escaping tmp_dir.
+
+    Args:
+        member: The TarInfo about to be extracted.
+        tmp_dir: The folder being extracted into.
+
+    Raises:
+        PakitError: The member is absolute, has a `..` component or is
+            a link pointing outside of tmp_dir.
+    """
+    root = os.path.realpath(tmp_dir)
+
+    def inside(path):
+        """
+        True if path resolves to somewhere under root.
+        """
+        path = os.path.realpath(os.path.join(root, path))
+        return path == root or path.startswith(root + os.sep)
+
+    safe = not os.path.isabs(member.name) and \
+        '..' not in member.name.split('/') and inside(member.name)
+    if member.issym():
+        safe = safe and not os.path.isabs(member.linkname) and inside(
+            os.path.join(os.path.dirname(member.name), member.linkname))
+    elif member.islnk():
+        safe = safe and not os.path.isabs(member.linkname) and \
+            inside(member.linkname)
+
+    if not safe:
+        raise PakitError('Unsafe member in archive: ' + member.name)
+
+
 @wrap_extract
-def extract_tar_gz(filename, tmp_dir):
+def extract_tar(filename, tmp_dir):
     """
-    Extracts a tar.gz archive to a temp dir
+    Extracts a tar archive compressed with gzip, bzip2, xz or nothing.
     """
-    tarf = tarfile.open(filename)
-    tarf.extractall(tmp_dir)
+    with open(filename, 'rb') as fin:
+        extract_tar_stream(fin, tmp_dir)
 
 
 @wrap_extract
-def extract_tar_xz(filename, tmp_dir):
+def extract_tar_zst(filename, tmp_dir):
     """
-    Extracts a tar.xz archive to a temp dir
+    Extracts a tar.zst archive, with the zstandard module if available.
+    Otherwise the output of `zstd -dc` is streamed into tarfile.
     """
-    tar_file = filename.split('.')
-    tar_file = tar_file[0:-2] if 'tar' in tar_file else tar_file[0:-1]
-    tar_file = os.path.join(os.path.dirname(filename),
-                            '.'.join(tar_file + ['tar']))
+    if zstandard is not None:
+        with open(filename, 'rb') as fin:
+            reader = zstandard.ZstdDecompressor().stream_reader(fin)
+            extract_tar_stream(reader, tmp_dir, '')
+        return
+
     try:
-        os.makedirs(tmp_dir)
-    except OSError:  # pragma: no cover
-        pass
+        with open(os.devnull, 'wb') as dnull:
+            proc = subprocess.Popen(['zstd', '-dc', filename],
+                                    stdout=subprocess.PIPE, stderr=dnull)
+    except OSError:
+        raise PakitCmdError('Need `zstd` command or zstandard module '
+                            'to extract: ' + filename)
     try:
-        Command('xz --keep --decompress ' + filename).wait()
-        Command('tar -C {0} -xf {1}'.format(tmp_dir, tar_file)).wait()
-    except (OSError, PakitCmdError):
-        raise PakitCmdError('Need commands `xz` and `tar` to extract: ' +
-                            filename)
+        extract_tar_stream(proc.stdout, tmp_dir, '')
     finally:
-        os.remove(tar_file)
-        try:
-            os.rmdir(tmp_dir)
-        except OSError:
-            pass
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise PakitCmdError('Command `zstd` failed to decompress: ' +
+                            filename)
 
 
 @wrap_extract
 def extract_zip(filename, tmp_dir):
     """
     Extracts a zip archive
+
+    Members are compressed independently, so large archives are split
+    into size balanced groups and decompressed on a pool of threads.
+    zlib releases the GIL while inflating.
+    """
+    with zipfile.ZipFile(filename) as zipf:
+        members = zipf.infolist()
+
+    dirs = set([tmp_dir])
+    files = []
+    for info in members:
+        path = zip_member_path(tmp_dir, info.filename)
+        if info.filename.endswith('/'):
+            dirs.add(path)
+        else:
+            dirs.add(os.path.dirname(path))
+            files.append((info, path))
+    for path in sorted(dirs):
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+
+    workers = os.cpu_count() or 1
+    if sum(info.file_size for info, _ in files) < ZIP_PARALLEL_MIN:
+        workers = 1
+    groups = balance_by_size(files, workers, lambda item: item[0].file_size)
+
+    if len(groups) == 1:
+        write_zip_members(filename, groups[0])
+        return
+    with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+        futures = [pool.submit(write_zip_members, filename, group)
+                   for group in groups]
+        for future in futures:
+            future.result()
+
+
+def zip_member_path(tmp_dir, arcname):
+    """
+    Map a zip member name to a path under tmp_dir.
+    Like zipfile, absolute paths and '..' components are dropped.
+
+    Args:
+        tmp_dir: The folder being extracted into.
+        arcname: The name of the member inside the zip.
+
+    Returns:
+        The path to extract the member to.
+    """
+    arcname = os.path.splitdrive(arcname.replace('/', os.path.sep))[1]
+    parts = [part for part in arcname.split(os.path.sep)
+             if part not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.join(tmp_dir, *parts)
+
+
+def balance_by_size(items, num_groups, size_of):
+    """
+    Split items into at most num_groups groups of roughly equal total size.
+    Largest items are placed first, each into the lightest group.
+
+    Args:
+        items: The items to split.
+        num_groups: The maximum number of groups wanted.
+        size_of: A function returning the size of an item.
+
+    Returns:
+        A list of non empty lists of items.
     """
-    zipf = zipfile.ZipFile(filename)
-    zipf.extractall(tmp_dir)
+    num_groups = max(1, min(num_groups, len(items)))
+    groups = [[] for _ in range(num_groups)]
+    loads = [(0, num) for num in range(num_groups)]
+    for item in sorted(items, key=size_of, reverse=True):
+        load, num = heapq.heappop(loads)
+        groups[num].append(item)
+        heapq.heappush(loads, (load + size_of(item), num))
+
+    return [group for group in groups if group] or [[]]
+
+
+def write_zip_members(filename, members):
+    """
+    Decompress the given zip members to their paths.
+    Each call opens its own handle, so it is safe to run in a thread.
+
+    Args:
+        filename: The path to the zip archive.
+        members: A list of (ZipInfo, path) pairs to extract.
+    """
+    with zipfile.ZipFile(filename) as zipf:
+        for info, path in members:
+            with zipf.open(info) as fin, open(path, 'wb') as fout:
+                if info.file_size and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(fout.fileno(), 0, info.file_size)
+                    except OSError:  # pragma: no cover
+                        pass
+                shutil.copyfileobj(fin, fout, 1024 ** 2)
+
+
+def sniff_mimetype(header):
+    """
+    Determine the mimetype of an archive from the magic bytes at its start.
+
+    Args:
+        header: The first SNIFF_SIZE bytes of the archive, or all of it
+            if shorter. Works just as well on the prefix of a download.
+
+    Returns:
+        The mimetype of the archive, 'application/octet-stream'
+        when no magic bytes matched.
+    """
+    for offset, magic, mtype in MAGIC_BYTES:
+        if header[offset:offset + len(magic)] == magic:
+            return mtype
+
+    return 'application/octet-stream'
+
+
+def tar_stream_args(fileobj, mtype):
+    """
+    Select how a stream of mtype should be fed to extract_tar_stream.
+
+    Args:
+        fileobj: The readable stream of the archive.
+        mtype: The mimetype of the archive.
+
+    Returns:
+        A tuple of (fileobj, comp) arguments for extract_tar_stream.
+        None if the archive can't be extracted while streaming.
+    """
+    if EXT_FUNCS.get(mtype) == 'extract_tar':
+        return fileobj, '*'
+    elif EXT_FUNCS.get(mtype) == 'extract_tar_zst' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(fileobj), ''
+
+    return None
 
 
 def get_extract_func(arc_path):
@@ -208,9 +701,8 @@ def get_extract_func(arc_path):
     Raises:
         PakitError: Could not determine function from mimetype.
     """
-    cmd = Command('file --mime-type ' + arc_path)
-    cmd.wait()
-    mtype = cmd.output()[0].split()[1]
+    with open(arc_path, 'rb') as fin:
+        mtype = sniff_mimetype(fin.read(SNIFF_SIZE))
 
     if mtype not in EXT_FUNCS.keys():
         raise PakitError('Unsupported Archive: mimetype ' + mtype)
@@ -242,6 +734,68 @@ def hash_archive(archive, hash_alg='sha256'):
     return hasher.hexdigest()
 
 
+class HashingReader(object):
+    """
+    Wrap a readable file object, every byte read through it is hashed.
+
+    Used to verify an archive while it is being streamed elsewhere,
+    for instance straight from the network into tarfile.
+
+    Attributes:
+        fileobj: The underlying file object being read.
+        hasher: The hashlib object updated on every read.
+    """
+    def __init__(self, fileobj, hash_alg='sha256'):
+        self.fileobj = fileobj
+        self.hasher = hashlib.new(hash_alg)
+        self.peeked = b''
+
+    def peek(self, size):
+        """
+        Read up to size bytes without consuming them.
+        They will be returned again by the following reads.
+        """
+        while len(self.peeked) < size:
+            block = self.fileobj.read(size - len(self.peeked))
+            if not block:
+                break
+            self.hasher.update(block)
+            self.peeked += block
+
+        return self.peeked[:size]
+
+    def read(self, size=-1):
+        """
+        Read from the underlying file object and hash the block.
+        """
+        if self.peeked:
+            if size < 0 or size > len(self.peeked):
+                block = self.peeked
+                self.peeked = b''
+            else:
+                block = self.peeked[:size]
+                self.peeked = self.peeked[size:]
+            return block
+
+        block = self.fileobj.read(size)
+        self.hasher.update(block)
+        return block
+
+    def drain(self, blk_size=1024 ** 2):
+        """
+        Read and hash whatever remains unread in the file object.
+        Consumers like tarfile may stop before the end of the stream.
+        """
+        while self.read(blk_size):
+            pass
+
+    def hexdigest(self):
+        """
+        The hex based hash of everything read so far.
+        """
+        return self.hasher.hexdigest()
+
+
 def common_suffix(path1, path2):
     """
     Given two paths, find the largest common suffix.
@@ -264,109 +818,368 @@ def common_suffix(path1, path2):
     return os.path.sep.join(suffix)
 
 
-def walk_and_link(src, dst):
+def walk_and_link(src, dst, fold=False, unfolded=None, linked=None):
     """
     Recurse down the tree from src and symbollically link
     the files to their counterparts under dst.
 
+    When fold is True, a folder with no counterpart under dst is linked
+    as a whole instead of file by file, like GNU stow does. Regardless of
+    fold, a folded link to another tree met along the way is unfolded
+    so that both trees can share the folder.
+
+    The tree is read with scandir and links are made relative to an open
+    descriptor of each destination folder, so no full paths are built.
+
     Args:
         src: The source path with the files to link.
         dst: The destination path where links should be made.
+        fold: Link whole folders when possible.
+        unfolded: Optional dict, every folded link that was unfolded is
+            mapped onto the list of links that replaced it.
+        linked: Optional paths relative to dst that are already linked
+            from src, they are neither linked again nor descended into.
+
+    Returns:
+        The manifest of links made, a list of paths relative to dst.
+
+    Raises:
+        PakitLinkError: When anything goes wrong linking. Any links
+            made before the error are removed.
+    """
+    if unfolded is None:
+        unfolded = {}
+    linked = set(linked or [])
+    links = []
+    try:
+        os.makedirs(dst)
+    except OSError:
+        pass  # The folder already existed
+
+    stack = ['']
+    try:
+        while stack:
+            rel_dir = stack.pop()
+            dst_fd = open_dir(os.path.join(dst, rel_dir))
+            try:
+                for entry in scan_dir(os.path.join(src, rel_dir)):
+                    rel_path = os.path.join(rel_dir, entry.name)
+                    if rel_path in linked:
+                        continue
+                    if not entry.is_dir():
+                        link_file(entry.path, entry.name, dst_fd)
+                        links.append(rel_path)
+                        continue
+
+                    dst_stat = lstat_at(entry.name, dst_fd)
+                    if dst_stat is None and fold:
+                        link_file(entry.path, entry.name, dst_fd)
+                        links.append(rel_path)
+                        continue
+                    if dst_stat is None:
+                        try:
+                            os.mkdir(entry.name, dir_fd=dst_fd)
+                        except OSError:
+                            pass  # Reported when the folder is opened
+                    elif stat.S_ISLNK(dst_stat.st_mode) and \
+                            is_folded(dst, os.path.join(dst, rel_path)):
+                        unfolded[rel_path] = unfold_link(dst, rel_path)
+                    stack.append(rel_path)
+            finally:
+                os.close(dst_fd)
+    except PakitLinkError:
+        unlink_manifest(dst, links)
+        raise
+
+    return links
+
+
+def scan_dir(path):
+    """
+    Returns:
+        The os.DirEntry objects of path sorted by name.
+    """
+    with os.scandir(path) as entries:
+        return sorted(entries, key=lambda entry: entry.name)
+
+
+def open_dir(path, dir_fd=None):
+    """
+    Open a folder for use as the dir_fd of other calls.
 
     Raises:
-        PakitLinkError: When anything goes wrong linking.
+        PakitLinkError: The folder could not be opened.
     """
-    for dirpath, _, filenames in os.walk(src, followlinks=True, topdown=True):
-        link_all_files(dirpath, dirpath.replace(src, dst), filenames)
+    try:
+        return os.open(path, DIR_FLAGS, dir_fd=dir_fd)
+    except OSError:
+        msg = 'Could not open folder: ' + path
+        logging.error(msg)
+        raise PakitLinkError(msg)
+
+
+def lstat_at(name, dir_fd):
+    """
+    Returns:
+        The lstat of name relative to dir_fd, None if nothing is there.
+    """
+    try:
+        return os.lstat(name, dir_fd=dir_fd)
+    except OSError:
+        return None
+
+
+def link_file(sfile, dfile, dir_fd=None):
+    """
+    Symlink dfile to sfile.
+    When dir_fd is given, dfile is relative to it.
+
+    Raises:
+        PakitLinkError: The link could not be made.
+    """
+    try:
+        os.symlink(sfile, dfile, dir_fd=dir_fd)
+    except OSError:
+        msg = 'Could not symlink {0} -> {1}'.format(sfile, dfile)
+        logging.error(msg)
+        raise PakitLinkError(msg)
+
+
+def is_folded(dst, path):
+    """
+    True iff path is a link to a folder outside of dst.
+    """
+    if not os.path.islink(path) or not os.path.isdir(path):
+        return False
+    real_dst = os.path.realpath(dst) + os.path.sep
+    return os.path.realpath(path).find(real_dst) != 0
+
+
+def unfold_link(dst, rel_path):
+    """
+    Replace a folded link by a real folder holding
+    one link per entry of the folder it pointed to.
+
+    Args:
+        dst: The destination path where links are made.
+        rel_path: The path of the folded link relative to dst.
+
+    Returns:
+        The links made in its place, paths relative to dst.
+    """
+    path = os.path.join(dst, rel_path)
+    target = os.path.join(os.path.dirname(path), os.readlink(path))
+    os.remove(path)
+    os.mkdir(path)
+
+    links = []
+    dst_fd = open_dir(path)
+    try:
+        for entry in scan_dir(target):
+            link_file(entry.path, entry.name, dst_fd)
+            links.append(os.path.join(rel_path, entry.name))
+    finally:
+        os.close(dst_fd)
+
+    return links
+
+
+def split_manifest(src, dst, links):
+    """
+    Check a manifest made by walk_and_link against the disk.
+
+    A link is valid when it still points at its counterpart under src
+    and that counterpart exists. Stale links point at a counterpart
+    that is gone, links that vanished or were replaced are in neither.
+
+    Args:
+        src: The source path the links were made from.
+        dst: The destination path the links were made under.
+        links: The manifest, a list of paths relative to dst.
+
+    Returns:
+        (valid, stale), two lists of paths relative to dst.
+    """
+    valid, stale = [], []
+    for link in links:
+        sfile = os.path.join(src, link)
+        try:
+            if os.readlink(os.path.join(dst, link)) != sfile:
+                continue
+        except OSError:
+            continue  # Not there or not a link anymore
+
+        if os.path.exists(sfile):
+            valid.append(link)
+        else:
+            stale.append(link)
+
+    return valid, stale
 
 
 def walk_and_unlink(src, dst):
     """
     Recurse down the tree from src and unlink the files
     that have counterparts under dst.
+    Folders left empty under dst are removed.
 
     Args:
         src: The source path with the files to link.
         dst: The destination path where links should be removed.
     """
-    for dirpath, _, filenames in os.walk(src, followlinks=True, topdown=False):
-        unlink_all_files(dirpath, dirpath.replace(src, dst), filenames)
+    try:
+        dst_fd = os.open(dst, DIR_FLAGS)
+    except OSError:
+        dst_fd = None
+
+    if dst_fd is not None:
+        try:
+            unlink_tree(src, dst_fd)
+        finally:
+            os.close(dst_fd)
+
     try:
         os.makedirs(dst)
     except OSError:
         pass
 
 
-def walk_and_unlink_all(link_root, build_root):
+def unlink_tree(src_dir, dst_fd):
     """
-    Walk the tree from bottom up and remove all symbolic links
-    pointing into the build_root. Cleans up any empty folders.
+    Remove links under dst_fd to their counterparts in src_dir,
+    bottom up, then the folders left empty.
+    A link to a folder is only removed if it points at src_dir.
 
     Args:
-        build_root: The path where all installations are. Any symlink
-            pakit makes will have this as a prefix of the target path.
-        link_root: All links are located below this folder.
+        src_dir: The source folder the links were made from.
+        dst_fd: A descriptor of the matching destination folder.
     """
-    for dirpath, _, filenames in os.walk(link_root, followlinks=True,
-                                         topdown=False):
-        to_remove = []
-        for fname in filenames:
-            abs_file = os.path.join(dirpath, fname)
-            if os.path.realpath(abs_file).find(build_root) == 0:
-                to_remove.append(fname)
+    for entry in scan_dir(src_dir):
+        dst_stat = lstat_at(entry.name, dst_fd)
+        if dst_stat is None:
+            continue
+
+        if stat.S_ISLNK(dst_stat.st_mode):
+            if not entry.is_dir() or \
+                    os.readlink(entry.name, dir_fd=dst_fd) == entry.path:
+                os.unlink(entry.name, dir_fd=dst_fd)
+        elif stat.S_ISDIR(dst_stat.st_mode) and entry.is_dir():
+            sub_fd = os.open(entry.name, DIR_FLAGS, dir_fd=dst_fd)
+            try:
+                unlink_tree(entry.path, sub_fd)
+            finally:
+                os.close(sub_fd)
+            try:
+                os.rmdir(entry.name, dir_fd=dst_fd)
+            except OSError:
+                pass  # Folder probably had files left.
 
-        unlink_all_files(dirpath, dirpath, to_remove)
+
+def unlink_manifest(dst, links):
+    """
+    Remove the links in a manifest made by walk_and_link.
+    Folders left empty are removed, no other part of dst is walked.
+
+    Args:
+        dst: The destination path the links were made under.
+        links: The manifest, a list of paths relative to dst.
+    """
+    by_dir = {}
+    for link in links:
+        by_dir.setdefault(os.path.dirname(link), []).append(
+            os.path.basename(link))
+
+    dirs = set()
+    for rel_dir, names in by_dir.items():
+        parent = rel_dir
+        while parent:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+
+        try:
+            dst_fd = os.open(os.path.join(dst, rel_dir), DIR_FLAGS)
+        except OSError:
+            continue
+        try:
+            for name in names:
+                dst_stat = lstat_at(name, dst_fd)
+                if dst_stat is not None and stat.S_ISLNK(dst_stat.st_mode):
+                    os.unlink(name, dir_fd=dst_fd)
+        finally:
+            os.close(dst_fd)
+
+    for rel_dir in sorted(dirs, key=lambda path: path.count(os.path.sep),
+                          reverse=True):
+        try:
+            os.rmdir(os.path.join(dst, rel_dir))
+        except OSError:
+            pass  # Folder probably had files left.
 
     try:
-        os.makedirs(link_root)
+        os.makedirs(dst)
     except OSError:
         pass
 
 
-def link_all_files(src, dst, filenames):
+def walk_and_unlink_all(link_root, build_root):
     """
-    From src directory link all filenames into dst.
+    Walk the tree from bottom up and remove all symbolic links
+    pointing into the build_root. Cleans up any empty folders.
+    Folded links to folders are removed, never followed.
 
     Args:
-        src: The directory where the source files exist.
-        dst: The directory where the links should be made.
-        filenames: A list of filenames in src.
+        build_root: The path where all installations are. Any symlink
+            pakit makes will have this as a prefix of the target path.
+        link_root: All links are located below this folder.
     """
     try:
-        os.makedirs(dst)
+        root_fd = os.open(link_root, DIR_FLAGS)
     except OSError:
-        pass  # The folder already existed
+        root_fd = None
 
-    for fname in filenames:
-        sfile = os.path.join(src, fname)
-        dfile = os.path.join(dst, fname)
+    if root_fd is not None:
         try:
-            os.symlink(sfile, dfile)
-        except OSError:
-            msg = 'Could not symlink {0} -> {1}'.format(sfile, dfile)
-            logging.error(msg)
-            raise PakitLinkError(msg)
+            unlink_into(link_root, root_fd, build_root)
+        finally:
+            os.close(root_fd)
+
+    try:
+        os.makedirs(link_root)
+    except OSError:
+        pass
 
 
-def unlink_all_files(_, dst, filenames):
+def unlink_into(dir_path, dir_fd, build_root):
     """
-    Unlink all links in dst that are in filenames.
+    Remove links under dir_fd pointing into build_root, bottom up,
+    then the folders left empty. Links are never followed.
 
     Args:
-        src: The directory where the source files exist.
-        dst: The directory where the links should be made.
-        filenames: A list of filenames in src.
+        dir_path: The path of the folder, used to resolve relative links.
+        dir_fd: A descriptor of the folder.
+        build_root: The path where all installations are.
     """
-    for fname in filenames:
-        try:
-            os.remove(os.path.join(dst, fname))
-        except OSError:
-            pass  # The link was not there
-
-    try:
-        os.rmdir(dst)
-    except OSError:
-        pass  # Folder probably had files left.
+    with os.scandir(dir_fd) as entries:
+        entries = list(entries)
+
+    for entry in entries:
+        if entry.is_symlink():
+            target = os.path.normpath(os.path.join(
+                dir_path, os.readlink(entry.name, dir_fd=dir_fd)))
+            if target.find(build_root) == 0 or \
+                    os.path.realpath(target).find(build_root) == 0:
+                os.unlink(entry.name, dir_fd=dir_fd)
+        elif entry.is_dir(follow_symlinks=False):
+            sub_fd = os.open(entry.name, DIR_FLAGS, dir_fd=dir_fd)
+            try:
+                unlink_into(os.path.join(dir_path, entry.name), sub_fd,
+                            build_root)
+            finally:
+                os.close(sub_fd)
+            try:
+                os.rmdir(entry.name, dir_fd=dir_fd)
+            except OSError:
+                pass  # Folder probably had files left.
 
 
 def link_man_pages(link_dir):
@@ -511,7 +1324,7 @@ class Fetchable(object):
         """
         Purges the source tree from the system
         """
-        Command('rm -rf ' + self.target).wait()
+        delete_later(self.target)
 
     @abstractmethod
     def download(self):
@@ -589,10 +1402,15 @@ class Archive(Fetchable):
     of the form `extract_ext`. For example, if given a zip will use the
     extract_zip function.
 
+    Remote archives are streamed by default. Tar archives are extracted
+    while downloading and never written to disk, other types are hashed
+    while being written. The extraction is only kept if the hash matches.
+
     Attributes:
         actual_hash: The actual sha256 hash of the archive.
         filename: The filename of the archive.
         src_hash: The expected sha256 hash of the archive.
+        stream: When True, stream remote archives into target.
         target: The folder the source code should end up in.
         uri: The location of the source code.
     """
@@ -606,11 +1424,13 @@ class Archive(Fetchable):
         Kwargs:
             filename: The filename to use, else a tempfile will be used.
             hash: The sha256 hash of the archive.
+            stream: Stream remote archives, default True.
             target: Path on system to extract to.
         """
         super(Archive, self).__init__(uri, kwargs.get('target', None))
 
         self.__src_hash = kwargs.get('hash', '')
+        self.stream = kwargs.get('stream', True)
         self.filename = kwargs.get('filename')
         if self.filename is None:
             self.__tfile = TempFile(mode='wb', delete=False,
@@ -625,13 +1445,17 @@ class Archive(Fetchable):
         if self.ready:
             return
 
-        logging.info('Downloading %s', self.arc_file)
-        self.download()
-        logging.info('Extracting %s to %s', self.arc_file, self.target)
-        get_extract_func(self.arc_file)(self.arc_file, self.target)
+        if self.streamable:
+            logging.info('Streaming %s to %s', self.uri, self.target)
+            self.stream_extract()
+        else:
+            logging.info('Downloading %s', self.arc_file)
+            self.download()
+            logging.info('Extracting %s to %s', self.arc_file, self.target)
+            get_extract_func(self.arc_file)(self.arc_file, self.target)
+            os.remove(self.arc_file)
         with open(os.path.join(self.target, '.archive'), 'wb') as fout:
             fout.write(self.src_hash.encode())
-        os.remove(self.arc_file)
 
     def __exit__(self, exc_type, exc_value, exc_tb):
         """
@@ -672,6 +1496,13 @@ class Archive(Fetchable):
         """
         return self.__src_hash
 
+    @property
+    def streamable(self):
+        """
+        True iff the archive is remote and can be streamed.
+        """
+        return self.stream and not os.path.isfile(self.uri)
+
     def actual_hash(self):
         """
         The actual hash of the downloaded archive file.
@@ -717,6 +1548,50 @@ class Archive(Fetchable):
                              '\n  Actual: {act}'.format(exp=self.src_hash,
                                                         act=arc_hash))
 
+    def stream_extract(self):
+        """
+        Extract the remote archive into target as it downloads.
+
+        The type is sniffed from the first bytes of the response.
+        Tar archives are extracted straight from the response, anything
+        else is written to arc_file and extracted once complete.
+        The response is hashed as it is consumed, the extraction is only
+        moved to target when the final hash matches.
+
+        Raises:
+            PakitError: The hash of the stream did not match.
+        """
+        tmp_dir = stage_dir(self.target)
+        resp = ulib.urlopen(self.uri, timeout=30)
+        try:
+            reader = HashingReader(resp)
+            mtype = sniff_mimetype(reader.peek(SNIFF_SIZE))
+            stream_args = tar_stream_args(reader, mtype)
+            if stream_args:
+                extract_tar_stream(stream_args[0], tmp_dir, stream_args[1])
+                reader.drain()
+            else:
+                with open(self.arc_file, 'wb') as fout:
+                    shutil.copyfileobj(reader, fout)
+
+            arc_hash = reader.hexdigest()
+            if arc_hash != self.src_hash:
+                raise PakitError('Hash mismatch on archive.\n  Expected: '
+                                 '{exp}\n  Actual: {act}'.format(
+                                     exp=self.src_hash, act=arc_hash))
+
+            if stream_args:
+                commit_extract(tmp_dir, self.target)
+            else:
+                get_extract_func(self.arc_file)(self.arc_file, self.target)
+        finally:
+            resp.close()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            try:
+                os.remove(self.arc_file)
+            except OSError:
+                pass
+
 
 class VersionRepo(Fetchable):
     """
@@ -11,20 +11,355 @@ from abc import ABCMeta, abstractmethod
 import glob
 import logging
 import os
+import re
 import shutil
+import tempfile
+import time
 
 import pakit.conf
 import pakit.recipe
-from pakit.exc import PakitCmdError, PakitLinkError
+from pakit.exc import PakitDBError, PakitLinkError
 from pakit.shell import (
-    Command, walk_and_link, walk_and_unlink, walk_and_unlink_all,
-    write_config, unlink_man_pages, user_input
+    walk_and_link, walk_and_unlink, walk_and_unlink_all,
+    is_folded, unfold_link, split_manifest, unlink_manifest,
+    trash_path, empty_trash, delete_later, is_deleting, dir_size,
+    write_config, unlink_man_pages, user_input, STAGE_PREFIX, TRASH_DIR
 )
 
 PREFIX = '\n  '
 USER = logging.getLogger('pakit')
 
 
+def link_installed(recipe, linked=None, taken=None):
+    """
+    Link an installed recipe, folding folders if configured.
+
+    Conflicts with other recipes are found by plan_links before
+    any link is made. Links of other recipes unfolded along the way
+    are moved into their manifests, even if linking fails.
+
+    Args:
+        recipe: The installed recipe.
+        linked: Optional links already in place, they are skipped.
+        taken: Optional dict, links taken over from lower priority
+            recipes are mapped onto their old owners.
+
+    Returns:
+        The manifest of links made.
+
+    Raises:
+        PakitLinkError: When conflicts are found or anything goes
+            wrong linking.
+    """
+    take, skip = plan_links(recipe)
+    if take:
+        take_links(recipe.link_dir, take)
+        if taken is not None:
+            taken.update(take)
+
+    unfolded = {}
+    try:
+        return walk_and_link(recipe.install_dir, recipe.link_dir,
+                             pakit.conf.CONFIG.get('pakit.link.fold'),
+                             unfolded, list(linked or []) + skip)
+    finally:
+        if unfolded:
+            transfer_unfolded(unfolded)
+
+
+def link_rank(name):
+    """
+    The rank of a recipe in pakit.link.priority, the lowest rank wins.
+    Recipes not in the list rank after all those in it.
+    """
+    priority = pakit.conf.CONFIG.get('pakit.link.priority')
+    try:
+        return priority.index(name)
+    except ValueError:
+        return len(priority)
+
+
+def link_owner(owners, rel_path):
+    """
+    Find the recipe owning the link at rel_path, or a folded link above it.
+
+    Args:
+        owners: The index from pakit.conf.InstallDB.owners.
+        rel_path: A path relative to the link dir.
+
+    Returns:
+        The owning recipe's name, None if no recipe owns it.
+    """
+    while rel_path:
+        if rel_path in owners:
+            return owners[rel_path]
+        rel_path = os.path.dirname(rel_path)
+
+    return None
+
+
+def plan_links(recipe):
+    """
+    Check every file of an installed recipe against the links
+    other recipes own, in one pass and before any link is made.
+
+    Conflicts are settled by pakit.link.priority, see link_rank.
+
+    Args:
+        recipe: The installed recipe.
+
+    Returns:
+        (take, skip): take maps links of lower priority recipes onto
+        their owners, they will be replaced. skip lists links left to
+        higher priority recipes.
+
+    Raises:
+        PakitLinkError: Reports every conflict that could not be settled.
+    """
+    owners = pakit.conf.IDB.owners
+    rank = link_rank(recipe.name)
+    take, skip, conflicts = {}, [], []
+    for dirpath, _, filenames in os.walk(recipe.install_dir,
+                                         followlinks=True):
+        rel_dir = os.path.relpath(dirpath, recipe.install_dir)
+        for fname in filenames:
+            rel_path = os.path.normpath(os.path.join(rel_dir, fname))
+            owner = link_owner(owners, rel_path)
+            if owner is None or owner == recipe.name:
+                continue
+            if rel_path not in owners and not os.path.lexists(
+                    os.path.join(recipe.link_dir, rel_path)):
+                continue  # Only below a folded link of owner
+
+            owner_rank = link_rank(owner)
+            if rank < owner_rank:
+                take[rel_path] = owner
+            elif owner_rank < rank:
+                skip.append(rel_path)
+            else:
+                conflicts.append('{0} (owned by {1})'.format(rel_path,
+                                                             owner))
+
+    if conflicts:
+        msg = '{0}: Link conflicts, see pakit.link.priority:{1}{2}'.format(
+            recipe.name, PREFIX, PREFIX.join(sorted(conflicts)))
+        logging.error(msg)
+        raise PakitLinkError(msg)
+
+    return take, skip
+
+
+def take_links(link_dir, take):
+    """
+    Remove links of lower priority recipes so they can be replaced.
+    Their folded links above the taken links are unfolded first.
+
+    Args:
+        link_dir: The path where all links are made.
+        take: Maps the links to take onto the recipe owning them.
+    """
+    for rel_path, owner in sorted(take.items()):
+        parents = []
+        parent = os.path.dirname(rel_path)
+        while parent:
+            parents.insert(0, parent)
+            parent = os.path.dirname(parent)
+        for parent in parents:
+            if is_folded(link_dir, os.path.join(link_dir, parent)):
+                transfer_unfolded({parent: unfold_link(link_dir, parent)})
+
+        path = os.path.join(link_dir, rel_path)
+        if os.path.islink(path):
+            os.remove(path)
+        entry = dict(pakit.conf.IDB[owner])
+        entry['links'] = [link for link in entry.get('links', [])
+                          if link != rel_path]
+        pakit.conf.IDB[owner] = entry
+        USER.info('%s: Link taken over by priority: %s', owner, rel_path)
+
+    pakit.conf.IDB.write()
+
+
+def transfer_unfolded(unfolded):
+    """
+    Update the manifests in the InstallDB for links that were unfolded.
+
+    Args:
+        unfolded: Maps each unfolded link onto the links replacing it,
+            in the order they were unfolded.
+    """
+    for folded, new_links in unfolded.items():
+        for name in pakit.conf.IDB:
+            entry = pakit.conf.IDB[name] or {}
+            if folded in entry.get('links', []):
+                entry = dict(entry)
+                entry['links'] = sorted(
+                    [link for link in entry['links'] if link != folded] +
+                    new_links)
+                pakit.conf.IDB[name] = entry
+                break
+
+    pakit.conf.IDB.write()
+
+
+def relink_installed(recipe):
+    """
+    Bring the links of an installed recipe up to date.
+
+    Only the difference between the manifest and the install_dir is
+    applied, links that are still correct are left untouched.
+    Older entries without a manifest are unlinked and linked again.
+
+    Args:
+        recipe: The installed recipe.
+
+    Returns:
+        The new manifest of links.
+
+    Raises:
+        PakitLinkError: When anything goes wrong linking.
+    """
+    entry = pakit.conf.IDB.get(recipe.name) or {}
+    if 'links' not in entry:
+        unlink_installed(recipe)
+        return sorted(link_installed(recipe))
+
+    valid, stale = split_manifest(recipe.install_dir, recipe.link_dir,
+                                  entry['links'])
+    unlink_manifest(recipe.link_dir, stale)
+    added = link_installed(recipe, valid)
+    logging.debug('%s: Relinked, %d added, %d removed, %d kept',
+                  recipe.name, len(added),
+                  len(entry['links']) - len(valid), len(valid))
+    return sorted(valid + added)
+
+
+def link_claimants(links):
+    """
+    Find the installed recipes with files at any of the links.
+    Links a recipe lost or skipped by priority are not in its manifest,
+    so its install_dir is checked instead.
+
+    Args:
+        links: Paths relative to the link dir.
+
+    Returns:
+        A sorted list of names.
+    """
+    names = []
+    for name in pakit.conf.IDB:
+        if name not in pakit.recipe.RDB:
+            continue
+        install_dir = pakit.recipe.RDB.get(name).install_dir
+        if any(os.path.lexists(os.path.join(install_dir, link))
+               for link in links):
+            names.append(name)
+
+    return sorted(names)
+
+
+def give_back_links(names):
+    """
+    Relink installed recipes so they get back links another recipe
+    held over them. The highest priority recipe is relinked first,
+    see link_rank.
+
+    A recipe that still conflicts is logged and left as it is.
+
+    Args:
+        names: The names of the installed recipes.
+    """
+    names = sorted(set(names), key=lambda name: (link_rank(name), name))
+    for name in names:
+        try:
+            links = relink_installed(pakit.recipe.RDB.get(name))
+        except PakitLinkError:
+            logging.error('%s: Could not take back links.', name)
+            continue
+        entry = dict(pakit.conf.IDB[name])
+        entry['links'] = links
+        pakit.conf.IDB[name] = entry
+
+    if names:
+        pakit.conf.IDB.write()
+
+
+def switch_current(recipe, version):
+    """
+    Point the current_link of a recipe at one of its installed versions.
+
+    The new link is made beside the current_link and renamed over it,
+    so the switch is atomic and the current_link is never missing.
+
+    Args:
+        recipe: The recipe.
+        version: The name of the version folder under install_root.
+            None removes the current_link.
+    """
+    current = recipe.current_link
+    if version is None:
+        try:
+            os.remove(current)
+        except OSError:
+            pass
+        return
+
+    new_link = current + '_new'
+    try:
+        os.remove(new_link)
+    except OSError:
+        pass
+    os.symlink(version, new_link)
+    os.rename(new_link, current)
+
+
+def old_versions(recipe, keep=0):
+    """
+    Find the versions of a recipe that are installed but not current.
+    Installs made before versioned installs have none.
+
+    Args:
+        recipe: The installed recipe.
+        keep: How many of the most recently modified to leave out.
+
+    Returns:
+        The paths of the old versions, plus any leftover new link.
+    """
+    try:
+        current = os.readlink(recipe.current_link)
+    except OSError:
+        return []
+
+    leftovers, versions = [], []
+    for fname in os.listdir(recipe.install_root):
+        path = os.path.join(recipe.install_root, fname)
+        if path == recipe.current_link + '_new':
+            leftovers.append(path)
+        elif path != recipe.current_link and fname != current:
+            versions.append(path)
+
+    versions = sorted(versions, key=lambda path: os.lstat(path).st_mtime,
+                      reverse=True)
+    return leftovers + versions[keep:]
+
+
+def unlink_installed(recipe):
+    """
+    Remove all links made for an installed recipe.
+
+    The manifest stored in the InstallDB is used when present, older
+    entries without one fall back to walking the install_dir.
+
+    Args:
+        recipe: The installed recipe.
+    """
+    entry = pakit.conf.IDB.get(recipe.name) or {}
+    if 'links' in entry:
+        unlink_manifest(recipe.link_dir, entry['links'])
+    else:
+        walk_and_unlink(recipe.install_dir, recipe.link_dir)
+
+
 class Task(object):
     """
     The abstract metaclass interface that pakit uses to perform high
@@ -98,6 +433,8 @@ class InstallTask(RecipeTask):
     """
     def __init__(self, recipe):
         super(InstallTask, self).__init__(recipe)
+        self.links = None
+        self.taken = {}
 
     def rollback(self, exc):
         """
@@ -117,16 +454,26 @@ class InstallTask(RecipeTask):
         if cascade or isinstance(exc, PakitLinkError):
             if not cascade:
                 logging.error('Error during linking of %s', self.recipe.name)
-            walk_and_unlink(self.recipe.install_dir, self.recipe.link_dir)
+            if self.links is not None:
+                unlink_manifest(self.recipe.link_dir, self.links)
+            self.give_back_links()
             cascade = True
         if cascade or (not isinstance(exc, PakitLinkError) and
                        not isinstance(exc, AssertionError)):
             if not cascade:
                 logging.error('Error during build() of %s', self.recipe.name)
+            switch_current(self.recipe, None)
             try:
-                Command('rm -rf ' + self.recipe.install_dir).wait()
-            except PakitCmdError:  # pragma: no cover
-                pass
+                delete_later(self.recipe.install_root)
+            except OSError:  # pragma: no cover
+                logging.error('Could not delete path: %s',
+                              self.recipe.install_root)
+
+    def give_back_links(self):
+        """
+        Relink the recipes that had links taken over while linking.
+        """
+        give_back_links(self.taken.values())
 
     def run(self):
         """
@@ -146,24 +493,30 @@ class InstallTask(RecipeTask):
             USER.info('%s: Downloading: %s', self.recipe.name,
                       str(self.recipe.repo))
             with self.recipe.repo:
+                version = self.recipe.repo.src_hash
+                self.recipe.opts['prefix'] = self.recipe.version_dir(version)
                 USER.info('%s: Building Source', self.recipe.name)
                 self.recipe.build()
+                switch_current(self.recipe, version)
 
                 USER.info('%s: Symlinking Program', self.recipe.name)
-                walk_and_link(self.recipe.install_dir, self.recipe.link_dir)
+                self.links = link_installed(self.recipe, taken=self.taken)
 
                 USER.info('%s: Verifying Program', self.recipe.name)
                 self.recipe.verify()
 
-                pakit.conf.IDB.add(self.recipe)
+                pakit.conf.IDB.add(self.recipe, self.links)
         except Exception as exc:  # pylint: disable=broad-except
             self.rollback(exc)
             raise
+        finally:
+            self.recipe.opts['prefix'] = self.recipe.current_link
 
 
 class RemoveTask(RecipeTask):
     """
     Remove a given recipe from the system.
+    Links it held over other recipes by priority are given back.
 
     Does nothing if it is not installed.
     """
@@ -178,63 +531,168 @@ class RemoveTask(RecipeTask):
             print(self.recipe.name + ': Not Installed')
             return
 
-        walk_and_unlink(self.recipe.install_dir, self.recipe.link_dir)
+        links = pakit.conf.IDB[self.recipe.name].get('links', [])
+        unlink_installed(self.recipe)
         try:
-            shutil.rmtree(self.recipe.install_dir)
+            delete_later(self.recipe.install_root)
         except OSError:  # pragma: no cover
-            pass
+            logging.error('Could not delete path: %s',
+                          self.recipe.install_root)
         del pakit.conf.IDB[self.recipe.name]
         pakit.conf.IDB.write()
+        give_back_links(link_claimants(links))
 
 
 class UpdateTask(RecipeTask):
     """
     Update a program, don't do it unless changes made.
+
+    The new version is built beside the live one, which stays linked
+    until the current_link is switched over to the new version.
+    On failure the current_link is switched back.
+
+    A recipe is also rebuilt when one of its requirements was updated
+    or reinstalled after it was built.
     """
     def __init__(self, recipe):
         super(UpdateTask, self).__init__(recipe)
-        self.back_dir = self.recipe.install_dir + '_bak'
         self.old_entry = None
+        self.old_version = None
+        self.switched = False
 
-    def save_old_install(self):
+    def stale_requires(self):
         """
-        Before attempting an update of the program:
-            - Unlink it.
-            - Move the installation to a backup location.
-            - Remove the pakit.conf.IDB entry.
+        The requirements installed after this recipe was built.
+
+        Returns:
+            A list of requirement names.
         """
-        USER.info('%s: Saving Old Install', self.recipe.name)
-        walk_and_unlink(self.recipe.install_dir, self.recipe.link_dir)
-        self.old_entry = pakit.conf.IDB.get(self.recipe.name)
-        del pakit.conf.IDB[self.recipe.name]
-        shutil.move(self.recipe.install_dir, self.back_dir)
+        built = self.old_entry.get('time', 0)
+        return [name for name in self.old_entry.get('requires', [])
+                if (pakit.conf.IDB.get(name) or {}).get('time', 0) > built]
 
-    def restore_old_install(self):
+    def switch_to(self, version):
         """
-        The update failed, reverse the actions of save_old_install.
+        Switch the current_link to version and bring the links up to date.
+
+        Installs made before versioned installs are fully relinked
+        when switching from or to them, others only get the difference.
+
+        Args:
+            version: The version folder to switch to, None for the
+                install directly under install_root.
+        """
+        if version is None or not os.path.lexists(self.recipe.current_link):
+            unlink_installed(self.recipe)
+            switch_current(self.recipe, version)
+            links = sorted(link_installed(self.recipe))
+        else:
+            switch_current(self.recipe, version)
+            links = relink_installed(self.recipe)
+
+        entry = dict(pakit.conf.IDB[self.recipe.name])
+        entry['links'] = links
+        pakit.conf.IDB[self.recipe.name] = entry
+
+    def remove_old_install(self, version):
+        """
+        Throw away the old versions beyond pakit.gc.keep, or everything
+        beside version for installs made before versioned installs.
+        Deletion happens in the background.
+        """
+        USER.info('%s: Deleting Old Install', self.recipe.name)
+        if self.old_version is None:
+            old = [os.path.join(self.recipe.install_root, fname)
+                   for fname in os.listdir(self.recipe.install_root)
+                   if fname not in (os.path.basename(
+                       self.recipe.current_link), version)]
+        else:
+            old = old_versions(self.recipe,
+                               pakit.conf.CONFIG.get('pakit.gc.keep'))
+
+        prefix = pakit.conf.CONFIG.path_to('prefix')
+        for path in old:
+            try:
+                delete_later(path, prefix)
+            except OSError:  # pragma: no cover
+                logging.error('Could not delete path: %s', path)
+
+    def restore_old_install(self, version):
+        """
+        The update failed, switch back to the old version and
+        delete the folder of the new version.
         """
         USER.info('%s: Restoring Old Install', self.recipe.name)
-        shutil.move(self.back_dir, self.recipe.install_dir)
-        pakit.conf.IDB[self.recipe.name] = self.old_entry
-        walk_and_link(self.recipe.install_dir, self.recipe.link_dir)
+        new_dir = None
+        if version is not None and version != self.old_version:
+            new_dir = self.recipe.version_dir(version)
+        prefix = pakit.conf.CONFIG.path_to('prefix')
+        if new_dir and self.old_version is None:
+            # The old install is walked from install_root, drop the new
+            # one before switching back
+            delete_later(new_dir, prefix)
+        if self.switched:
+            self.switch_to(self.old_version)
+        if new_dir and self.old_version is not None:
+            delete_later(new_dir, prefix)
+
+        entry = dict(self.old_entry)
+        entry['links'] = pakit.conf.IDB[self.recipe.name].get('links', [])
+        pakit.conf.IDB[self.recipe.name] = entry
+        pakit.conf.IDB.write()
 
     def run(self):
         """
         Execute a set of operations to perform the Task.
         """
         USER.info('%s: Checking For Updates', self.recipe.name)
-        cur_hash = pakit.conf.IDB[self.recipe.name]['hash']
-        if cur_hash == self.recipe.repo.src_hash:
+        self.old_entry = pakit.conf.IDB[self.recipe.name]
+        stale = self.stale_requires()
+        if self.old_entry['hash'] == self.recipe.repo.src_hash and not stale:
             return
+        if stale:
+            USER.info('%s: Rebuilding For: %s', self.recipe.name,
+                      ', '.join(stale))
+
+        self.old_version = None
+        if os.path.lexists(self.recipe.current_link):
+            self.old_version = os.readlink(self.recipe.current_link)
 
+        version = None
         try:
-            self.save_old_install()
-            InstallTask(self.recipe).run()
-            USER.info('%s: Deleting Old Install', self.recipe.name)
-            Command('rm -rf ' + self.back_dir).wait()
+            USER.info('%s: Downloading: %s', self.recipe.name,
+                      str(self.recipe.repo))
+            with self.recipe.repo:
+                version = self.recipe.repo.src_hash
+                cnt = 0
+                while version == self.old_version:
+                    # Rebuild of the live source, never build over it
+                    cnt += 1
+                    version = '{0}_{1}'.format(self.recipe.repo.src_hash, cnt)
+                version_dir = self.recipe.version_dir(version)
+                # Left by an aborted update
+                delete_later(version_dir, pakit.conf.CONFIG.path_to('prefix'))
+                self.recipe.opts['prefix'] = version_dir
+                USER.info('%s: Building Source', self.recipe.name)
+                self.recipe.build()
+
+                USER.info('%s: Switching To New Version', self.recipe.name)
+                self.switched = True
+                self.switch_to(version)
+
+                USER.info('%s: Verifying Program', self.recipe.name)
+                self.recipe.verify()
+
+                pakit.conf.IDB.add(self.recipe,
+                                   pakit.conf.IDB[self.recipe.name]['links'])
         except Exception as exc:  # pylint: disable=broad-except
             logging.error(exc)
-            self.restore_old_install()
+            self.restore_old_install(version)
+            return
+        finally:
+            self.recipe.opts['prefix'] = self.recipe.current_link
+
+        self.remove_old_install(version)
 
 
 class DisplayTask(RecipeTask):
@@ -260,25 +718,68 @@ class RelinkRecipes(Task):
     Relink all programs managed by pakit.
 
     Useful if one Recipe adds something to another Recipe's install.
-    Should be avoided unless absolutely necessary.
+    Only links that are missing or stale are changed.
 
     For example, if you installed  python and used get-pip.py.
     It would modify pakit's python install, but have to be relinked to be used.
     """
-    def __init__(self):
+    def __init__(self, recipes=None):
         super(RelinkRecipes, self).__init__()
+        self.recipes = recipes
 
     def run(self):
         """
         Execute a set of operations to perform the Task.
         """
-        logging.debug('Relinking All Programs')
+        logging.debug('Relinking Programs')
+
+        names = self.recipes or [name for name in pakit.conf.IDB]
+        for name in names:
+            if pakit.conf.IDB.get(name) is None:
+                print(name + ': Not Installed')
+                continue
+            if name not in pakit.recipe.RDB:
+                logging.error('Cannot relink %s, recipe missing.', name)
+                continue
+
+            links = relink_installed(pakit.recipe.RDB.get(name))
+            entry = dict(pakit.conf.IDB[name])
+            entry['links'] = links
+            pakit.conf.IDB[name] = entry
 
-        dst = pakit.conf.CONFIG.path_to('link')
-        walk_and_unlink_all(dst, pakit.conf.CONFIG.path_to('prefix'))
+        pakit.conf.IDB.write()
 
-        for _, recipe in pakit.recipe.RDB:
-            walk_and_link(recipe.install_dir, dst)
+
+class ListDependents(Task):
+    """
+    List the installed recipes that require a recipe.
+    """
+    def __init__(self, recipe):
+        super(ListDependents, self).__init__()
+        self.recipe = recipe
+
+    def run(self):
+        """
+        Execute a set of operations to perform the Task.
+        """
+        logging.debug('List Dependents: ' + self.recipe)
+        names = pakit.conf.IDB.rdeps([self.recipe])
+        if not names:
+            msg = self.recipe + ': No installed recipe requires it'
+            print(msg)
+            return msg
+
+        chain = set(names + [self.recipe])
+        dependents = ['Program      Requires']
+        for name in names:
+            requires = [req for req in pakit.conf.IDB[name]['requires']
+                        if req in chain]
+            dependents.append('{0:12} {1}'.format(name, ', '.join(requires)))
+
+        msg = 'Installed Recipes Requiring {0}:'.format(self.recipe)
+        msg += PREFIX + PREFIX.join(dependents)
+        print(msg)
+        return msg
 
 
 class ListInstalled(Task):
@@ -383,7 +884,12 @@ class PurgeTask(Task):
         USER.info('Removing all links made by pakit.')
         config = pakit.conf.CONFIG
         unlink_man_pages(config.path_to('link'))
-        walk_and_unlink_all(config.path_to('link'), config.path_to('prefix'))
+        entries = [pakit.conf.IDB[name] or {} for name in pakit.conf.IDB]
+        for entry in entries:
+            unlink_manifest(config.path_to('link'), entry.get('links', []))
+        if [entry for entry in entries if 'links' not in entry]:
+            walk_and_unlink_all(config.path_to('link'),
+                                config.path_to('prefix'))
 
         uris_file = os.path.join(config.path_to('recipes'), 'uris.yml')
         ruri_db = pakit.conf.RecipeURIDB(uris_file)
@@ -405,6 +911,145 @@ class PurgeTask(Task):
                 logging.error('Could not delete path: %s', path)
 
 
+class GCTask(Task):
+    """
+    Reclaim disk space from the folders pakit manages.
+
+    The live installs are found in the InstallDB, what else is kept
+    follows the pakit.gc policy in the config. Garbage is first renamed
+    into a TRASH_DIR beside it, then deleted.
+    """
+    def __init__(self, dry_run=False, background=False):
+        super(GCTask, self).__init__()
+        self.dry_run = dry_run
+        self.background = background
+
+    def find_garbage(self):
+        """
+        Scan the prefix, source and temporary folders for garbage.
+
+        Returns:
+            A list of (path, reason) pairs.
+        """
+        config = pakit.conf.CONFIG
+        stale_time = time.time() - config.get('pakit.gc.max_age')
+
+        def is_stale(path):
+            """ True iff path was not modified since stale_time. """
+            try:
+                return os.lstat(path).st_mtime < stale_time
+            except OSError:
+                return False
+
+        garbage = []
+        sources = []
+        source_root = config.path_to('source')
+        tmp_root = tempfile.gettempdir()
+        for root in (config.path_to('prefix'), source_root, tmp_root):
+            try:
+                fnames = sorted(os.listdir(root))
+            except OSError:
+                continue
+
+            for fname in fnames:
+                path = os.path.join(root, fname)
+                if fname == TRASH_DIR:
+                    holders = [os.path.join(path, holder)
+                               for holder in sorted(os.listdir(path))]
+                    garbage += [(holder, 'trash') for holder in holders
+                                if not is_deleting(holder)]
+                elif root == tmp_root:
+                    if (fname.startswith('pakit_cmd_stdout_') or
+                            fname.startswith('pakit_tmp_')) and \
+                            path != pakit.conf.TMP_DIR and is_stale(path):
+                        garbage.append((path, 'temporary'))
+                elif fname.startswith(tuple(pakit.conf.IDB_FILES.values())):
+                    continue
+                elif fname.startswith(STAGE_PREFIX) or \
+                        fname.endswith('_bak'):
+                    if is_stale(path):
+                        garbage.append((path, 'leftover'))
+                elif fname not in pakit.conf.IDB:
+                    if is_stale(path):
+                        garbage.append((path, 'not installed'))
+                elif root == source_root:
+                    if is_stale(path):
+                        garbage.append((path, 'source unused'))
+                    else:
+                        sources.append(path)
+                elif fname in pakit.recipe.RDB:
+                    recipe = pakit.recipe.RDB.get(fname)
+                    garbage += [(old, 'old version') for old in
+                                old_versions(recipe,
+                                             config.get('pakit.gc.keep'))]
+
+        return garbage + self.trim_sources(sources)
+
+    @staticmethod
+    def trim_sources(sources):
+        """
+        Select the least recently modified source trees to delete
+        until the rest fit in pakit.gc.max_source.
+
+        Args:
+            sources: The source trees left after the other checks.
+
+        Returns:
+            A list of (path, reason) pairs.
+        """
+        max_source = pakit.conf.CONFIG.get('pakit.gc.max_source')
+        if not max_source:
+            return []
+
+        sizes = dict((path, dir_size(path)) for path in sources)
+        total = sum(sizes.values())
+        garbage = []
+        for path in sorted(sources, key=lambda path: os.lstat(path).st_mtime):
+            if total <= max_source:
+                break
+            garbage.append((path, 'source over max_source'))
+            total -= sizes[path]
+
+        return garbage
+
+    def run(self):
+        """
+        Execute a set of operations to perform the Task.
+        """
+        logging.debug('Collecting Garbage')
+        garbage = self.find_garbage()
+        if not garbage:
+            if not self.background:
+                print('Nothing to delete')
+            return garbage
+
+        lines = ['{0:22} {1}'.format(reason, path)
+                 for path, reason in garbage]
+        if self.dry_run:
+            print('Would Delete:' + PREFIX + PREFIX.join(lines))
+            return garbage
+
+        holders = []
+        prefix = pakit.conf.CONFIG.path_to('prefix')
+        for path, reason in garbage:
+            USER.info('Deleting %s: %s', reason, path)
+            if reason == 'trash':
+                holders.append(path)
+                continue
+            try:
+                if reason == 'old version':
+                    holders.append(trash_path(path, prefix))
+                else:
+                    holders.append(trash_path(path))
+            except OSError:
+                logging.error('Could not delete path: %s', path)
+        empty_trash(holders, self.background)
+
+        if not self.background:
+            print('Deleted:' + PREFIX + PREFIX.join(lines))
+        return garbage
+
+
 def create_substring_matcher(case=False, names_only=False):
     """
     Use lexical scoping to modify the matcher.
@@ -442,37 +1087,88 @@ def create_substring_matcher(case=False, names_only=False):
     return substring_match
 
 
+def create_regex_matcher(case=False, names_only=False):
+    """
+    Like create_substring_matcher, but the words are regular expressions.
+
+    Args:
+        case: Toggles case sensitivity, default off.
+        names_only: Only match against names, default names & description.
+
+    Returns:
+        Matcher object.
+    """
+    flags = 0 if case else re.IGNORECASE
+
+    def regex_match(recipe, word):
+        """
+        Returns:
+            True iff the regular expression word matched the part of
+            the recipe matched against.
+        """
+        line = recipe.name if names_only else str(recipe)
+        return re.search(word, line, flags) is not None
+
+    return regex_match
+
+
 class SearchTask(Task):
     """
     Search the RecipeDB for matching recipes.
+
+    Matches for each word are ORed together, or ANDed with args.all.
+    Results are ranked by pakit.recipe.SearchIndex.score.
     """
     def __init__(self, args):
         super(SearchTask, self).__init__()
-        self.matcher = create_substring_matcher(args.case, args.names)
+        self.regex = args.regex
+        self.match_all = args.all
+        if self.regex:
+            self.matcher = create_regex_matcher(args.case, args.names)
+        else:
+            self.matcher = create_substring_matcher(args.case, args.names)
         self.words = args.words
 
     def matching_recipes(self):
         """
         Returns:
             A list of recipes that matched the query words with the
-            given matcher.
-        """
-        matched = []
+            given matcher, best match first.
 
-        for _, recipe in pakit.recipe.RDB:
-            for word in self.words:
-                if self.matcher(recipe, word):
-                    matched.append(str(recipe))
-                    break
+        Raises:
+            PakitDBError: A word was not a valid regular expression.
+        """
+        index = pakit.recipe.RDB.search_index
+        matched = None
+        for word in self.words:
+            if self.regex:
+                candidates = index.lines
+            else:
+                candidates = index.candidates(word)
 
-        return matched
+            try:
+                found = set([name for name in candidates if self.matcher(
+                    pakit.recipe.RDB.get(name), word)])
+            except re.error as exc:
+                raise PakitDBError('Bad regex {0}: {1}'.format(word, exc))
+
+            if matched is None:
+                matched = found
+            elif self.match_all:
+                matched = matched.intersection(found)
+            else:
+                matched = matched.union(found)
+
+        ranked = sorted(matched or [], key=lambda name: (
+            -index.score(name, self.words), name))
+        return [index.lines[name] for name in ranked]
 
     def run(self):
         """
         Execute a set of operations to perform the Task.
         """
         matched = ['Program      Description']
-        matched += sorted(self.matching_recipes())
+        matched += self.matching_recipes()
 
         msg = 'Your Search For:'
         msg += PREFIX + PREFIX.join(["'" + word + "'" for word in self.words])
@@ -309,6 +309,7 @@ setup(
     entry_points={
         'console_scripts': [
             'pakit = pakit.main:main',
+            'pakitd = pakit.daemon:main',
         ],
     },
 
@@ -0,0 +1,72 @@
+"""
+Benchmark the link engine in pakit.shell on a synthetic tree.
+
+Not collected by py.test, run it directly:
+    python tests/bench_link.py [NUM_FILES]
+"""
+from __future__ import absolute_import, print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pakit.shell import (
+    walk_and_link, walk_and_unlink, walk_and_unlink_all,
+    split_manifest, unlink_manifest
+)
+
+FILES_PER_DIR = 100
+DIRS_PER_DIR = 10
+
+
+def make_tree(root, num_files):
+    """
+    Create num_files empty files under root, spread over
+    nested folders of FILES_PER_DIR files each.
+    """
+    made = 0
+    dirs = [root]
+    while made < num_files:
+        cur = dirs.pop(0)
+        os.makedirs(cur)
+        for num in range(min(FILES_PER_DIR, num_files - made)):
+            open(os.path.join(cur, 'file' + str(num)), 'w').close()
+        made += FILES_PER_DIR
+        dirs.extend([os.path.join(cur, 'dir' + str(num))
+                     for num in range(DIRS_PER_DIR)])
+
+
+def timed(msg, func, *args):
+    """
+    Run func with args, print how long it took and return the result.
+    """
+    start = time.time()
+    ret = func(*args)
+    print('{0:<24} {1:8.3f}s'.format(msg, time.time() - start))
+    return ret
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    root = tempfile.mkdtemp(prefix='pakit_bench_')
+    src = os.path.join(root, 'builds', 'prog')
+    dst = os.path.join(root, 'links')
+    try:
+        timed('make_tree ({0})'.format(num_files), make_tree, src, num_files)
+        links = timed('walk_and_link', walk_and_link, src, dst)
+        timed('split_manifest', split_manifest, src, dst, links)
+        timed('walk_and_link linked', walk_and_link, src, dst, False, None,
+              links)
+        timed('unlink_manifest', unlink_manifest, dst, links)
+        walk_and_link(src, dst)
+        timed('walk_and_unlink', walk_and_unlink, src, dst)
+        walk_and_link(src, dst)
+        timed('walk_and_unlink_all', walk_and_unlink_all, dst,
+              os.path.join(root, 'builds'))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
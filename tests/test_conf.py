@@ -2,13 +2,18 @@
 Test pakit.conf
 """
 from __future__ import absolute_import, print_function
+import copy
 import os
 import subprocess as sub
 import mock
 import pytest
 
 import pakit.conf
-from pakit.conf import Config, InstallDB, RecipeURIDB, YamlDict, YamlNestedDict
+from pakit.conf import (
+    Config, InstallDB, RecipeURIDB, SqliteInstallDB, YamlDict, YamlNestedDict,
+    open_idb
+)
+from pakit.exc import PakitError
 import pakit.recipe
 import tests.common as tc
 
@@ -80,6 +85,45 @@ Filename: %s
         with open(self.dict.filename) as fin:
             assert fin.readlines() == ['hello: world\n']
 
+    def test_write_unchanged(self):
+        self.dict.write()
+        assert not self.dict.changed
+        os.remove(self.dict.filename)
+        self.dict.write()
+        assert not os.path.exists(self.dict.filename)
+
+        self.dict['c'] = {'inner': []}
+        self.dict.write()
+        self.dict['c']['inner'].append(1)
+        assert self.dict.changed
+        self.dict.write()
+        assert YamlDict(self.fname)['c'] == {'inner': [1]}
+
+    def test_write_atomic(self):
+        self.dict.write()
+        os.chmod(self.dict.filename, 0o600)
+        inode = os.stat(self.dict.filename).st_ino
+        self.dict['c'] = 'void'
+        self.dict.write()
+        assert os.stat(self.dict.filename).st_ino != inode
+        assert os.stat(self.dict.filename).st_mode & 0o777 == 0o600
+        assert [fname for fname in os.listdir(tc.STAGING)
+                if fname.startswith('.file.yaml')] == []
+
+    def test_batch(self):
+        with self.dict.batch():
+            self.dict.write()
+            with self.dict.batch():
+                self.dict.write()
+            assert not os.path.exists(self.dict.filename)
+        assert YamlDict(self.fname)['a'] == 11
+
+    def test_batch_error(self):
+        with pytest.raises(KeyError):
+            with self.dict.batch():
+                raise KeyError('a')
+        assert not os.path.exists(self.dict.filename)
+
 
 class TestYamlNestedDict(object):
     def setup(self):
@@ -112,6 +156,23 @@ class TestYamlNestedDict(object):
         assert 'c.inner' in self.dict
         assert 'does.not.exist' not in self.dict
 
+    def test_lookup(self):
+        assert self.dict.lookup['c'] == {'inner': 'world'}
+        assert self.dict.lookup['c.inner'] == 'world'
+        with pytest.raises(TypeError):
+            self.dict.lookup['c.inner'] = 'void'
+
+        self.dict['c.inner'] = 'void'
+        assert self.dict.lookup['c.inner'] == 'void'
+        self.dict.data = {'d': 1}
+        assert sorted(self.dict.lookup) == ['d']
+
+    def test_deepcopy(self):
+        assert self.dict['c.inner'] == 'world'
+        other = copy.deepcopy(self.dict)
+        other['c.inner'] = 'void'
+        assert self.dict['c.inner'] == 'world'
+
 
 class TestConfig(object):
     """ Test the operation of Config class. """
@@ -156,6 +217,19 @@ class TestConfig(object):
         opts = config.opts_for('ag')
         assert opts.get('repo') == 'unstable'
         assert opts.get('prefix') == '/tmp/test_pakit/builds'
+        opts['prefix'] = 'changed'
+        assert config.path_to('prefix') == '/tmp/test_pakit/builds'
+        assert config.opts_for('ag')['prefix'] == '/tmp/test_pakit/builds'
+
+    def test_read_cached(self):
+        self.config.write()
+        config = Config(self.config_file)
+        config['pakit.paths.prefix'] = 'changed'
+        assert Config(self.config_file).path_to('prefix') == \
+            self.config.path_to('prefix')
+
+        config.write()
+        assert Config(self.config_file).path_to('prefix') == 'changed'
 
     def test_reset(self):
         self.config['pakit.paths.prefix'] = 22
@@ -185,6 +259,104 @@ class TestInstallDB(object):
         self.idb.remove('ag')
         assert self.idb.get('ag') is None
 
+    def test_owners(self):
+        self.idb.add(self.recipe, ['bin/ag', 'share'])
+        assert self.idb.owners == {'bin/ag': 'ag', 'share': 'ag'}
+        self.idb['other'] = {'links': ['bin/other']}
+        assert self.idb.owners['bin/other'] == 'other'
+        self.idb.remove('ag')
+        assert self.idb.owners == {'bin/other': 'other'}
+
+    def test_add_requires(self):
+        self.idb.add(self.recipe)
+        assert self.idb.get('ag')['requires'] == []
+
+    def test_rdeps(self):
+        self.idb['lib'] = {'requires': []}
+        self.idb['app'] = {'requires': ['lib']}
+        self.idb['plugin'] = {'requires': ['app', 'other']}
+        assert self.idb.dependents['lib'] == ['app']
+        assert self.idb.rdeps(['lib']) == ['app', 'plugin']
+        assert self.idb.rdeps(['other']) == ['plugin']
+        assert self.idb.rdeps(['plugin']) == []
+        del self.idb['app']
+        assert self.idb.rdeps(['lib']) == []
+
+    def test_transaction(self):
+        with self.idb.transaction():
+            self.idb['lib'] = {'requires': []}
+            self.idb.write()
+            assert 'lib' not in type(self.idb)(self.idb_file)
+            self.idb['app'] = {'requires': ['lib']}
+        assert sorted(type(self.idb)(self.idb_file)) == ['app', 'lib']
+
+    def test_transaction_error(self):
+        self.idb['lib'] = {'requires': []}
+        self.idb.write()
+        with pytest.raises(KeyError):
+            with self.idb.transaction():
+                del self.idb['lib']
+                self.idb['app'] = {'requires': ['lib']}
+                raise KeyError('app')
+        assert sorted(self.idb) == ['lib']
+        assert sorted(type(self.idb)(self.idb_file)) == ['lib']
+
+
+class TestSqliteInstallDB(TestInstallDB):
+    def setup(self):
+        self.config = tc.CONF
+        self.idb_file = os.path.join(tc.STAGING, 'test_idb.db')
+        self.idb = SqliteInstallDB(self.idb_file)
+        self.recipe = pakit.recipe.RDB.get('ag')
+
+    def teardown(self):
+        self.idb.conn.close()
+        for suffix in ('', '-shm', '-wal'):
+            tc.delete_it(self.idb_file + suffix)
+
+    def test_concurrent_writers(self):
+        other = SqliteInstallDB(self.idb_file)
+        self.idb['lib'] = {'requires': []}
+        other['app'] = {'requires': ['lib']}
+        self.idb.write()
+        other.write()
+        assert sorted(SqliteInstallDB(self.idb_file)) == ['app', 'lib']
+
+    def test_stamp(self):
+        stamp = self.idb.stamp()
+        self.idb['lib'] = {'requires': []}
+        self.idb.write()
+        assert self.idb.stamp() == stamp
+
+        other = SqliteInstallDB(self.idb_file)
+        del other['lib']
+        other.write()
+        assert self.idb.stamp() != stamp
+
+    def test_migrate(self):
+        yaml_file = os.path.join(tc.STAGING, 'test_idb.yml')
+        old_db = InstallDB(yaml_file)
+        old_db['ag'] = {'hash': 'abc', 'requires': []}
+        old_db.write()
+        try:
+            assert self.idb.migrate(yaml_file)
+            assert not os.path.exists(yaml_file)
+            assert SqliteInstallDB(self.idb_file)['ag']['hash'] == 'abc'
+            assert not self.idb.migrate(yaml_file + '.bak')
+        finally:
+            tc.delete_it(yaml_file)
+            tc.delete_it(yaml_file + '.bak')
+
+
+def test_open_idb():
+    config = copy.deepcopy(tc.CONF)
+    assert isinstance(open_idb(config), SqliteInstallDB)
+    config['pakit.idb.backend'] = 'yaml'
+    assert type(open_idb(config)) is InstallDB
+    config['pakit.idb.backend'] = 'xml'
+    with pytest.raises(PakitError):
+        open_idb(config)
+
 
 class TestRecipeURIDB(object):
     def setup(self):
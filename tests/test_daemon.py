@@ -0,0 +1,92 @@
+"""
+Test pakit.daemon
+"""
+from __future__ import absolute_import
+import io
+import json
+import os
+import threading
+import mock
+
+from pakit.daemon import MessageWriter, PakitServer, connect, forward
+import tests.common as tc
+
+
+def test_forward_no_server():
+    path = os.path.join(tc.STAGING, 'nothing.sock')
+    assert forward(['pakit', 'list'], tc.TEST_CONFIG, path) is None
+
+
+def test_message_writer():
+    wfile = io.BytesIO()
+    out = MessageWriter(wfile)
+    out.write('hello')
+    out.write('')
+    out.send(exit=0)
+    msgs = [json.loads(line.decode('utf-8'))
+            for line in wfile.getvalue().splitlines()]
+    assert msgs == [{'out': 'hello'}, {'exit': 0}]
+
+
+class TestPakitServer(object):
+    def setup(self):
+        self.path = os.path.join(tc.STAGING, 'pakitd.sock')
+        self.server = PakitServer(self.path, tc.TEST_CONFIG)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        tc.delete_it(self.path)
+
+    def request(self, argv, conf=None):
+        """
+        Send a command to the server, return all messages received.
+        """
+        sock = connect(self.path)
+        request = {
+            'argv': argv,
+            'conf': conf or tc.TEST_CONFIG,
+            'cwd': os.getcwd(),
+        }
+        try:
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            return [json.loads(line.decode('utf-8'))
+                    for line in sock.makefile('rb')]
+        finally:
+            sock.close()
+
+    def test_socket_private(self):
+        assert os.stat(self.path).st_mode & 0o777 == 0o600
+
+    def test_run_command(self):
+        msgs = self.request(['pakit', 'available', '--short'])
+        assert msgs[-1] == {'exit': 0}
+        output = ''.join([msg.get('out', '') for msg in msgs])
+        assert 'ag' in output.split()
+
+    def test_bad_args(self):
+        msgs = self.request(['pakit', 'hello'])
+        assert msgs[-1] == {'exit': 2}
+
+    def test_refused(self):
+        msgs = self.request(['pakit', 'list'], os.path.join(tc.STAGING, 'x'))
+        assert msgs == [{'refused': os.path.realpath(tc.TEST_CONFIG)}]
+
+    def test_refresh_config(self):
+        self.request(['pakit', 'list'])
+        stamp = self.server.stamps[self.server.conf]
+        os.utime(self.server.conf, (stamp + 10, stamp + 10))
+        try:
+            self.server.refresh()
+            assert self.server.stamps[self.server.conf] == stamp + 10
+        finally:
+            os.utime(self.server.conf, (stamp, stamp))
+            self.server.refresh()
+
+    @mock.patch('pakit.recipe.RecipeManager.refresh_in_background')
+    def test_refresh_recipes(self, mock_refresh):
+        self.server.refresh()
+        mock_refresh.assert_called_with(self.server.conf)
@@ -4,6 +4,9 @@ Test pakit.graph
 from __future__ import absolute_import, print_function
 import string
 
+import pytest
+
+from pakit.exc import CycleInGraphError
 from pakit.graph import DiGraph, topological_sort
 
 
@@ -93,6 +96,41 @@ class TestDiGraph(object):
         print(self.graph)
         assert self.graph.size == 3
 
+    def test_remove_reverse_index(self):
+        self.graph.add_vertex('A')
+        self.graph.add_vertex('B')
+        self.graph.add_vertex('C')
+        self.graph.add_edges('A', ['B', 'C'])
+        assert self.graph.rev_lists['B'] == set(['A'])
+        self.graph.remove('A')
+        assert self.graph.rev_lists['B'] == set()
+        assert self.graph.rev_lists['C'] == set()
+        assert 'A' not in self.graph.rev_lists
+
+    def test_add_vertex_resets_edges(self):
+        self.graph.add_vertex('A')
+        self.graph.add_vertex('B')
+        self.graph.add_edge('A', 'B')
+        self.graph.add_vertex('A')
+        assert not self.graph.is_connected('A', 'B')
+        assert self.graph.rev_lists['B'] == set()
+
+    def test_find_cycle(self):
+        for char in 'ABCD':
+            self.graph.add_vertex(char)
+        self.graph.add_edge('A', 'B')
+        self.graph.add_edge('B', 'C')
+        self.graph.add_edge('C', 'D')
+        self.graph.add_edge('D', 'B')
+        assert self.graph.find_cycle() == ['B', 'C', 'D', 'B']
+
+    def test_find_cycle_none(self):
+        for char in 'ABC':
+            self.graph.add_vertex(char)
+        self.graph.add_edges('A', ['B', 'C'])
+        self.graph.add_edge('B', 'C')
+        assert self.graph.find_cycle() == []
+
 
 class TestTopologicalSort(object):
     def setup(self):
@@ -112,6 +150,37 @@ class TestTopologicalSort(object):
 
     def test_topological_sort(self):
         print(self.graph)
+        edges = [(key, adj) for key in self.graph.adj_lists
+                 for adj in self.graph.adj_lists[key]]
         top_list = list(topological_sort(self.graph))
         assert len(top_list) == 8
         assert self.graph.size == 0
+        for key, adj in edges:
+            assert top_list.index(adj) < top_list.index(key)
+
+    def test_topological_sort_order(self):
+        top_list = list(topological_sort(self.graph))
+        assert top_list == ['H', 'F', 'G', 'C', 'D', 'E', 'A', 'B']
+
+    def test_topological_sort_cycle(self):
+        self.graph.add_edge('H', 'A')
+        with pytest.raises(CycleInGraphError) as exc:
+            list(topological_sort(self.graph))
+        assert 'A -> D -> G -> H -> A' in str(exc.value)
+
+    def test_topological_sort_missing(self):
+        self.graph.add_edge('H', 'Z')
+        with pytest.raises(CycleInGraphError) as exc:
+            list(topological_sort(self.graph))
+        assert 'Missing dependencies: Z' in str(exc.value)
+
+    def test_topological_sort_long_chain(self):
+        num_verts = 20000
+        graph = DiGraph()
+        for num in range(num_verts):
+            graph.add_vertex(str(num))
+            if num:
+                graph.add_edge(str(num), str(num - 1))
+
+        top_list = list(topological_sort(graph))
+        assert top_list == [str(num) for num in range(num_verts)]
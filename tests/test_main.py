@@ -4,23 +4,28 @@ Test pakit.main
 from __future__ import absolute_import
 import os
 import shutil
+import subprocess
+import sys
 import mock
 import pytest
 
 import pakit.conf
+from pakit.conf import InstallDB, open_idb
 from pakit.exc import PakitError
 from pakit.main import (
-    create_args_parser, environment_check, main,
-    search_for_config, order_tasks
+    create_args_parser, environment_check, main, read_search_cache,
+    run_tasks, search_cache_file, search_for_config, order_tasks
 )
 import pakit.recipe
 from pakit.task import (
     InstallTask, RemoveTask, UpdateTask, DisplayTask,
-    ListInstalled, ListAvailable, SearchTask, RelinkRecipes,
-    CreateConfig, PurgeTask
+    ListInstalled, ListAvailable, ListDependents, SearchTask, RelinkRecipes,
+    CreateConfig, PurgeTask, GCTask
 )
 import tests.common as tc
 
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 
 @mock.patch('pakit.main.PLOG')
 def test_environment_check(mock_log):
@@ -35,6 +40,53 @@ def test_environment_check(mock_log):
     os.environ['PATH'] = old_path
 
 
+def startup_modules(args):
+    """
+    Run pakit with args in a fresh interpreter, without pakitd.
+
+    Returns:
+        The names of the modules loaded and True iff the recipes were
+        never indexed.
+    """
+    script = (
+        'import sys, pakit.main\n'
+        'try:\n'
+        '    pakit.main.main(["pakit"] + sys.argv[1:])\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        'mod = sys.modules.get("pakit.recipe")\n'
+        'rdb = mod.RDB if type(mod).__name__ == "module" else None\n'
+        'print("PENDING", bool(rdb and rdb.pending))\n'
+        'print("MODULES", " ".join(name for name, mod in sys.modules.items()\n'
+        '      if type(mod).__name__ != "_LazyModule"))\n'
+    )
+    env = dict(os.environ, PYTHONPATH=ROOT,
+               PAKITD_SOCKET=os.path.join(tc.STAGING, 'nothing.sock'))
+    proc = subprocess.Popen([sys.executable, '-c', script] + args, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    out, err = proc.communicate()
+    assert proc.returncode == 0, err
+
+    lines = out.splitlines()
+    return lines[-1].split()[1:], lines[-2] == 'PENDING True'
+
+
+def test_startup_version():
+    loaded, _ = startup_modules(['--version'])
+    for name in ('pakit.recipe', 'pakit.shell', 'pakit.task', 'sqlite3',
+                 'tarfile', 'urllib.request', 'yaml', 'zipfile'):
+        assert name not in loaded
+
+
+def test_startup_list_short():
+    loaded, pending = startup_modules(['--conf', tc.TEST_CONFIG, 'list',
+                                       '--short'])
+    assert pending
+    for name in ('tarfile', 'urllib.request', 'zipfile'):
+        assert name not in loaded
+
+
 class TestSearchConfig(object):
     def setup(self):
         self.orig_dir = os.getcwd()
@@ -47,6 +99,10 @@ class TestSearchConfig(object):
         self.home_pakit_conf = os.path.join(os.path.expanduser('~'), '.pakit',
                                             '.pakit.yaml')
 
+        self.old_env = dict(os.environ)
+        os.environ.pop('PAKIT_CONFIG', None)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(tc.STAGING, 'cache')
+
         os.makedirs(os.path.dirname(self.third_conf))
         try:
             os.makedirs(os.path.dirname(self.home_pakit_conf))
@@ -60,7 +116,10 @@ class TestSearchConfig(object):
         os.chdir(os.path.dirname(self.third_conf))
 
     def teardown(self):
+        os.environ.clear()
+        os.environ.update(self.old_env)
         os.chdir(self.orig_dir)
+        tc.delete_it(os.path.join(tc.STAGING, 'cache'))
         tc.delete_it(self.test_dir)
         tc.delete_it(self.home_conf)
         tc.delete_it(self.home_pakit_conf)
@@ -104,6 +163,31 @@ class TestSearchConfig(object):
         tc.delete_it(self.home_pakit_conf)
         assert search_for_config(1) == 1
 
+    def test_search_config_env(self):
+        os.environ['PAKIT_CONFIG'] = tc.TEST_CONFIG
+        assert search_for_config() == tc.TEST_CONFIG
+
+    @mock.patch('pakit.main.SEARCH_CACHE_RACY', -1)
+    def test_search_config_cached(self):
+        tc.delete_it(self.third_conf)
+        assert search_for_config() == self.second_conf
+        cache = read_search_cache(search_cache_file())
+        assert cache[os.path.dirname(self.second_conf)][1] == \
+            self.second_conf
+        assert cache[os.getcwd()][1] is None
+
+        with mock.patch('pakit.main.os.path.exists') as mock_exists:
+            assert search_for_config() == self.second_conf
+            assert not mock_exists.called
+
+        shutil.copy(tc.TEST_CONFIG, self.third_conf)
+        assert search_for_config() == self.third_conf
+
+    def test_search_config_racy(self):
+        assert search_for_config() == self.third_conf
+        cache = read_search_cache(search_cache_file())
+        assert os.getcwd() not in cache
+
 
 class TestOrderTasks(object):
     def test_no_requires(self):
@@ -141,6 +225,23 @@ class TestParseTasks(object):
         assert tasks[0] == RemoveTask('ag')
         assert isinstance(tasks[0], RemoveTask)
 
+    @mock.patch('pakit.main.PLOG')
+    def test_parse_remove_required(self, mock_plog):
+        pakit.conf.IDB.data = {'ag': {'requires': []},
+                               'ack': {'requires': ['ag']}}
+        args = self.parser.parse_args('remove ag'.split())
+        with pytest.raises(SystemExit) as exc:
+            args.func(args)
+        assert exc.value.code == 1
+        mock_plog.assert_any_call('Required by installed recipe(s): ack')
+
+    def test_parse_remove_cascade(self):
+        pakit.conf.IDB.data = {'ag': {'requires': []},
+                               'ack': {'requires': ['ag']}}
+        args = self.parser.parse_args('remove --cascade ag'.split())
+        tasks = args.func(args)
+        assert tasks == [RemoveTask('ack'), RemoveTask('ag')]
+
     def test_parse_update(self):
         """
         Not ideal, but mucking around internally saves hassle.
@@ -198,6 +299,25 @@ class TestParseTasks(object):
         args = self.parser.parse_args('relink'.split())
         tasks = args.func(args)
         assert isinstance(tasks[0], RelinkRecipes)
+        assert tasks[0].recipes == []
+
+    def test_parse_relink_recipes(self):
+        args = self.parser.parse_args('relink ag vim'.split())
+        tasks = args.func(args)
+        assert tasks[0].recipes == ['ag', 'vim']
+
+    def test_parse_update_dependents(self):
+        pakit.conf.IDB.data = {'ag': {'requires': []},
+                               'ack': {'requires': ['ag']}}
+        args = self.parser.parse_args('update ag'.split())
+        tasks = args.func(args)
+        assert tasks == [UpdateTask('ag'), UpdateTask('ack')]
+
+    def test_parse_rdeps(self):
+        args = self.parser.parse_args('rdeps ag'.split())
+        tasks = args.func(args)
+        assert isinstance(tasks[0], ListDependents)
+        assert tasks[0].recipe == 'ag'
 
     def test_parse_search(self):
         args = self.parser.parse_args('search ag'.split())
@@ -209,6 +329,12 @@ class TestParseTasks(object):
         tasks = args.func(args)
         assert isinstance(tasks[0], CreateConfig)
 
+    def test_parse_gc(self):
+        args = self.parser.parse_args('gc --dry-run'.split())
+        tasks = args.func(args)
+        assert isinstance(tasks[0], GCTask)
+        assert tasks[0].dry_run
+
     def test_parse_purge(self):
         args = self.parser.parse_args('purge'.split())
         tasks = args.func(args)
@@ -255,6 +381,68 @@ class TestMain(object):
         main(['pakit', '--conf', tc.TEST_CONFIG, 'list'])
         mock_log.error.assert_any_call("Pakit can't do much without it!")
 
+    @mock.patch('pakit.main.PLOG')
+    def test_run_tasks_transaction(self, _):
+        def add_recipe(name):
+            pakit.conf.IDB[name] = {'requires': []}
+            pakit.conf.IDB.write()
+
+        def fail_recipe():
+            add_recipe('app')
+            raise PakitError('Just throw.')
+
+        tasks = [mock.Mock(), mock.Mock()]
+        tasks[0].run.side_effect = lambda: add_recipe('lib')
+        tasks[1].run.side_effect = fail_recipe
+        try:
+            with pytest.raises(PakitError):
+                run_tasks(mock.Mock(func=lambda _: tasks))
+            assert 'lib' in pakit.conf.IDB
+            assert 'app' not in pakit.conf.IDB
+            saved = open_idb(pakit.conf.CONFIG)
+            assert 'lib' in saved and 'app' not in saved
+        finally:
+            with pakit.conf.IDB.transaction():
+                del pakit.conf.IDB['lib']
+
+    @mock.patch('pakit.main.PLOG')
+    def test_run_tasks_write_per_task(self, _):
+        old_idb = pakit.conf.IDB
+        pakit.conf.IDB = InstallDB(os.path.join(tc.STAGING, 'batch_idb.yml'))
+
+        def add_recipe(name):
+            pakit.conf.IDB[name] = {'requires': []}
+            pakit.conf.IDB.write()
+            pakit.conf.IDB[name] = {'requires': [], 'links': []}
+            pakit.conf.IDB.write()
+
+        tasks = [mock.Mock() for _ in range(3)]
+        for name, task in zip(['lib', 'app', 'plugin'], tasks):
+            task.run.side_effect = lambda name=name: add_recipe(name)
+        try:
+            with mock.patch.object(pakit.conf.IDB, 'commit') as mock_commit:
+                run_tasks(mock.Mock(func=lambda _: tasks))
+            assert mock_commit.call_count == 3
+        finally:
+            pakit.conf.IDB = old_idb
+            tc.delete_it(os.path.join(tc.STAGING, 'batch_idb.yml'))
+
+    @mock.patch('pakit.main.pakit.daemon.forward')
+    def test_forward_read_only(self, mock_forward):
+        mock_forward.return_value = 0
+        main(['pakit', '--conf', tc.TEST_CONFIG, 'list'])
+        assert mock_forward.called
+
+    @mock.patch('pakit.main.PLOG')
+    @mock.patch('pakit.main.pakit.daemon.forward')
+    def test_forward_not_install(self, mock_forward, _):
+        main(['pakit', '--conf', tc.TEST_CONFIG, 'install', 'iiiii'])
+        assert not mock_forward.called
+
+    def test_config_which(self, mock_print):
+        main(['pakit', '--conf', tc.TEST_CONFIG, 'config', '--which'])
+        mock_print.assert_called_with(tc.TEST_CONFIG)
+
     @mock.patch('pakit.main.PLOG')
     def test_recipe_not_found(self, mock_plog):
         expect = 'Missing recipe to build: iiiii'
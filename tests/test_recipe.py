@@ -9,12 +9,14 @@ import tempfile
 import mock
 import pytest
 
+from pakit.conf import RecipeURIDB
 from pakit.exc import PakitError
 import pakit.recipe
 from pakit.recipe import (
-    Recipe, RecipeDB, RecipeManager, check_package,
-    DecChangeDir, DecPrePost
+    Recipe, RecipeDB, RecipeManager, SearchIndex, check_package,
+    raise_first, trigrams, DecChangeDir, DecPrePost
 )
+from pakit.shell import try_lock
 import tests.common as tc
 
 
@@ -171,6 +173,12 @@ class TestRecipe(object):
     def test_install_dir(self):
         self.recipe.install_dir == self.config.path_to('prefix')
 
+    def test_install_root(self):
+        root = os.path.join(self.config.path_to('prefix'), 'ag')
+        assert self.recipe.install_root == root
+        assert self.recipe.current_link == os.path.join(root, 'current')
+        assert self.recipe.version_dir('abc') == os.path.join(root, 'abc')
+
     def test_link_dir(self):
         self.recipe.link_dir == self.config.path_to('link')
 
@@ -186,12 +194,14 @@ class TestRecipe(object):
 
     def test_cmd_str(self):
         cmd = self.recipe.cmd('echo {prefix}')
-        expect = [os.path.join(self.config.path_to('prefix'), 'ag')]
+        expect = [os.path.join(self.config.path_to('prefix'), 'ag',
+                               'current')]
         assert cmd.output() == expect
 
     def test_cmd_list(self):
         cmd = self.recipe.cmd('echo {prefix}'.split())
-        expect = [os.path.join(self.config.path_to('prefix'), 'ag')]
+        expect = [os.path.join(self.config.path_to('prefix'), 'ag',
+                               'current')]
         assert cmd.output() == expect
 
     def test_cmd_dir_arg(self):
@@ -215,6 +225,39 @@ class TestRecipe(object):
         mock_cmd.assert_called_with(1)
 
 
+class TestSearchIndex(object):
+    def setup(self):
+        self.index = SearchIndex(pakit.recipe.RDB)
+
+    def test_trigrams(self):
+        assert trigrams('grep') == set(['gre', 'rep'])
+        assert trigrams('ag') == set()
+
+    def test_candidates(self):
+        candidates = self.index.candidates('Grep Like')
+        assert 'ag' in candidates
+        assert 'vim' not in candidates
+
+    def test_candidates_long_name(self):
+        index = SearchIndex([('silversearcher_ag',
+                              pakit.recipe.RDB.get('ag'))])
+        assert index.candidates('searcher') == set(['silversearcher_ag'])
+
+    def test_candidates_short(self):
+        assert self.index.candidates('g') == set(self.index.lines)
+
+    def test_score(self):
+        assert self.index.score('ag', ['ag']) > \
+            self.index.score('ag', ['grep'])
+        assert self.index.score('ag', ['grep']) > \
+            self.index.score('ag', ['vim'])
+
+    def test_rdb_search_index(self):
+        index = pakit.recipe.RDB.search_index
+        assert index is pakit.recipe.RDB.search_index
+        assert index.lines['ag'] == str(pakit.recipe.RDB.get('ag'))
+
+
 class TestRecipeDB(object):
     def test__contains__(self):
         assert 'ag' in pakit.recipe.RDB
@@ -246,6 +289,38 @@ class TestRecipeDB(object):
         rdb.index(test_recipes)
         assert 'cyclea' in rdb
 
+    def test_closure(self):
+        closure = pakit.recipe.RDB.closure('dependsonb')
+        assert closure == frozenset(['dependsonb', 'providesb'])
+        assert pakit.recipe.RDB.closures['dependsonb'] is closure
+        assert pakit.recipe.RDB.closure('dependsonb') is closure
+
+    def test_closure_file_changed(self):
+        test_uri = tc.CONF.get('pakit.recipe.uris')[1]['uri']
+        test_recipes = os.path.join(tc.CONF.path_to('recipes'),
+                                    os.path.basename(test_uri))
+        rdb = RecipeDB(tc.CONF)
+        rdb.index(test_recipes)
+        closure = rdb.closure('dependsonb')
+
+        fname, mtime = rdb.files['providesb']
+        os.utime(fname, (mtime + 10, mtime + 10))
+        try:
+            assert rdb.changed('providesb')
+            assert rdb.closure('dependsonb') is not closure
+            assert not rdb.changed('providesb')
+        finally:
+            os.utime(fname, (mtime, mtime))
+
+    def test_resolve(self):
+        graph = pakit.recipe.RDB.resolve(['dependsonb', 'providesb'])
+        assert sorted(graph.adj_lists) == ['dependsonb', 'providesb']
+        assert graph.rev_lists['providesb'] == set(['dependsonb'])
+
+    def test_resolve_not_found(self):
+        with pytest.raises(PakitError):
+            pakit.recipe.RDB.resolve(['xyzxyz'])
+
     def test_recipe_obj(self):
         recipes_path = os.path.join(tc.CONF.path_to('recipes'), 'test_recipes')
         try:
@@ -322,6 +397,27 @@ class TestRecipeManager(object):
         self.manager.init_new_uris()
         assert self.manager.paths == expect
 
+    def test_init_new_uris_concurrent_managers(self):
+        self.manager = RecipeManager(self.config)
+        self.config['pakit.recipe.uris'] = [{'uri': 'user_recipes'}]
+        other = RecipeManager(self.config)
+        self.manager.init_new_uris()
+        other.init_new_uris()
+
+        uri_db = RecipeURIDB(self.manager.uri_db.filename)
+        assert sorted(uri_db) == sorted([self.git_uri, 'user_recipes'])
+
+    def test_fetch_repos(self):
+        self.manager = RecipeManager(self.config)
+        good, bad = mock.MagicMock(), mock.MagicMock()
+        bad.__enter__.side_effect = PakitError('Failed')
+        errors = self.manager.fetch_repos({'good': good, 'bad': bad})
+        assert good.__enter__.called
+        assert errors['good'] is None
+        assert isinstance(errors['bad'], PakitError)
+        with pytest.raises(PakitError):
+            raise_first(errors)
+
     def test_check_for_deletions(self):
         self.manager = RecipeManager(self.config)
         self.manager.init_new_uris()
@@ -345,6 +441,61 @@ class TestRecipeManager(object):
         self.manager.check_for_updates()
         assert self.manager.uri_db[self.git_uri]['time'] != old_time
 
+    def test_stale_uris(self):
+        self.manager = RecipeManager(self.config)
+        self.manager.init_new_uris()
+        assert self.manager.stale_uris() == []
+        interval = self.config.get('pakit.recipe.update_interval')
+        self.manager.uri_db[self.git_uri]['time'] -= 2 * interval
+        assert self.manager.stale_uris() == [self.git_uri]
+
+    def stale_manager(self):
+        """
+        Clone the git uri and age it past the update interval.
+        Popen is only mocked after cloning, Command uses it too.
+        """
+        self.manager = RecipeManager(self.config)
+        self.manager.init_new_uris()
+        interval = self.config.get('pakit.recipe.update_interval')
+        self.manager.uri_db[self.git_uri]['time'] -= 2 * interval
+
+    def test_refresh_in_background(self):
+        self.manager = RecipeManager(self.config)
+        self.manager.init_new_uris()
+        with mock.patch('pakit.recipe.subprocess.Popen') as mock_popen:
+            assert not self.manager.refresh_in_background(tc.TEST_CONFIG)
+            assert not mock_popen.called
+
+        self.stale_manager()
+        with mock.patch('pakit.recipe.subprocess.Popen') as mock_popen:
+            assert self.manager.refresh_in_background(tc.TEST_CONFIG)
+        assert mock_popen.call_args[0][0][-1] == tc.TEST_CONFIG
+
+    def test_refresh_in_background_relative(self):
+        self.stale_manager()
+        old_cwd = os.getcwd()
+        os.chdir(os.path.dirname(tc.TEST_CONFIG))
+        try:
+            relative = os.path.basename(tc.TEST_CONFIG)
+            with mock.patch('pakit.recipe.subprocess.Popen') as mock_popen:
+                assert self.manager.refresh_in_background(relative)
+        finally:
+            os.chdir(old_cwd)
+        assert mock_popen.call_args[0][0][-1] == \
+            os.path.abspath(tc.TEST_CONFIG)
+        assert mock_popen.call_args[1]['cwd'] == '/'
+
+    def test_refresh_in_background_locked(self):
+        self.stale_manager()
+        lock = try_lock(self.manager.lock_file)
+        try:
+            with mock.patch('pakit.recipe.subprocess.Popen') as mock_popen:
+                assert not self.manager.refresh_in_background(
+                    tc.TEST_CONFIG)
+            assert not mock_popen.called
+        finally:
+            lock.close()
+
     def test_check_for_updates_kwargs(self):
         self.manager = RecipeManager(self.config)
         self.manager.init_new_uris()
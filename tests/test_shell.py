@@ -2,7 +2,9 @@
 Test pakit.shell
 """
 from __future__ import absolute_import, print_function
+import io
 import os
+import tarfile
 import mock
 import pytest
 
@@ -13,10 +15,14 @@ from pakit.exc import (
 import pakit.shell
 from pakit.shell import (
     Archive, Dummy, Git, Hg, Command, hash_archive,
-    common_suffix, cmd_cleanup, get_extract_func, extract_tar_gz,
+    common_suffix, cmd_cleanup, get_extract_func, extract_tar,
+    extract_tar_zst,
     walk_and_link, walk_and_unlink, walk_and_unlink_all, vcs_factory,
+    split_manifest, unlink_manifest,
     write_config, link_man_pages, unlink_man_pages, user_input,
-    check_connectivity
+    check_connectivity, sniff_mimetype, balance_by_size,
+    trash_path, empty_trash, delete_later, wait_deletions, remove_tree,
+    remove_quietly, dir_size, try_lock, check_tar_member, TRASH_DIR
 )
 from pakit.shell import ulib
 import tests.common as tc
@@ -87,7 +93,7 @@ def test_unlink_man_pages():
 
 
 def test_get_extract_func():
-    assert get_extract_func(tc.TAR_FILE) is extract_tar_gz
+    assert get_extract_func(tc.TAR_FILE) is extract_tar
 
 
 def test_get_extract_func_not_found():
@@ -95,6 +101,112 @@ def test_get_extract_func_not_found():
         get_extract_func(tc.TEST_CONFIG)
 
 
+def test_sniff_mimetype():
+    assert sniff_mimetype(b'\x1f\x8b\x08\x00') == 'application/gzip'
+    assert sniff_mimetype(b'PK\x03\x04\x14\x00') == 'application/zip'
+    assert sniff_mimetype(b'\x00' * 257 + b'ustar\x00') == 'application/x-tar'
+    assert sniff_mimetype(b'hello') == 'application/octet-stream'
+
+
+def test_balance_by_size():
+    sizes = [9, 1, 7, 3, 5, 5]
+    groups = balance_by_size(sizes, 2, lambda size: size)
+    assert sorted(sum(groups, [])) == sorted(sizes)
+    assert sorted(sum(group) for group in groups) == [15, 15]
+    assert balance_by_size(sizes, 10, lambda size: size) == \
+        [[size] for size in sorted(sizes, reverse=True)]
+    assert balance_by_size([], 4, lambda size: size) == [[]]
+
+
+def test_trash_path():
+    path = os.path.join(tc.STAGING, 'to_trash')
+    try:
+        os.makedirs(os.path.join(path, 'sub'))
+        holder = trash_path(path)
+        assert not os.path.exists(path)
+        assert os.path.dirname(holder) == os.path.join(tc.STAGING, TRASH_DIR)
+        assert os.listdir(holder) == ['to_trash']
+        empty_trash([holder])
+        assert not os.path.exists(holder)
+    finally:
+        tc.delete_it(os.path.join(tc.STAGING, TRASH_DIR))
+
+
+def test_remove_tree():
+    path = os.path.join(tc.STAGING, 'to_remove')
+    keep = os.path.join(tc.STAGING, 'to_keep')
+    try:
+        os.makedirs(os.path.join(path, 'sub', 'subsub'))
+        os.makedirs(keep)
+        with open(os.path.join(keep, 'file'), 'w') as fout:
+            fout.write('keep')
+        os.symlink(keep, os.path.join(path, 'sub', 'link'))
+        remove_tree(path)
+        assert not os.path.exists(path)
+        assert os.listdir(keep) == ['file']
+        remove_tree(path)
+    finally:
+        tc.delete_it(path)
+        tc.delete_it(keep)
+
+
+def test_delete_later():
+    path = os.path.join(tc.STAGING, 'to_delete')
+    try:
+        os.makedirs(os.path.join(path, 'sub'))
+        future = delete_later(path)
+        assert not os.path.exists(path)
+        future.result()
+        wait_deletions()
+        assert os.listdir(os.path.join(tc.STAGING, TRASH_DIR)) == []
+        assert delete_later(path) is None
+    finally:
+        tc.delete_it(os.path.join(tc.STAGING, TRASH_DIR))
+
+
+@mock.patch('pakit.shell.logging')
+@mock.patch('pakit.shell.remove_tree')
+def test_remove_quietly_gone(mock_remove, mock_log):
+    mock_remove.side_effect = OSError(2, 'No such file or directory')
+    remove_quietly(os.path.join(tc.STAGING, 'never_made'))
+    assert not mock_log.error.called
+
+    remove_quietly(tc.STAGING)
+    assert mock_log.error.called
+
+
+def test_delete_later_missing():
+    path = os.path.join(tc.STAGING, 'never_made')
+    assert delete_later(path) is None
+    assert not os.path.exists(os.path.join(tc.STAGING, TRASH_DIR))
+
+
+def test_dir_size():
+    path = os.path.join(tc.STAGING, 'sized')
+    try:
+        os.makedirs(os.path.join(path, 'sub'))
+        for fname, size in (('a', 10), (os.path.join('sub', 'b'), 20)):
+            with open(os.path.join(path, fname), 'wb') as fout:
+                fout.write(b'x' * size)
+        assert dir_size(path) == 30
+    finally:
+        tc.delete_it(path)
+
+
+def test_try_lock():
+    path = os.path.join(tc.STAGING, 'test.lock')
+    lock = try_lock(path)
+    try:
+        assert lock is not None
+        assert try_lock(path) is None
+        lock.close()
+        lock = try_lock(path)
+        assert lock is not None
+    finally:
+        lock.close()
+        tc.delete_it(path)
+
+
 def test_hash_archive_sha256():
     expect_hash = ('795f4b4446b0ea968b9201c25e8c1ef8a6ade710ebca4657dd879c'
                    '35916ad362')
@@ -117,6 +229,23 @@ def test_common_suffix():
     assert common_suffix(path2, path1) == path1[1:]
 
 
+def test_check_tar_member():
+    tmp_dir = os.path.join(tc.STAGING, 'members')
+    check_tar_member(tarfile.TarInfo('src/main.c'), tmp_dir)
+
+    link = tarfile.TarInfo('src/lib')
+    link.type, link.linkname = tarfile.SYMTYPE, '../include'
+    check_tar_member(link, tmp_dir)
+
+    for name, linkname in [('/etc/passwd', None), ('src/../../x', None),
+                           ('src/lib', '../../x'), ('src/lib', '/etc')]:
+        info = tarfile.TarInfo(name)
+        if linkname:
+            info.type, info.linkname = tarfile.SYMTYPE, linkname
+        with pytest.raises(PakitError):
+            check_tar_member(info, tmp_dir)
+
+
 def test_vcs_factory():
     print(os.listdir('/tmp'))
     repo = vcs_factory(tc.GIT)
@@ -187,6 +316,40 @@ class TestLinking(object):
             assert os.path.islink(fname)
             assert os.readlink(fname) == fname.replace(self.dst, self.src)
 
+    def test_walk_and_link_manifest(self):
+        links = walk_and_link(self.src, self.dst)
+        assert sorted(links) == sorted([os.path.relpath(fname, self.dst)
+                                        for fname in self.dst_fnames])
+
+    def test_walk_and_link_fold(self):
+        links = walk_and_link(self.src, self.dst, fold=True)
+        subdir = self.subdir.replace(self.src, self.dst)
+        assert os.path.islink(subdir)
+        assert os.path.relpath(subdir, self.dst) in links
+        for fname in self.dst_fnames:
+            assert os.path.exists(fname)
+
+    def test_walk_and_link_unfold(self):
+        other = os.path.join(tc.STAGING, 'other')
+        try:
+            os.makedirs(os.path.join(other, 'subdir'))
+            with open(os.path.join(other, 'subdir', 'other'), 'w') as fout:
+                fout.write('other')
+
+            walk_and_link(self.src, self.dst, fold=True)
+            unfolded = {}
+            links = walk_and_link(other, self.dst, True, unfolded)
+            subdir = self.subdir.replace(self.src, self.dst)
+            assert not os.path.islink(subdir)
+            assert links == [os.path.join('subdir', 'other')]
+            assert unfolded == {'subdir': [os.path.join('subdir', 'file' +
+                                                        str(num))
+                                           for num in range(0, 4)]}
+            for fname in self.dst_fnames:
+                assert os.path.islink(fname)
+        finally:
+            tc.delete_it(other)
+
     def test_walk_and_link_raises(self):
         walk_and_link(self.src, self.dst)
         with pytest.raises(PakitLinkError):
@@ -213,6 +376,17 @@ class TestLinking(object):
             assert os.path.exists(fname)
         assert os.path.exists(self.dst)
 
+    def test_walk_and_unlink_src_twice(self):
+        nested = self.src + self.src
+        os.makedirs(nested)
+        with open(os.path.join(nested, 'file'), 'w') as fout:
+            fout.write('dummy')
+
+        walk_and_link(self.src, self.dst)
+        walk_and_unlink(self.src, self.dst)
+        assert not os.path.lexists(os.path.join(self.dst + self.src, 'file'))
+        assert os.listdir(self.dst) == []
+
     def test_walk_and_unlink_mkdirs(self):
         link_file = os.path.join(self.dst, 'NotSymLink')
         with open(link_file, 'w') as fout:
@@ -224,6 +398,46 @@ class TestLinking(object):
         assert os.path.exists(self.dst)
         assert os.path.exists(link_file)
 
+    def test_walk_and_link_raises_cleans(self):
+        os.symlink(self.fnames[0], self.dst_fnames[5])
+        with pytest.raises(PakitLinkError):
+            walk_and_link(self.src, self.dst)
+        assert os.listdir(self.dst) == ['file5']
+
+    def test_walk_and_link_linked(self):
+        links = walk_and_link(self.src, self.dst)
+        os.remove(self.dst_fnames[0])
+        linked = [link for link in links if link != 'file0']
+        assert walk_and_link(self.src, self.dst, linked=linked) == ['file0']
+        assert os.path.islink(self.dst_fnames[0])
+
+    def test_split_manifest(self):
+        links = walk_and_link(self.src, self.dst)
+        os.remove(self.fnames[0])
+        os.remove(self.dst_fnames[1])
+        os.remove(self.dst_fnames[2])
+        os.symlink(self.fnames[3], self.dst_fnames[2])
+        valid, stale = split_manifest(self.src, self.dst, links + ['gone'])
+        assert stale == ['file0']
+        assert sorted(valid) == sorted(links[3:])
+
+    def test_walk_and_unlink_all_folded(self):
+        walk_and_link(self.src, self.dst, fold=True)
+        walk_and_unlink_all(self.dst, self.src)
+        assert not os.path.lexists(self.subdir.replace(self.src, self.dst))
+        for fname in self.fnames:
+            assert os.path.exists(fname)
+
+    def test_unlink_manifest(self):
+        links = walk_and_link(self.src, self.dst)
+        unlink_manifest(self.dst, links)
+        for fname in self.dst_fnames:
+            assert not os.path.exists(fname)
+        assert not os.path.exists(self.subdir.replace(self.src, self.dst))
+        for fname in self.fnames:
+            assert os.path.exists(fname)
+        assert os.path.exists(self.dst)
+
     def test_walk_and_unlink_all(self):
         walk_and_link(self.src, self.dst)
 
@@ -258,6 +472,12 @@ class TestExtractFuncs(object):
         extract(self.arc_file(ext), self.target)
         assert os.listdir(os.path.dirname(self.expect_file)) == ['example.txt']
 
+    def test_extract_unstaged(self):
+        self.__test_ext('tar.gz')
+        parent = os.path.dirname(self.target)
+        assert [path for path in os.listdir(parent)
+                if path.startswith(pakit.shell.STAGE_PREFIX)] == []
+
     def test_rar(self):
         self.__test_ext('rar')
 
@@ -291,11 +511,12 @@ class TestExtractFuncs(object):
     def test_tar_xz(self):
         self.__test_ext('tar.xz')
 
+    @mock.patch('pakit.shell.zstandard', None)
     @mock.patch('pakit.shell.subprocess')
-    def test_tar_xz_unavailable(self, mock_sub):
-        mock_sub.side_effect = PakitCmdError('No cmd.')
+    def test_tar_zst_unavailable(self, mock_sub):
+        mock_sub.Popen.side_effect = OSError('No cmd.')
         with pytest.raises(PakitCmdError):
-            self.__test_ext('tar.xz')
+            extract_tar_zst(self.arc_file('tar.gz'), self.target)
 
     def test_zip(self):
         self.__test_ext('zip')
@@ -396,6 +617,55 @@ class TestArchive(object):
         with pytest.raises(PakitError):
             self.archive.download()
 
+    def test_streamable(self):
+        assert not self.archive.streamable
+        self.archive.uri = tc.TAR
+        assert self.archive.streamable
+        self.archive.stream = False
+        assert not self.archive.streamable
+
+    def test_stream_extract(self):
+        self.archive.uri = tc.TAR
+        with self.archive:
+            assert self.archive.ready
+            assert not os.path.exists(self.archive.arc_file)
+            assert os.path.exists(os.path.join(self.test_dir, 'README'))
+
+    def test_stream_extract_bad_hash(self):
+        self.archive = Archive(tc.TAR, target=self.test_dir, hash='bad hash')
+        with pytest.raises(PakitError):
+            self.archive.stream_extract()
+        assert not os.path.exists(self.test_dir)
+
+    def test_stream_extract_traversal(self):
+        evil = os.path.join(os.path.dirname(tc.CONF.path_to('source')),
+                            'evil_written.txt')
+        arc_file = os.path.join(tc.STAGING, 'evil.tar')
+        try:
+            tarf = tarfile.open(arc_file, 'w')
+            info = tarfile.TarInfo('../../evil_written.txt')
+            info.size = 4
+            tarf.addfile(info, io.BytesIO(b'evil'))
+            tarf.close()
+
+            self.archive = Archive('file://' + arc_file, target=self.test_dir,
+                                   hash='bad hash')
+            with pytest.raises(PakitError):
+                self.archive.stream_extract()
+            assert not os.path.exists(evil)
+            assert not os.path.exists(self.test_dir)
+        finally:
+            tc.delete_it(arc_file)
+            tc.delete_it(evil)
+
+    def test_stream_extract_not_tar(self):
+        self.archive.uri = tc.TAR
+        with mock.patch('pakit.shell.tar_stream_args') as mock_args:
+            mock_args.return_value = None
+            with self.archive:
+                assert self.archive.ready
+                assert not os.path.exists(self.archive.arc_file)
+
     def test_extract(self):
         with self.archive:
             assert os.path.exists(self.test_dir)
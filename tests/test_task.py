@@ -4,18 +4,23 @@ Test pakit.task
 from __future__ import absolute_import, print_function
 import logging
 import os
+import shutil
+import threading
+import time
 import mock
 import pytest
 
 import pakit.conf
-from pakit.exc import PakitCmdError, PakitLinkError
+from pakit.conf import open_idb
+from pakit.exc import PakitCmdError, PakitDBError, PakitLinkError
 import pakit.main
 import pakit.recipe
+from pakit.shell import TRASH_DIR, delete_later, wait_deletions
 from pakit.task import (
-    create_substring_matcher, Task, RecipeTask,
-    InstallTask, RemoveTask, UpdateTask, DisplayTask,
-    ListInstalled, ListAvailable, SearchTask, RelinkRecipes,
-    CreateConfig, PurgeTask
+    create_substring_matcher, plan_links, switch_current, transfer_unfolded,
+    Task, RecipeTask, InstallTask, RemoveTask, UpdateTask, DisplayTask,
+    ListInstalled, ListAvailable, ListDependents, SearchTask, RelinkRecipes,
+    CreateConfig, PurgeTask, GCTask, old_versions
 )
 import tests.common as tc
 
@@ -62,10 +67,9 @@ class TestTaskBase(object):
 
     def teardown(self):
         RemoveTask(self.recipe).run()
-        try:
-            os.remove(pakit.conf.IDB.filename)
-        except OSError:
-            pass
+        with pakit.conf.IDB.transaction():
+            for name in list(pakit.conf.IDB):
+                del pakit.conf.IDB[name]
         try:
             self.recipe.repo.clean()
         except PakitCmdError:
@@ -106,13 +110,20 @@ class TestTaskInstall(TestTaskBase):
         name = self.recipe.name
 
         paths = pakit.conf.CONFIG.get('pakit.paths')
-        build_bin = os.path.join(paths['prefix'], name, 'bin', name)
+        version_dir = self.recipe.version_dir(self.recipe.repo.src_hash)
+        build_bin = os.path.join(version_dir, 'bin', name)
         link_bin = os.path.join(paths['link'], 'bin', name)
         assert os.path.exists(build_bin)
         assert os.path.exists(link_bin)
-        assert os.path.realpath(link_bin) == build_bin
-        with open(pakit.conf.IDB.filename) as fin:
-            assert 'ag:' in fin.read()
+        assert os.path.realpath(link_bin) == os.path.realpath(build_bin)
+        assert os.readlink(link_bin) == os.path.join(self.recipe.current_link,
+                                                     'bin', name)
+        assert name in open_idb(pakit.conf.CONFIG)
+        assert os.path.join('bin', name) in pakit.conf.IDB[name]['links']
+
+    def test_prefix_restored(self):
+        InstallTask(self.recipe).run()
+        assert self.recipe.opts['prefix'] == self.recipe.current_link
 
     @mock.patch('pakit.task.USER')
     def test_is_installed(self, mock_log):
@@ -121,6 +132,26 @@ class TestTaskInstall(TestTaskBase):
         task.run()
         assert mock_log.info.called
 
+    def test_plan_links(self):
+        InstallTask(self.recipe).run()
+        link = os.path.join('bin', self.recipe.name)
+        old_entry = pakit.conf.IDB[self.recipe.name]
+        entry = dict(old_entry)
+        entry['links'] = [path for path in entry['links'] if path != link]
+        pakit.conf.IDB[self.recipe.name] = entry
+        pakit.conf.IDB['other'] = {'links': [link]}
+        try:
+            with pytest.raises(PakitLinkError):
+                plan_links(self.recipe)
+            pakit.conf.CONFIG['pakit.link.priority'] = ['ag']
+            assert plan_links(self.recipe) == ({link: 'other'}, [])
+            pakit.conf.CONFIG['pakit.link.priority'] = ['other']
+            assert plan_links(self.recipe) == ({}, [link])
+        finally:
+            pakit.conf.CONFIG['pakit.link.priority'] = []
+            del pakit.conf.IDB['other']
+            pakit.conf.IDB[self.recipe.name] = old_entry
+
 
 class TestTaskRollback(object):
     def setup(self):
@@ -141,7 +172,7 @@ class TestTaskRollback(object):
         self.recipe = pakit.recipe.RDB.get('build')
         with pytest.raises(PakitCmdError):
             InstallTask(self.recipe).run()
-        assert os.listdir(os.path.dirname(self.recipe.install_dir)) == []
+        assert not os.path.exists(self.recipe.install_root)
         assert os.path.exists(self.recipe.source_dir)
         assert os.path.exists(self.recipe.link_dir)
 
@@ -149,7 +180,7 @@ class TestTaskRollback(object):
         self.recipe = pakit.recipe.RDB.get('link')
         with pytest.raises(PakitLinkError):
             InstallTask(self.recipe).run()
-        assert os.listdir(os.path.dirname(self.recipe.install_dir)) == []
+        assert not os.path.exists(self.recipe.install_root)
         assert os.path.exists(self.recipe.source_dir)
         assert os.path.exists(self.recipe.link_dir)
 
@@ -157,7 +188,7 @@ class TestTaskRollback(object):
         self.recipe = pakit.recipe.RDB.get('verify')
         with pytest.raises(AssertionError):
             InstallTask(self.recipe).run()
-        assert os.listdir(os.path.dirname(self.recipe.install_dir)) == []
+        assert not os.path.exists(self.recipe.install_root)
         assert os.path.exists(self.recipe.source_dir)
         assert os.path.exists(self.recipe.link_dir)
 
@@ -172,6 +203,9 @@ class TestTaskRollback(object):
         self.recipe.repo = 'unstable'
         UpdateTask(self.recipe).run()
         assert pakit.conf.IDB.get(self.recipe.name)['hash'] == expect
+        assert os.readlink(self.recipe.current_link) == expect
+        assert sorted(os.listdir(self.recipe.install_root)) == [
+            'current', expect]
         RemoveTask(self.recipe).run()
 
 
@@ -183,19 +217,41 @@ class TestTaskRemove(TestTaskBase):
     def test_is_installed(self):
         InstallTask(self.recipe).run()
         assert self.recipe.name in pakit.conf.IDB
-        with open(pakit.conf.IDB.filename) as fin:
-            assert 'ag:' in fin.read()
+        assert self.recipe.name in open_idb(pakit.conf.CONFIG)
 
         RemoveTask(self.recipe).run()
         assert self.recipe.name not in pakit.conf.IDB
-        with open(pakit.conf.IDB.filename) as fin:
-            assert 'ag:' not in fin.read()
+        assert self.recipe.name not in open_idb(pakit.conf.CONFIG)
 
         paths = pakit.conf.CONFIG.get('pakit.paths')
         assert os.path.exists(paths['prefix'])
         assert os.path.exists(paths['link'])
         assert os.listdir(paths['link']) == []
 
+    def test_gives_back_links(self):
+        ack = pakit.recipe.RDB.get('ack')
+        link = os.path.join('bin', 'ag')
+        link_path = os.path.join(ack.link_dir, link)
+        try:
+            InstallTask(ack).run()
+            with open(os.path.join(ack.install_dir, link), 'w') as fout:
+                fout.write('dummy')
+            RelinkRecipes([ack.name]).run()
+            pakit.conf.CONFIG['pakit.link.priority'] = ['ag']
+            InstallTask(self.recipe).run()
+            assert link not in pakit.conf.IDB[ack.name]['links']
+            assert os.path.realpath(link_path).startswith(
+                os.path.realpath(self.recipe.install_dir))
+
+            RemoveTask(self.recipe).run()
+            assert link in pakit.conf.IDB[ack.name]['links']
+            assert link in open_idb(pakit.conf.CONFIG)[ack.name]['links']
+            assert os.path.realpath(link_path).startswith(
+                os.path.realpath(ack.install_dir))
+        finally:
+            pakit.conf.CONFIG['pakit.link.priority'] = []
+            RemoveTask(ack).run()
+
 
 class TestTaskUpdate(TestTaskBase):
     def teardown(self):
@@ -223,31 +279,68 @@ class TestTaskUpdate(TestTaskBase):
 
         recipe.repo = 'unstable'
         UpdateTask(recipe).run()
-        assert pakit.conf.IDB.get(recipe.name)['hash'] != expect
+        new_hash = pakit.conf.IDB.get(recipe.name)['hash']
+        assert new_hash != expect
+        assert os.readlink(recipe.current_link) == new_hash
+        assert sorted(os.listdir(recipe.install_root)) == sorted(
+            ['current', new_hash])
 
         recipe.repo = old_repo_name
 
-    def test_save_old_install(self):
+    def test_requirement_updated(self):
         recipe = self.recipe
         InstallTask(recipe).run()
-        task = UpdateTask(recipe)
-        task.save_old_install()
-        assert pakit.conf.IDB.get(recipe.name) is None
-        assert not os.path.exists(recipe.install_dir)
-        assert os.path.exists(recipe.install_dir + '_bak')
+        old = os.readlink(recipe.current_link)
+        entry = dict(pakit.conf.IDB[recipe.name])
+        entry['requires'] = ['lib']
+        pakit.conf.IDB[recipe.name] = entry
+        pakit.conf.IDB['lib'] = {'time': entry['time'] + 60}
+
+        UpdateTask(recipe).run()
+        del pakit.conf.IDB['lib']
+        assert os.readlink(recipe.current_link) == old + '_1'
+        assert pakit.conf.IDB[recipe.name]['hash'] == old
+        recipe.verify()
 
-    def test_restore_old_install(self):
+    @mock.patch('pakit.task.delete_later')
+    def test_restore_old_install_unversioned(self, mock_delete):
+        task = UpdateTask(self.recipe)
+        task.old_entry = {'hash': 'old', 'requires': []}
+        task.old_version = None
+        pakit.conf.IDB[self.recipe.name] = {'links': []}
+        task.restore_old_install('new')
+        mock_delete.assert_called_once_with(
+            self.recipe.version_dir('new'),
+            pakit.conf.CONFIG.path_to('prefix'))
+
+    def test_switch_current(self):
         recipe = self.recipe
         InstallTask(recipe).run()
-        task = UpdateTask(recipe)
-        task.save_old_install()
-        task.restore_old_install()
-        assert pakit.conf.IDB.get(recipe.name)['hash'] == recipe.repo.src_hash
-        assert os.path.exists(recipe.install_dir)
-        assert not os.path.exists(recipe.install_dir + '_bak')
+        old = os.readlink(recipe.current_link)
+        shutil.copytree(recipe.version_dir(old), recipe.version_dir('other'),
+                        symlinks=True)
+        switch_current(recipe, 'other')
+        assert os.readlink(recipe.current_link) == 'other'
+        assert os.path.exists(os.path.join(recipe.link_dir, 'bin', 'ag'))
+        switch_current(recipe, old)
+        assert os.readlink(recipe.current_link) == old
         recipe.verify()
 
 
+class TestTransferUnfolded(TestTaskBase):
+    def test_transfer_unfolded(self):
+        pakit.conf.IDB['ag'] = {'links': ['bin', 'share']}
+        try:
+            transfer_unfolded({
+                'share': ['share/doc', 'share/man'],
+                'share/doc': ['share/doc/ag'],
+            })
+            assert pakit.conf.IDB['ag']['links'] == ['bin', 'share/doc/ag',
+                                                     'share/man']
+        finally:
+            del pakit.conf.IDB['ag']
+
+
 class TestTaskRelink(TestTaskBase):
     def test_relink(self):
         recipe = self.recipe
@@ -258,6 +351,91 @@ class TestTaskRelink(TestTaskBase):
         assert sorted(os.listdir(recipe.link_dir)) == ['bin', 'share']
         assert os.path.islink(os.path.join(recipe.link_dir, 'bin', 'ag'))
 
+    def test_relink_incremental(self):
+        recipe = self.recipe
+        InstallTask(recipe).run()
+        new_file = os.path.join(recipe.install_dir, 'bin', 'ag-new')
+        with open(new_file, 'w') as fout:
+            fout.write('dummy')
+        kept = os.path.join(recipe.link_dir, 'bin', 'ag')
+        kept_stat = os.lstat(kept)
+
+        RelinkRecipes([recipe.name]).run()
+        assert os.path.islink(new_file.replace(recipe.install_dir,
+                                               recipe.link_dir))
+        assert os.lstat(kept).st_ino == kept_stat.st_ino
+        assert os.path.join('bin', 'ag-new') in \
+            pakit.conf.IDB[recipe.name]['links']
+
+        os.remove(new_file)
+        RelinkRecipes([recipe.name]).run()
+        assert not os.path.lexists(new_file.replace(recipe.install_dir,
+                                                    recipe.link_dir))
+        assert os.path.join('bin', 'ag-new') not in \
+            pakit.conf.IDB[recipe.name]['links']
+
+    def test_relink_not_installed(self, mock_print):
+        RelinkRecipes([self.recipe.name]).run()
+        mock_print.assert_called_with('ag: Not Installed')
+
+
+class TestTaskGC(TestTaskBase):
+    def setup(self):
+        super(TestTaskGC, self).setup()
+        self.orphan = os.path.join(self.config.path_to('source'), 'orphan')
+        os.makedirs(self.orphan)
+        stale = time.time() - self.config.get('pakit.gc.max_age') - 60
+        os.utime(self.orphan, (stale, stale))
+
+    def teardown(self):
+        super(TestTaskGC, self).teardown()
+        tc.delete_it(self.orphan)
+        tc.delete_it(os.path.join(self.config.path_to('source'), TRASH_DIR))
+
+    def test_gc_dry_run(self, mock_print):
+        garbage = GCTask(dry_run=True).run()
+        assert (self.orphan, 'not installed') in garbage
+        assert os.path.exists(self.orphan)
+        assert mock_print.called
+
+    def test_gc(self, mock_print):
+        GCTask().run()
+        assert not os.path.exists(self.orphan)
+
+    def test_gc_nothing(self, mock_print):
+        GCTask().run()
+        wait_deletions()
+        mock_print.reset_mock()
+        assert GCTask(dry_run=True).run() == []
+        mock_print.assert_called_once_with('Nothing to delete')
+        mock_print.reset_mock()
+        assert GCTask().run() == []
+        mock_print.assert_called_once_with('Nothing to delete')
+
+    def test_gc_skips_pending_trash(self):
+        release = threading.Event()
+        with mock.patch('pakit.shell.remove_quietly',
+                        side_effect=lambda _: release.wait()):
+            delete_later(self.orphan)
+            holder = os.path.join(os.path.dirname(self.orphan), TRASH_DIR)
+            holder = os.path.join(holder, os.listdir(holder)[0])
+            try:
+                garbage = GCTask(dry_run=True).find_garbage()
+                assert (holder, 'trash') not in garbage
+            finally:
+                release.set()
+                wait_deletions()
+
+        assert (holder, 'trash') in GCTask(dry_run=True).find_garbage()
+
+    def test_gc_old_versions(self):
+        recipe = self.recipe
+        InstallTask(recipe).run()
+        old = recipe.version_dir('old')
+        os.makedirs(old)
+        assert old_versions(recipe) == [old]
+        assert old_versions(recipe, keep=1) == []
+
 
 class TestTaskPurge(TestTaskBase):
     def test_purge_abort(self, mock_input):
@@ -328,12 +506,49 @@ class TestTaskQuery(TestTaskBase):
         expect = ' '.join(pakit.recipe.RDB.names(desc=False))
         mock_print.assert_called_with(expect)
 
+    def test_list_dependents(self, mock_print):
+        pakit.conf.IDB['lib'] = {'requires': []}
+        pakit.conf.IDB['app'] = {'requires': ['lib', 'other']}
+        out = ListDependents('lib').run().split('\n')
+        del pakit.conf.IDB['lib']
+        del pakit.conf.IDB['app']
+        assert out[0] == 'Installed Recipes Requiring lib:'
+        assert out[-1] == '  app          lib'
+
+    def test_list_dependents_none(self, mock_print):
+        ListDependents('ag').run()
+        mock_print.assert_called_with('ag: No installed recipe requires it')
+
     def test_search_task(self):
         args = pakit.main.create_args_parser().parse_args('search ack'.split())
         ack = pakit.recipe.RDB.get('ack')
         results = SearchTask(args).run()
         assert results[1:] == [str(ack)]
 
+    def test_search_task_all(self):
+        args = pakit.main.create_args_parser().parse_args(
+            'search --all grep programmers'.split())
+        ack = pakit.recipe.RDB.get('ack')
+        assert SearchTask(args).matching_recipes() == [str(ack)]
+
+    def test_search_task_rank_names(self):
+        args = pakit.main.create_args_parser().parse_args(
+            'search ag grep'.split())
+        results = SearchTask(args).matching_recipes()
+        assert results[0] == str(pakit.recipe.RDB.get('ag'))
+
+    def test_search_task_regex(self):
+        args = pakit.main.create_args_parser().parse_args(
+            'search --regex --names ^ac.$'.split())
+        ack = pakit.recipe.RDB.get('ack')
+        assert SearchTask(args).matching_recipes() == [str(ack)]
+
+    def test_search_task_bad_regex(self):
+        args = pakit.main.create_args_parser().parse_args(
+            'search --regex ('.split())
+        with pytest.raises(PakitDBError):
+            SearchTask(args).matching_recipes()
+
     def test_display_info(self):
         prefix = pakit.task.PREFIX
         results = DisplayTask(self.recipe).run()